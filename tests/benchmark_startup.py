@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Startup time of daemon-tools, every run is a fresh interpreter.
+
+    python tests/benchmark_startup.py [runs] [configs]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs daemon-tools with settings pointed to the temporary directory
+TOOLS = '''
+import sys
+from upstart import settings
+settings.SETTINGS_MANAGER['configs'] = %(path)r
+settings.SETTINGS_MANAGER['socket'] = %(path)r + '/daemon-manager.sock'
+settings.SETTINGS_MANAGER['cache'] = %(cache)r
+settings.SETTINGS_TOOLS['log']['dir'] = %(path)r + '/'
+from upstart.cli import CLI
+sys.argv = ['daemon-tools'] + sys.argv[1:]
+sys.exit(CLI().execute())
+'''
+
+
+def measure(code, args, runs):
+    times = []
+    for _ in xrange(runs):
+        started = time.time()
+        process = subprocess.Popen([sys.executable, '-c', code] + args, cwd=ROOT,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate()
+        times.append(time.time() - started)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    configs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    path = tempfile.mkdtemp()
+    try:
+        os.mkdir(path + '/conf-enabled')
+        for i in xrange(configs):
+            with open('%s/conf-enabled/daemon-%s' % (path, i), 'w') as config_file:
+                config_file.write('pid: %s/daemon-%s.pid\nrun: /bin/sleep 1000\n' % (path, i))
+
+        benchmarks = [
+            ('python', '', []),
+            ('import upstart.cli', 'import upstart.cli', []),
+            ('status <name>, no cache', TOOLS % {'path': path, 'cache': None}, ['status', 'daemon-0', '--direct']),
+            ('status <name>', TOOLS % {'path': path, 'cache': path + '/configs.cache'}, ['status', 'daemon-0', '--direct']),
+            ('status, no cache', TOOLS % {'path': path, 'cache': None}, ['status', '--direct']),
+            ('status', TOOLS % {'path': path, 'cache': path + '/configs.cache'}, ['status', '--direct']),
+        ]
+        print '%s runs, %s configs, median:' % (runs, configs)
+        for title, code, args in benchmarks:
+            print '  %-28s %7.1f ms' % (title, measure(code, args, runs) * 1000)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
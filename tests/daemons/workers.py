@@ -48,5 +48,6 @@ if __name__ == '__main__':
     MyDaemonMaster(
         log=log,
         pidfile=os.path.abspath('/vagrant/Python/ProcessMaster/tests/daemons/run/workers-test.pid'),
-        stop_timeout=15
+        stop_timeout=15,
+        worker_log='/vagrant/Python/ProcessMaster/tests/daemons/logs/workers-test.log'
     ).execute()
\ No newline at end of file
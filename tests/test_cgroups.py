@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import unittest
+
+from upstart.cgroups import Cgroup, get_root
+
+
+def get_test_cgroup():
+    root = get_root('daemon-manager-test')
+    if root is None or not root.create():
+        return None
+    return root.child(str(os.getpid()))
+
+
+@unittest.skipIf(get_test_cgroup() is None, 'cgroup v2 is not writable')
+class TestCgroup(unittest.TestCase):
+
+    def setUp(self):
+        self.cgroup = get_test_cgroup()
+        self.assertTrue(self.cgroup.create())
+        self.processes = []
+
+    def tearDown(self):
+        self.cgroup.kill(1)
+        for process in self.processes:
+            process.wait()
+        self.cgroup.remove()
+        Cgroup(os.path.dirname(self.cgroup.path)).remove()
+
+    def start(self, cgroup, *args):
+        process = subprocess.Popen(args, preexec_fn=cgroup.add)
+        self.processes.append(process)
+        return process
+
+    def test_pids(self):
+        self.assertEqual(self.cgroup.get_pids(), [])
+        self.assertFalse(self.cgroup.is_populated())
+
+        child = self.cgroup.child('workers')
+        self.assertTrue(child.create())
+        first = self.start(self.cgroup, 'sleep', '10')
+        second = self.start(child, 'sleep', '10')
+        self.assertEqual(sorted(self.cgroup.get_pids()), sorted([first.pid, second.pid]))
+        self.assertEqual(child.get_pids(), [second.pid])
+        self.assertTrue(self.cgroup.is_populated())
+
+    def test_kill(self):
+        self.start(self.cgroup, 'sh', '-c', 'trap "" TERM; sleep 10 & sleep 10')
+        self.assertTrue(self.cgroup.kill(1))
+        self.assertFalse(self.cgroup.is_populated())
+        self.cgroup.remove()
+        self.assertFalse(self.cgroup.exists())
+        self.assertEqual(self.cgroup.get_pids(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
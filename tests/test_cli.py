@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from upstart.cli import CLI
+from upstart.control import ThreadOutput
+from upstart.manager import ConfigStore, Manager
+from upstart.processes import ProcessManager
+
+
+class StubbornProcessManager(ProcessManager):
+    # as if the processes ignored even SIGKILL
+    def stop(self, pids, *args, **kwargs):
+        return dict((pid, False) for pid in pids)
+
+
+class CLITestCase(unittest.TestCase):
+    CONFIGS = {}
+
+    def setUp(self):
+        self.conf_path = tempfile.mkdtemp()
+        os.mkdir(self.conf_path + '/conf-enabled')
+        for name, config in self.CONFIGS.iteritems():
+            with open(self.conf_path + '/conf-enabled/' + name, 'w') as config_file:
+                config_file.write('pid: %s/%s.pid\nrun: /bin/sleep 1000\n' % (self.conf_path, name) +
+                                  config % {'path': self.conf_path})
+        self.manager = Manager(self.conf_path, store=ConfigStore())
+        self.output, self.installed = ThreadOutput.install()
+
+    def tearDown(self):
+        for daemon in self.manager.daemons.itervalues():
+            if daemon.pid:
+                try:
+                    os.kill(daemon.pid, signal.SIGKILL)
+                    os.waitpid(daemon.pid, 0)
+                except OSError:
+                    pass
+        if self.installed:
+            self.output.uninstall()
+        shutil.rmtree(self.conf_path)
+
+    def call(self, command, name):
+        self.output.capture()
+        try:
+            code = getattr(CLI(self.manager), command)(name)
+        finally:
+            text = self.output.release()
+        return code, text
+
+
+class TestRunAll(CLITestCase):
+    CONFIGS = {'first': '', 'second': '', 'stubborn': ''}
+
+    def setUp(self):
+        super(TestRunAll, self).setUp()
+        self.manager.daemons['stubborn']._manager = StubbornProcessManager()
+
+    def test_stop_all(self):
+        code, text = self.call('start', 'all')
+        self.assertEqual(code, 0, text)
+        code, text = self.call('stop', 'all')
+        self.assertEqual(code, 1, text)
+        self.assertTrue(' * stopping first ... stopped' in text, text)
+        self.assertTrue(' * stopping stubborn ... cannot stop process' in text, text)
+
+    def test_restart_all(self):
+        self.call('start', 'all')
+        code, text = self.call('restart', 'all')
+        # stubborn is left running, so it isn't started again
+        self.assertEqual(code, 1, text)
+        self.assertTrue('not restarted' in text, text)
+        self.assertEqual(text.count('restarted ('), 2, text)
+
+
+class TestStopScript(CLITestCase):
+    CONFIGS = {
+        'signalled': 'stop: /bin/sh -c "kill $(cat %(path)s/signalled.pid)"\n',
+        # the daemon is stopped as if it had no stop script
+        'ignored': 'stop: /bin/true\ntimeouts: {stop: 0.5}\n',
+    }
+
+    def test_signal(self):
+        self.call('start', 'signalled')
+        pid = self.manager.daemons['signalled'].pid
+        code, text = self.call('stop', 'signalled')
+        self.assertFalse(code, text)
+        self.assertFalse(self.manager.daemons['signalled'].manager.is_running(pid))
+
+    def test_fallback(self):
+        self.call('start', 'ignored')
+        pid = self.manager.daemons['ignored'].pid
+        code, text = self.call('stop', 'ignored')
+        self.assertFalse(code, text)
+        self.assertTrue('still running (%s) after stop script, stopped' % pid in text, text)
+        self.assertFalse(self.manager.daemons['ignored'].manager.is_running(pid))
+
+
+if __name__ == '__main__':
+    unittest.main()
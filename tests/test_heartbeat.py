@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from upstart.daemon import DaemonWorker
+from upstart.heartbeat import HeartbeatTable
+
+
+class BeatingWorker(DaemonWorker):
+    def run(self):
+        for i in xrange(1000):
+            self.active()
+
+
+class TestHeartbeat(unittest.TestCase):
+
+    def test_stalled(self):
+        heartbeats = HeartbeatTable(3)
+        self.assertEqual(heartbeats.get_stalled(10)[0], [])
+
+        heartbeats.times[1] -= 20
+        heartbeats.times[2] -= 5
+        stalled, next_check = heartbeats.get_stalled(10)
+        self.assertEqual(stalled, [1])
+        self.assertAlmostEqual(next_check, heartbeats.get(2) + 10)
+
+        heartbeats.reset(1)
+        self.assertEqual(heartbeats.get_stalled(10)[0], [])
+
+    def test_busy_time(self):
+        heartbeats = HeartbeatTable(1)
+        worker = BeatingWorker()
+        worker.attach(heartbeats, 0)
+        worker.busy()
+        self.assertTrue(heartbeats.is_busy(0))
+        heartbeats.busy_since[0] -= 2
+        self.assertTrue(heartbeats.get_busy_time(0) >= 2)
+        worker.idle()
+        self.assertFalse(heartbeats.is_busy(0))
+        busy_time = heartbeats.get_busy_time(0)
+        self.assertTrue(2 <= busy_time < 10)
+        worker.idle()
+        self.assertEqual(heartbeats.get_busy_time(0), busy_time)
+        heartbeats.reset(0)
+        self.assertEqual(heartbeats.get_busy_time(0), 0)
+
+    def test_worker_beats(self):
+        heartbeats = HeartbeatTable(2)
+        heartbeats.times[1] -= 100
+        worker = BeatingWorker()
+        worker.attach(heartbeats, 1)
+        worker.start()
+        worker.join()
+        # written by the child, seen by the parent
+        self.assertTrue(time.time() - heartbeats.get(1) < 10)
+        self.assertTrue(worker.is_active(10))
+
+    def test_worker_without_master(self):
+        worker = BeatingWorker()
+        self.assertTrue(worker.is_active())
+        self.assertEqual(worker.last_activity, None)
+        worker.start()
+        worker.join()
+        self.assertEqual(worker.exitcode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import re
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from upstart.daemon import DaemonMaster, DaemonWorker
+from upstart.logchannel import PIPE_BUF, LogChannel
+
+RECORDS = 2000
+LINE_RE = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ INFO test: worker (\d) record (\d+) x+$')
+
+
+class LoggingWorker(DaemonWorker):
+    def __init__(self, number):
+        super(LoggingWorker, self).__init__()
+        self.number = number
+
+    def run(self):
+        log = logging.getLogger('test')
+        for record in xrange(RECORDS):
+            log.info('worker %s record %s %s', self.number, record, 'x' * 100)
+        log.info('worker %s record %s %s', self.number, RECORDS, 'x' * PIPE_BUF)
+        while True:
+            time.sleep(1)
+
+
+class LoggingMaster(DaemonMaster):
+    def get_workers(self):
+        return [LoggingWorker(number) for number in xrange(4)]
+
+    def start_worker(self, worker):
+        return LoggingWorker(worker.number)
+
+
+class TestLogChannel(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'workers.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_drop(self):
+        # the smallest pipe, a page
+        channel = LogChannel(self.path, 2, capacity=1)
+        record = 'a' * 99 + '\n'
+        sent = 0
+        while not channel.dropped[1]:
+            channel.send(record, 1)
+            sent += 1
+        channel.send(record, 1)
+        channel.flush()
+        channel.send('b\n', 1)
+        channel.close()
+
+        with open(self.path) as log_file:
+            lines = log_file.read().splitlines()
+        self.assertEqual(lines[:sent - 1], [record[:-1]] * (sent - 1))
+        self.assertTrue(lines[sent - 1].endswith('daemon-master: 2 records of the worker in slot 1 dropped'))
+        self.assertEqual(lines[sent:], ['b'])
+
+    def test_master(self):
+        log = logging.getLogger('test')
+        log.setLevel(logging.INFO)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # workers don't write here but to worker_log
+                log.addHandler(logging.FileHandler(os.path.join(self.directory, 'master.log')))
+                LoggingMaster(log, worker_log=self.path).run()
+            finally:
+                os._exit(1)
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if not os.path.exists(self.path):
+                time.sleep(0.1)
+                continue
+            with open(self.path) as log_file:
+                if log_file.read().count('\n') >= 4 * (RECORDS + 1):
+                    break
+            time.sleep(0.1)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+        records = {}
+        with open(self.path) as log_file:
+            for line in log_file:
+                match = LINE_RE.match(line.rstrip('\n'))
+                self.assertTrue(match, line[:200])
+                records.setdefault(int(match.group(1)), []).append(int(match.group(2)))
+        # every worker's records come whole and in order, the long one is
+        # written by the worker itself and may overtake them
+        for number in xrange(4):
+            self.assertTrue(RECORDS in records[number])
+            records[number].remove(RECORDS)
+        self.assertEqual(records, dict((number, range(RECORDS)) for number in xrange(4)))
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, 'master.log')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
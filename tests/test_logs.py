@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from upstart.logs import (LogFile, LogPump, compress_segment, follow, get_key, get_segments, merge_logs,
+                          merge_tails, parse_time, read_log, tail)
+from upstart.manager import DaemonConfiguration
+from upstart.settings import SETTINGS_MANAGER
+
+# more than a pipe holds
+CHATTY = '%s -c "import sys; [sys.stdout.write(\'%%05d\' %% i + 60 * \'x\' + chr(10)) for i in xrange(5000)]"' % (
+    sys.executable,)
+
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dir_setting = SETTINGS_MANAGER['logs']['dir']
+        SETTINGS_MANAGER['logs']['dir'] = self.directory
+
+    def tearDown(self):
+        SETTINGS_MANAGER['logs']['dir'] = self.dir_setting
+        shutil.rmtree(self.directory)
+
+    def get_lines(self, name):
+        with open('%s/%s.log' % (self.directory, name)) as log_file:
+            return [line.split(' ', 3)[2:] for line in log_file.read().splitlines()]
+
+    def write_lines(self, log_file, started, number):
+        for second in xrange(number):
+            line = '%s stdout: line %s\n' % (get_key(started + second), second)
+            if second % 10 == 0:
+                # a line without the time belongs to the one before it
+                line += 'traceback of %s\n' % second
+            log_file.write(line, started + second)
+
+    def test_rotation(self):
+        path = self.directory + '/test.log'
+        log_file = LogFile(path, max_size=100, segments=2, hot=5)
+        for number in xrange(5):
+            log_file.write('%s\n' % (str(number) * 59))
+        log_file.close()
+        self.assertEqual(len(get_segments(path)), 3)
+        self.assertEqual(get_segments(path)[-1], path)
+        self.assertEqual(tail(path, 2), ['3' * 59 + '\n', '4' * 59 + '\n'])
+        self.assertEqual(len(tail(path, 10)), 3)
+
+    def test_tail(self):
+        path = self.directory + '/test.log'
+        log_file = LogFile(path, max_size=100000, segments=5, hot=5)
+        expected = []
+        for number in xrange(5000):
+            line = '%05d %s\n' % (number, 'x' * (number % 80))
+            expected.append(line)
+            log_file.write(line)
+        log_file.close()
+        for segment in get_segments(path)[:-2]:
+            compress_segment(segment)
+        self.assertTrue(get_segments(path)[0].endswith('.gz'))
+        for number in (0, 1, 10, 1000, 3000, 5000, 6000):
+            self.assertEqual(tail(path, number), expected[-number:] if number else [])
+
+    def test_follow(self):
+        path = self.directory + '/test.log'
+        with open(path, 'w') as log_file:
+            log_file.write('old\n')
+        written = []
+
+        class Followed(Exception):
+            pass
+
+        def write(data):
+            written.append(data)
+            if ''.join(written).count('\n') >= 3:
+                raise Followed()
+
+        def run():
+            try:
+                follow(path, write, interval=0.05)
+            except Followed:
+                pass
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        for number in xrange(2):
+            # after follow has seen the end of the file
+            time.sleep(0.2)
+            with open(path, 'a') as log_file:
+                log_file.write('new %s\n' % number)
+        # rotated: the rest goes to a new file
+        time.sleep(0.2)
+        os.rename(path, path + '.1')
+        with open(path, 'w') as log_file:
+            log_file.write('rotated\n')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(''.join(written), 'new 0\nnew 1\nrotated\n')
+
+    def test_read_range(self):
+        path = self.directory + '/test.log'
+        log_file = LogFile(path, max_size=5000, segments=10, hot=10)
+        log_file.INDEX_INTERVAL = 500
+        started = int(time.time()) - 3600
+        self.write_lines(log_file, started, 600)
+        log_file.close()
+        segments = get_segments(path)
+        self.assertTrue(len(segments) > 3)
+        compress_segment(segments[0])
+        compress_segment(segments[1])
+        self.assertTrue(get_segments(path)[0].endswith('.gz'))
+
+        def get_range(since, until):
+            return ''.join(str(chunk) for chunk in read_log(path, since, until))
+
+        with open(segments[-1]) as last_segment:
+            self.assertEqual(get_range(None, None).splitlines()[-3:], last_segment.read().splitlines()[-3:])
+        for since, until in [(0, 599), (10, 10), (95, 420), (590, 700), (-5, 3)]:
+            expected = ''.join('%s stdout: line %s\n' % (get_key(started + second), second) +
+                               ('traceback of %s\n' % second if second % 10 == 0 else '')
+                               for second in xrange(max(since, 0), min(until, 599) + 1))
+            self.assertEqual(get_range(started + since, started + until), expected)
+            # the same without indexes
+            for segment in get_segments(path):
+                if os.path.exists(segment + '.idx'):
+                    os.rename(segment + '.idx', segment + '.noidx')
+            self.assertEqual(get_range(started + since, started + until), expected)
+            for segment in get_segments(path):
+                if os.path.exists(segment + '.noidx'):
+                    os.rename(segment + '.noidx', segment + '.idx')
+
+    def test_merge(self):
+        started = int(time.time()) - 60
+        paths = [self.directory + '/first.log', self.directory + '/second.log']
+        for index, path in enumerate(paths):
+            log_file = LogFile(path, max_size=1 << 20)
+            self.write_lines(log_file, started + index, 20)
+            log_file.close()
+        records = list(merge_logs(paths, started + 5, started + 7))
+        self.assertEqual([(number, line.split()[-1]) for _, number, line in records],
+                         [(0, '5'), (1, '4'), (0, '6'), (1, '5'), (0, '7'), (1, '6')])
+        self.assertEqual([number for _, number, _ in merge_tails(paths, 3)], [0, 1, 1])
+
+    def test_dst(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/Berlin'
+        time.tzset()
+        try:
+            path = self.directory + '/test.log'
+            log_file = LogFile(path, max_size=1 << 20)
+            log_file.INDEX_INTERVAL = 500
+            # 2025-10-26 01:00 UTC clocks go back from 03:00 to 02:00
+            started = calendar.timegm((2025, 10, 26, 0, 0, 0, 0, 0, 0))
+            self.write_lines(log_file, started, 7200)
+            log_file.close()
+            since, until = started + 2700, started + 4500
+            lines = ''.join(str(chunk) for chunk in read_log(path, since, until)).splitlines()
+            self.assertEqual(lines[0], '2025-10-26 02:45:00+0200 stdout: line 2700')
+            self.assertEqual(lines[-2:], ['2025-10-26 02:15:00+0100 stdout: line 4500', 'traceback of 4500'])
+            self.assertEqual(len([line for line in lines if 'stdout' in line]), 1801)
+            self.assertEqual([line for _, _, line in merge_logs([path], since, until)],
+                             [line + '\n' for line in lines])
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+    def test_parse_time(self):
+        now = time.mktime((2026, 10, 18, 12, 0, 0, 0, 0, -1))
+        self.assertEqual(parse_time('10m', now), now - 600)
+        self.assertEqual(parse_time('2026-10-18 11:30', now), now - 1800)
+        self.assertEqual(parse_time('11:59:30', now), now - 30)
+        self.assertRaises(ValueError, parse_time, 'yesterday', now)
+
+    def test_rate(self):
+        pump = LogPump(max_size=1 << 20, rate=1, burst=2)
+        daemon_log = pump.get_log('test')
+        now = time.time()
+        for number in xrange(5):
+            daemon_log.add_line('stdout', str(number), now, '2026-10-18 12:00:00')
+        daemon_log.add_line('stdout', 'later', now + 1, '2026-10-18 12:00:01')
+        pump.close()
+        self.assertEqual(self.get_lines('test'), [['stdout:', '0'], ['stdout:', '1'],
+                                                  ['daemon-runtime:', '3 lines dropped'], ['stdout:', 'later']])
+
+    def test_pump(self):
+        pump = LogPump(max_size=1 << 20)
+        pump.start()
+        daemon = DaemonConfiguration.from_config({'pid': '/tmp/test.pid', 'run': CHATTY})
+        daemon.output = pump.get_log('chatty')
+        pid, _ = daemon.call(daemon.run_script)
+        # the thread of the pump drains the pipe, nothing else drives it
+        deadline = time.time() + 10
+        while pump.pipes and time.time() < deadline:
+            time.sleep(0.1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        pump.close()
+
+        lines = self.get_lines('chatty')
+        self.assertEqual(len(lines), 5000)
+        self.assertEqual(lines[-1], ['stdout:', '04999' + 60 * 'x'])
+
+    def test_blocking_call(self):
+        script = '%s -c "import sys; sys.stderr.write(200000 * \'e\'); print \'done\'"' % sys.executable
+        daemon = DaemonConfiguration.from_config({'pid': '/tmp/test.pid', 'run': 'true'})
+        daemon.log_path = self.directory + '/stop.log'
+        _, result = daemon.call(script, block=True)
+        self.assertEqual(result, 'done\n')
+        self.assertEqual(os.path.getsize(daemon.log_path), 200000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import gc
+import logging
+import os
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+
+from upstart.daemon import GC_FROZEN_THRESHOLD, DaemonMaster, DaemonWorker
+
+
+class ReportingWorker(DaemonWorker):
+    def __init__(self, master):
+        super(ReportingWorker, self).__init__()
+        self.master = master
+
+    def run(self):
+        os.write(self.master.report_fd, '%s %s %s\n' % (
+            self.master.preloads, len(self.master.model), gc.get_threshold()[2]))
+
+
+class PreloadingMaster(DaemonMaster):
+    preloads = 0
+
+    def preload(self):
+        self.preloads += 1
+        self.model = dict((i, [i]) for i in xrange(10000))
+
+    def get_workers(self):
+        return [ReportingWorker(self)]
+
+    def start_worker(self, worker):
+        return ReportingWorker(self)
+
+
+class TestPreload(unittest.TestCase):
+
+    def test_preload(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                master = PreloadingMaster(logging.getLogger('test'), freeze_gc=True)
+                master.report_fd = write_fd
+                master.run()
+            finally:
+                os._exit(1)
+        os.close(write_fd)
+
+        reports = ''
+        # the worker exits after its report, so it is respawned
+        while reports.count('\n') < 3:
+            reports += os.read(read_fd, 4096)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        os.close(read_fd)
+
+        for report in reports.splitlines()[:3]:
+            # loaded once, before the first worker
+            self.assertEqual(report, '1 10000 %s' % GC_FROZEN_THRESHOLD)
+
+
+class SleepingWorker(DaemonWorker):
+    def __init__(self, report_fd):
+        super(SleepingWorker, self).__init__()
+        self.report_fd = report_fd
+
+    def run(self):
+        os.write(self.report_fd, '%s\n' % os.getpid())
+        while True:
+            time.sleep(1)
+
+
+class SleepingMaster(DaemonMaster):
+    def get_workers(self):
+        return [SleepingWorker(self.report_fd)]
+
+    def start_worker(self, worker):
+        return SleepingWorker(self.report_fd)
+
+
+class TestRespawn(unittest.TestCase):
+
+    def read_pid(self, read_fd, timeout):
+        ready, _, _ = select.select([read_fd], [], [], timeout)
+        self.assertTrue(ready, 'no worker started within %s seconds' % timeout)
+        return int(os.read(read_fd, 4096).split()[0])
+
+    def test_sigchld_wakeup(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # no timers: the master waits without a timeout until a
+                # signal writes to its wakeup pipe
+                master = SleepingMaster(logging.getLogger('test'))
+                master.report_fd = write_fd
+                master.run()
+            finally:
+                os._exit(1)
+        os.close(write_fd)
+        try:
+            worker_pid = self.read_pid(read_fd, 5)
+            for _ in xrange(3):
+                started = time.time()
+                os.kill(worker_pid, signal.SIGKILL)
+                new_pid = self.read_pid(read_fd, 2)
+                self.assertNotEqual(new_pid, worker_pid)
+                self.assertTrue(time.time() - started < 1)
+                worker_pid = new_pid
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+
+
+class BeatingWorker(DaemonWorker):
+    kind = 'beating'
+
+    def __init__(self, report_fd):
+        super(BeatingWorker, self).__init__()
+        self.report_fd = report_fd
+
+    def report(self, event):
+        os.write(self.report_fd, '%s %s %s\n' % (event, self.kind, os.getpid()))
+
+    def run(self):
+        self.report('started')
+        while True:
+            self.active()
+            time.sleep(0.1)
+
+
+class HangingWorker(BeatingWorker):
+    kind = 'hanging'
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.report('terminated'))
+        self.report('started')
+        while True:
+            time.sleep(1)
+
+
+class StallingMaster(DaemonMaster):
+    def get_workers(self):
+        return [HangingWorker(self.report_fd), BeatingWorker(self.report_fd)]
+
+    def start_worker(self, worker):
+        return type(worker)(self.report_fd)
+
+
+class TestActivity(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = ''
+
+    def read_event(self, read_fd, timeout):
+        deadline = time.time() + timeout
+        while '\n' not in self.buffer:
+            ready, _, _ = select.select([read_fd], [], [], max(deadline - time.time(), 0))
+            self.assertTrue(ready, 'no event within %s seconds' % timeout)
+            self.buffer += os.read(read_fd, 4096)
+        line, self.buffer = self.buffer.split('\n', 1)
+        event, kind, pid = line.split()
+        return event, kind, int(pid)
+
+    def test_stalled_worker(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                master = StallingMaster(logging.getLogger('test'), worker_activity=True,
+                                        worker_timeout=0.5, stop_timeout=3)
+                master.report_fd = write_fd
+                master.run()
+            finally:
+                os._exit(1)
+        os.close(write_fd)
+        hanging_pids = []
+        try:
+            pids = {}
+            for _ in xrange(2):
+                event, kind, worker_pid = self.read_event(read_fd, 5)
+                pids[kind] = worker_pid
+            hanging_pids.append(pids['hanging'])
+            self.assertEqual(self.read_event(read_fd, 3), ('terminated', 'hanging', pids['hanging']))
+
+            # the master keeps respawning while the stalled worker stops
+            started = time.time()
+            os.kill(pids['beating'], signal.SIGKILL)
+            event, kind, worker_pid = self.read_event(read_fd, 2)
+            self.assertEqual((event, kind), ('started', 'beating'))
+            self.assertTrue(time.time() - started < 1)
+
+            # killed after stop_timeout and replaced
+            event, kind, worker_pid = self.read_event(read_fd, 5)
+            hanging_pids.append(worker_pid)
+            self.assertEqual((event, kind), ('started', 'hanging'))
+            self.assertTrue(time.time() - started > 2)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+            # they ignore the SIGTERM of the exiting master
+            for worker_pid in hanging_pids:
+                try:
+                    os.kill(worker_pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+
+class VersionWorker(DaemonWorker):
+    def __init__(self, master):
+        super(VersionWorker, self).__init__()
+        self.master = master
+        self.version = master.version
+
+    def run(self):
+        os.write(self.master.report_fd, 'start %s %s\n' % (self.version, os.getpid()))
+        try:
+            # loading takes a while, the worker isn't ready until it beats
+            time.sleep(0.3)
+            while True:
+                self.active()
+                time.sleep(0.05)
+        finally:
+            os.write(self.master.report_fd, 'stop %s %s\n' % (self.version, os.getpid()))
+
+
+class ReloadingMaster(DaemonMaster):
+    version = 0
+
+    def preload(self):
+        self.version += 1
+
+    def get_workers(self):
+        return [VersionWorker(self) for _ in xrange(3)]
+
+    def start_worker(self, worker):
+        return VersionWorker(self)
+
+
+class TestRollingReload(unittest.TestCase):
+
+    def test_rolling_reload(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                master = ReloadingMaster(logging.getLogger('test'), rolling_reload=True, max_surge=1)
+                master.report_fd = write_fd
+                master.run()
+            finally:
+                os._exit(1)
+        os.close(write_fd)
+
+        reports = ''
+        while reports.count('start 1') < 3:
+            reports += os.read(read_fd, 4096)
+        os.kill(pid, signal.SIGHUP)
+        while reports.count('stop 1') < 3:
+            reports += os.read(read_fd, 4096)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        os.close(read_fd)
+
+        alive = set()
+        for report in reports.splitlines():
+            event, version, worker_pid = report.split()
+            if event == 'stop' and version == '2':
+                break
+            if event == 'start':
+                alive.add(worker_pid)
+            else:
+                alive.discard(worker_pid)
+                # an old worker is retired after its replacement is ready
+                self.assertEqual(len(alive), 3)
+            self.assertTrue(len(alive) <= 4)
+        self.assertEqual(reports.count('start 2'), 3)
+
+
+class ServingWorker(DaemonWorker):
+    def __init__(self, master):
+        super(ServingWorker, self).__init__()
+        self.master = master
+
+    def run(self):
+        [sock] = self.sockets
+        os.write(self.master.report_fd, '%s %s\n' % (sock.getsockname()[1], os.getpid()))
+        while True:
+            connection, _ = sock.accept()
+            connection.sendall(str(os.getpid()))
+            connection.close()
+
+
+class ServingMaster(DaemonMaster):
+    def get_workers(self):
+        return [ServingWorker(self) for _ in xrange(2)]
+
+    def start_worker(self, worker):
+        return ServingWorker(self)
+
+
+class TestListen(unittest.TestCase):
+
+    def get_reports(self, **kwargs):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                master = ServingMaster(logging.getLogger('test'), **kwargs)
+                master.report_fd = write_fd
+                master.run()
+            finally:
+                os._exit(1)
+        os.close(write_fd)
+        reports = ''
+        while reports.count('\n') < 2:
+            reports += os.read(read_fd, 4096)
+        os.close(read_fd)
+        return pid, [report.split() for report in reports.splitlines()]
+
+    def test_shared(self):
+        pid, reports = self.get_reports(listen='127.0.0.1:0')
+        try:
+            # bound once by the master
+            [port] = set(port for port, _ in reports)
+            client = socket.create_connection(('127.0.0.1', int(port)), timeout=10)
+            self.assertTrue(client.recv(16) in [worker_pid for _, worker_pid in reports])
+            client.close()
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    def test_reuse_port(self):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        pid, reports = self.get_reports(listen='127.0.0.1:%s' % port, reuse_port=True)
+        try:
+            self.assertEqual(set(report_port for report_port, _ in reports), set([str(port)]))
+            pids = set()
+            for _ in xrange(50):
+                client = socket.create_connection(('127.0.0.1', port), timeout=10)
+                pids.add(client.recv(16))
+                client.close()
+            # both workers have their own socket
+            self.assertEqual(pids, set(worker_pid for _, worker_pid in reports))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_stalled_scraper(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'metrics.sock')
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                master = PreloadingMaster(logging.getLogger('test'), metrics_listen='unix:' + path)
+                master.report_fd = write_fd
+                master.run()
+            finally:
+                os._exit(1)
+        os.close(write_fd)
+        try:
+            reports = os.read(read_fd, 4096)
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            deadline = time.time() + 5
+            while True:
+                try:
+                    stalled.connect(path)
+                    break
+                except socket.error:
+                    # the metrics are set up after the first workers start
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.01)
+            # workers exit after their reports and are respawned while the
+            # connection is open
+            time.sleep(0.2)
+            fcntl.fcntl(read_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+            try:
+                while os.read(read_fd, 4096):
+                    pass
+            except OSError:
+                pass
+            reports = ''
+            deadline = time.time() + 2
+            while reports.count('\n') < 5 and select.select([read_fd], [], [], deadline - time.time())[0]:
+                reports += os.read(read_fd, 4096)
+            self.assertTrue(reports.count('\n') >= 5, reports)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.settimeout(2)
+            client.connect(path)
+            client.sendall('GET /metrics HTTP/1.0\r\n\r\n')
+            response = ''
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                response += data
+            client.close()
+            stalled.close()
+            self.assertTrue(response.startswith('HTTP/1.0 200 OK'))
+            self.assertTrue('daemon_master_workers 1\n' in response, response)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
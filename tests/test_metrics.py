@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from upstart.metrics import MetricsRegistry, MetricsServer, write_textfile
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.up = self.registry.gauge('up', 'Whether it is up.', ['daemon'])
+        self.loop = self.registry.summary('loop_seconds', 'Loop duration.')
+
+    def test_render(self):
+        self.up.set(1, ('a',))
+        self.up.set(0, ('b "x"\n',))
+        self.loop.observe(0.5)
+        self.loop.observe(0.25)
+        self.assertEqual(self.registry.render(),
+                         '# HELP up Whether it is up.\n'
+                         '# TYPE up gauge\n'
+                         'up{daemon="a"} 1\n'
+                         'up{daemon="b \\"x\\"\\n"} 0\n'
+                         '# HELP loop_seconds Loop duration.\n'
+                         '# TYPE loop_seconds summary\n'
+                         'loop_seconds_sum 0.75\n'
+                         'loop_seconds_count 2\n')
+
+    def test_incremental(self):
+        self.up.set(1, ('a',))
+        self.up.set(1, ('b',))
+        text = self.registry.render()
+        # nothing has changed, the same text is returned
+        self.up.set(1, ('a',))
+        self.assertTrue(self.registry.render() is text)
+        loop_text = self.loop.render()
+
+        self.up.set(0, ('b',))
+        self.assertTrue(self.loop.render() is loop_text)
+        self.assertTrue('up{daemon="b"} 0\n' in self.registry.render())
+
+        self.registry.remove_series(('b',))
+        self.assertFalse('daemon="b"' in self.registry.render())
+
+    def test_counter(self):
+        counter = self.registry.counter('respawns_total', 'Respawns.', ['daemon'])
+        counter.inc(labels=('a',))
+        counter.inc(2, ('a',))
+        self.assertEqual(counter.get(('a',)), 3)
+        self.assertRaises(ValueError, counter.inc, 1, ('a', 'b'))
+        self.assertRaises(ValueError, self.registry.counter, 'respawns_total', 'Respawns.')
+
+    def test_textfile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'daemons.prom')
+            self.up.set(1, ('a',))
+            write_textfile(path, self.registry)
+            with open(path) as metrics_file:
+                self.assertEqual(metrics_file.read(), self.registry.render())
+            self.assertEqual(os.listdir(directory), ['daemons.prom'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_server(self):
+        directory = tempfile.mkdtemp()
+        collected = []
+        server = MetricsServer('unix:' + os.path.join(directory, 'metrics.sock'), self.registry,
+                               lambda: collected.append(True), threaded=False)
+        try:
+            server.listen()
+            self.up.set(1, ('a',))
+
+            def get(request):
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                client.connect(server.path)
+                client.sendall(request)
+                server.accept()
+                response = ''
+                while True:
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    response += data
+                client.close()
+                return response
+
+            response = get('GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            self.assertTrue(response.startswith('HTTP/1.0 200 OK\r\n'))
+            self.assertTrue(response.endswith('\r\n\r\n' + self.registry.render()))
+            self.assertEqual(collected, [True])
+            self.assertTrue(get('GET /other HTTP/1.1\r\n\r\n').startswith('HTTP/1.0 404'))
+            self.assertTrue(get('POST /metrics HTTP/1.1\r\n\r\n').startswith('HTTP/1.0 405'))
+        finally:
+            server.close()
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import unittest
+
+from upstart.notify import NOTIFY_SOCKET, NotifySocket, notify, parse_state
+
+
+class TestNotify(unittest.TestCase):
+
+    def setUp(self):
+        self.notify_socket = NotifySocket()
+        os.environ[NOTIFY_SOCKET] = self.notify_socket.path
+
+    def tearDown(self):
+        os.environ.pop(NOTIFY_SOCKET, None)
+        self.notify_socket.close()
+
+    def test_parse_state(self):
+        self.assertEqual(parse_state('READY=1\nMAINPID=42\ngarbage\nSTATUS=a=b'),
+                         {'READY': '1', 'MAINPID': '42', 'STATUS': 'a=b'})
+
+    def test_ready(self):
+        self.assertTrue(notify('STATUS=loading'))
+        self.assertTrue(notify('READY=1\nMAINPID=%s' % os.getpid(), unset_environment=True))
+        self.assertNotIn(NOTIFY_SOCKET, os.environ)
+        self.assertEqual(self.notify_socket.wait(1),
+                         {'READY': '1', 'MAINPID': str(os.getpid()), 'STATUS': 'loading'})
+
+    def test_timeout(self):
+        notify('STATUS=loading')
+        started = time.time()
+        self.assertEqual(self.notify_socket.wait(0.1), {'STATUS': 'loading'})
+        self.assertTrue(time.time() - started >= 0.1)
+
+    def test_without_socket(self):
+        del os.environ[NOTIFY_SOCKET]
+        self.assertFalse(notify('READY=1'))
+
+    def test_close(self):
+        directory = self.notify_socket.directory
+        self.notify_socket.close()
+        self.assertFalse(os.path.exists(directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import subprocess
+import unittest
+
+from upstart.manager import DaemonConfiguration
+from upstart.placement import CpuPolicy, Placement, get_cores, get_nodes, parse_cpu_list, parse_ioprio
+from upstart.processes import Process
+from upstart.syscalls import sched_getaffinity
+
+
+class TestPlacement(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_cpu_list('0-3, 8,2'), [0, 1, 2, 3, 8])
+        self.assertEqual(parse_cpu_list(5), [5])
+        self.assertEqual(parse_cpu_list([3, 1]), [1, 3])
+        self.assertRaises(ValueError, parse_cpu_list, '')
+        self.assertRaises(ValueError, parse_cpu_list, 'a-b')
+
+        self.assertEqual(parse_ioprio('be/4'), ('be', 4))
+        self.assertEqual(parse_ioprio('idle'), ('idle', 0))
+        self.assertEqual(parse_ioprio(2), ('be', 2))
+        self.assertRaises(ValueError, parse_ioprio, 'rt/9')
+        self.assertRaises(ValueError, parse_ioprio, 'fast')
+
+    def test_config(self):
+        config = {'pid': '/tmp/test.pid', 'run': 'true', 'cpus': '0', 'nice': 5, 'ioprio': 'idle',
+                  'oom_score_adj': 500}
+        placement = DaemonConfiguration.from_config(config).placement
+        self.assertEqual((placement.cpus, placement.nice, placement.ioprio, placement.oom_score_adj),
+                         ([0], 5, ('idle', 0), 500))
+        self.assertEqual(DaemonConfiguration.from_config({'pid': '/tmp/test.pid', 'run': 'true'}).placement, None)
+        config['nice'] = 30
+        self.assertRaises(AttributeError, DaemonConfiguration.from_config, config)
+
+    def test_apply(self):
+        cpus = sched_getaffinity(0)
+        placement = Placement(cpus=cpus[:1], nice=5, ioprio=('idle', 0), oom_score_adj=500)
+        child = subprocess.Popen(['sleep', '10'], preexec_fn=placement.apply)
+        try:
+            self.assertEqual(sched_getaffinity(child.pid), cpus[:1])
+            with open('/proc/%s/stat' % child.pid) as stat_file:
+                _, fields = Process.parse_stat(stat_file.read())
+            # the 19th field of stat, the command is cut off
+            self.assertEqual(int(fields[16]), 5)
+            with open('/proc/%s/oom_score_adj' % child.pid) as oom_file:
+                self.assertEqual(oom_file.read().strip(), '500')
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_cpu_policy(self):
+        policy = CpuPolicy([[0, 1], '2-3'])
+        self.assertEqual([policy.get_cpus(slot) for slot in xrange(3)], [[0, 1], [2, 3], [0, 1]])
+        self.assertEqual(CpuPolicy('0-3').get_cpus(7), [0, 1, 2, 3])
+
+        cpus = sched_getaffinity(0)
+        self.assertEqual(sorted(sum(get_cores(), [])), cpus)
+        self.assertEqual(sorted(sum(get_nodes(), [])), cpus)
+        self.assertEqual(CpuPolicy('core').get_cpus(len(get_cores())), get_cores()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
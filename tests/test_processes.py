@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import os
+import signal
+import subprocess
+import sys
+import time
+import unittest
+
+from upstart.processes import Process, ProcessManager, ProcessNotFound, ProcessPattern, ProcessTable
+
+
+class TestProcess(unittest.TestCase):
+
+    def test_parse_stat(self):
+        name, fields = Process.parse_stat('42 (python) S 1 42 42 0 -1 4194560 0 0 0 0 0 0 0 0 20 0 1 0 100 '
+                                          '12345678 1000\n')
+        self.assertEqual(name, 'python')
+        self.assertEqual(fields[Process.STAT_STATE], 'S')
+        self.assertEqual(fields[Process.STAT_PARENT_PID], '1')
+        self.assertEqual(fields[Process.STAT_VSIZE], '12345678')
+
+    def test_parse_stat_name_with_spaces_and_parentheses(self):
+        name, fields = Process.parse_stat('42 (my (odd) name) R 7 42 42 0 -1 4194560 0 0 0 0 0 0 0 0 20 0 1 0 100 '
+                                          '4096 10\n')
+        self.assertEqual(name, 'my (odd) name')
+        self.assertEqual(fields[Process.STAT_STATE], 'R')
+        self.assertEqual(fields[Process.STAT_PARENT_PID], '7')
+        self.assertEqual(fields[Process.STAT_VSIZE], '4096')
+
+    def test_current_process(self):
+        process = Process(os.getpid())
+        self.assertEqual(process.parent_pid, os.getppid())
+        self.assertTrue('test_processes' in process.cmdline or 'python' in process.cmdline)
+        process.refresh()
+        self.assertEqual(process.parent_pid, os.getppid())
+
+    def test_not_found(self):
+        self.assertRaises(ProcessNotFound, Process, 2 ** 22 + 1)
+
+
+class TestProcessPattern(unittest.TestCase):
+
+    def test_literals(self):
+        pattern = ProcessPattern(r'(.*?)simple.py(\x00)+(.*?)start(\x00)*')
+        self.assertEqual(pattern.literals, ['simple', 'start', 'py'])
+        self.assertFalse(pattern.matches_empty)
+
+    def test_match(self):
+        pattern = ProcessManager.compile(r'(.*?)simple.py(\x00)+(.*?)start(\x00)*')
+        self.assertTrue(pattern is ProcessManager.compile(r'(.*?)simple.py(\x00)+(.*?)start(\x00)*'))
+        self.assertTrue(pattern.match('python\x00/opt/SIMPLE.py\x00start\x00'))
+        self.assertFalse(pattern.match('python\x00/opt/simple.py\x00stop\x00'))
+        self.assertFalse(pattern.match('python\x00/opt/other.py\x00start\x00'))
+
+
+class TestProcessTable(unittest.TestCase):
+
+    def test_tree(self):
+        manager = ProcessManager()
+        table = manager.snapshot()
+        process = manager.get(os.getpid(), table)
+        self.assertTrue(process is not None)
+        self.assertEqual(process.parent.pid, os.getppid())
+        self.assertTrue(process in table.get_children(os.getppid()))
+        self.assertTrue(process.parent in process.ancestors)
+        self.assertTrue(process in table.get_descendants(process.ancestors[-1].pid))
+
+    def test_pids(self):
+        table = ProcessTable([os.getpid(), os.getppid(), 2 ** 22 + 1])
+        self.assertEqual(sorted(process.pid for process in table), sorted([os.getpid(), os.getppid()]))
+
+    def test_children_table(self):
+        child = subprocess.Popen(['sleep', '10'])
+        try:
+            table = ProcessManager().get_children_table(os.getpid())
+            self.assertTrue(child.pid in table)
+            self.assertTrue(os.getpid() not in table)
+        finally:
+            child.kill()
+            child.wait()
+
+
+class TestStop(unittest.TestCase):
+
+    def start_stubborn(self):
+        child = subprocess.Popen([sys.executable, '-c', 'import signal, sys, time; '
+                                  'signal.signal(signal.SIGTERM, signal.SIG_IGN); print "ready"; '
+                                  'sys.stdout.flush(); time.sleep(30)'], stdout=subprocess.PIPE)
+        child.stdout.readline()
+        return child
+
+    def test_escalation(self):
+        obedient = subprocess.Popen(['sleep', '30'])
+        stubborn = self.start_stubborn()
+        started = time.time()
+        results = ProcessManager().stop([obedient.pid, stubborn.pid], 0.5)
+        elapsed = time.time() - started
+        self.assertEqual(results, {obedient.pid: True, stubborn.pid: True})
+        self.assertEqual(obedient.wait(), -signal.SIGTERM)
+        self.assertEqual(stubborn.wait(), -signal.SIGKILL)
+        # the kill signal is sent at the deadline, not a whole timeout later
+        self.assertTrue(0.5 <= elapsed < 0.5 + ProcessManager.KILL_GRACE, elapsed)
+
+    def test_no_wait_for_stopped(self):
+        child = subprocess.Popen(['sleep', '30'])
+        started = time.time()
+        self.assertEqual(ProcessManager().stop([child.pid], 10), {child.pid: True})
+        self.assertTrue(time.time() - started < 1)
+        child.wait()
+
+    def test_force(self):
+        stubborn = self.start_stubborn()
+        self.assertEqual(ProcessManager().stop([stubborn.pid], 10, force=True), {stubborn.pid: True})
+        self.assertEqual(stubborn.wait(), -signal.SIGKILL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from upstart.manager import DaemonConfiguration
+from upstart.ratelimit import TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket.updated
+        self.assertTrue(all(bucket.acquire(now) for _ in xrange(3)))
+        self.assertFalse(bucket.acquire(now))
+        self.assertAlmostEqual(bucket.get_next_time(now), now + 0.5)
+        self.assertTrue(bucket.acquire(now + 0.5))
+        self.assertFalse(bucket.acquire(now + 0.6))
+        # no more than burst is saved up
+        self.assertTrue(all(bucket.acquire(now + 100) for _ in xrange(3)))
+        self.assertFalse(bucket.acquire(now + 100))
+
+
+class TestRespawnPolicy(unittest.TestCase):
+
+    def get_daemon(self, **respawn):
+        return DaemonConfiguration.from_config({'pid': '/tmp/test.pid', 'run': 'true', 'respawn': respawn})
+
+    def test_backoff(self):
+        daemon = self.get_daemon(limit=10, interval=2, max_interval=20, jitter=0)
+        delays = []
+        for crash_number in xrange(1, 7):
+            daemon.crash_number = crash_number
+            delays.append(daemon.get_respawn_delay())
+        self.assertEqual(delays, [2, 4, 8, 16, 20, 20])
+
+        daemon.respawn_jitter = 0.5
+        daemon.crash_number = 3
+        for _ in xrange(100):
+            self.assertTrue(4 <= daemon.get_respawn_delay() <= 8)
+
+    def test_config(self):
+        daemon = self.get_daemon(limit=3, healthy=30)
+        self.assertEqual((daemon.respawn_limit, daemon.respawn_healthy), (3, 30))
+        self.assertFalse(daemon.failed)
+        self.assertRaises(AttributeError, self.get_daemon, limit=3, jitter=2)
+        self.assertRaises(AttributeError, self.get_daemon, limit=3, max_interval='long')
+
+    def test_pid_keeps_crashes(self):
+        daemon = self.get_daemon(limit=3)
+        daemon.crash_number = 2
+        daemon.pid
+        self.assertEqual(daemon.crash_number, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
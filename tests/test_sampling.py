@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import unittest
+
+from upstart.processes import ProcessNotFound
+from upstart.sampling import ProcessFiles, ResourceSampler, RingBuffer, format_size
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_wrap(self):
+        buffer = RingBuffer(('time', 'value'), 3)
+        self.assertEqual(len(buffer), 0)
+        for i in xrange(5):
+            buffer.append({'time': i, 'value': i * 10})
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.get('value'), 40)
+        self.assertEqual(buffer.get('value', 2), 20)
+        self.assertEqual(buffer.values('time'), [2, 3, 4])
+        self.assertRaises(IndexError, buffer.get, 'value', 3)
+
+
+class TestSampling(unittest.TestCase):
+
+    def test_process_files(self):
+        files = ProcessFiles(os.getpid())
+        try:
+            cpu, rss, read_bytes, write_bytes, fds = files.sample()
+            self.assertTrue(rss > 0)
+            self.assertTrue(fds > 0)
+            # the same fds are read again
+            self.assertEqual(len(files.sample()), 5)
+        finally:
+            files.close()
+
+    def test_process_gone(self):
+        child = subprocess.Popen(['sleep', '10'])
+        files = ProcessFiles(child.pid)
+        try:
+            child.kill()
+            child.wait()
+            self.assertRaises(ProcessNotFound, files.sample)
+        finally:
+            files.close()
+        self.assertRaises(ProcessNotFound, ProcessFiles, child.pid)
+
+    def test_sampler(self):
+        child = subprocess.Popen(['sleep', '10'])
+        try:
+            sampler = ResourceSampler(size=10)
+            sampler.sample({'self': (os.getpid(), None)})
+            sum(xrange(1000000))
+            sampler.sample({'self': (os.getpid(), None)})
+            stats = sampler.get_stats('self')
+            self.assertEqual(stats['processes'], 2)
+            self.assertTrue(stats['rss'] > 0)
+            self.assertTrue(stats['cpu_percent'] >= 0)
+            self.assertEqual(len(sampler.files), 2)
+
+            sampler.sample({})
+            self.assertEqual(sampler.files, {})
+            sampler.forget('self')
+            self.assertEqual(sampler.get_stats('self'), None)
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_format_size(self):
+        self.assertEqual(format_size(512), '512B')
+        self.assertEqual(format_size(1536), '1.5K')
+        self.assertEqual(format_size(-3 * 1024 * 1024), '-3.0M')
+        self.assertEqual(format_size(5 * 1024 ** 4), '5120.0G')
+
+
+if __name__ == '__main__':
+    unittest.main()
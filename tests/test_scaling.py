@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from upstart.scaling import ScalingPolicy, get_memory_pressure
+
+
+class TestScalingPolicy(unittest.TestCase):
+
+    def test_busy(self):
+        policy = ScalingPolicy(target_busy=0.5, up_cooldown=10, down_cooldown=60)
+        self.assertEqual(policy.decide({'busy': 0.9}, 2, 1, 10, now=100), 4)
+        # up waits for up_cooldown, down for down_cooldown
+        self.assertEqual(policy.decide({'busy': 1.0}, 4, 1, 10, now=105), 4)
+        self.assertEqual(policy.decide({'busy': 1.0}, 4, 1, 10, now=110), 8)
+        self.assertEqual(policy.decide({'busy': 0.1}, 8, 1, 10, now=130), 8)
+        self.assertEqual(policy.decide({'busy': 0.1}, 8, 1, 10, now=170), 2)
+        # bounds
+        self.assertEqual(policy.decide({'busy': 0.0}, 2, 1, 10, now=300), 1)
+        self.assertEqual(policy.decide({'busy': None}, 12, 1, 10, now=301), 10)
+
+    def test_queue(self):
+        policy = ScalingPolicy(queue_per_worker=10)
+        self.assertEqual(policy.decide({'busy': None, 'queue': 45}, 2, 1, 10), 5)
+
+    def test_overloaded(self):
+        policy = ScalingPolicy(max_load=2, max_memory_pressure=10)
+        self.assertEqual(policy.decide({'busy': 1.0, 'load': 3.0}, 2, 1, 10), 2)
+        self.assertEqual(policy.decide({'busy': 1.0, 'memory_pressure': 20.0}, 2, 1, 10), 2)
+        # the minimum is kept anyway
+        self.assertEqual(policy.decide({'busy': 1.0, 'load': 3.0}, 0, 1, 10), 1)
+
+    def test_memory_pressure(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'memory')
+            with open(path, 'w') as pressure_file:
+                pressure_file.write('some avg10=1.50 avg60=0.20 avg300=0.00 total=100\n'
+                                    'full avg10=0.50 avg60=0.00 avg300=0.00 total=10\n')
+            self.assertEqual(get_memory_pressure(path), 1.5)
+            self.assertEqual(get_memory_pressure(os.path.join(directory, 'missing')), None)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import sys
+import unittest
+
+from upstart.manager import DaemonConfiguration
+from upstart.sockets import LISTEN_FDS, LISTEN_PID, listen_sockets, parse_address
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# answers one connection with the name of its socket
+SERVER = ('import sys; sys.path.insert(0, %r); from upstart.sockets import listen_sockets; '
+          '[(name, sock)] = listen_sockets(); connection, _ = sock.accept(); connection.sendall(name)' % ROOT)
+
+
+class TestSockets(unittest.TestCase):
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('unix:/run/web.sock'), (socket.AF_UNIX, '/run/web.sock'))
+        self.assertEqual(parse_address('@web'), (socket.AF_UNIX, '\0web'))
+        self.assertEqual(parse_address('127.0.0.1:80'), (socket.AF_INET, ('127.0.0.1', 80)))
+        self.assertEqual(parse_address(':8080'), (socket.AF_INET, ('0.0.0.0', 8080)))
+        self.assertEqual(parse_address('[::1]:80'), (socket.AF_INET6, ('::1', 80)))
+        self.assertRaises(ValueError, parse_address, 'localhost')
+        self.assertRaises(ValueError, parse_address, 'localhost:http')
+
+    def test_config(self):
+        config = {'pid': '/tmp/test.pid', 'run': 'true', 'listen': {'web': ':8080', 'admin': 'unix:/tmp/admin'}}
+        self.assertEqual(DaemonConfiguration.from_config(config).listen,
+                         [('admin', 'unix:/tmp/admin'), ('web', ':8080')])
+        config['listen'] = ':8080'
+        self.assertEqual(DaemonConfiguration.from_config(config).listen, [('unknown', ':8080')])
+        config['listen'] = ['8080']
+        self.assertRaises(AttributeError, DaemonConfiguration.from_config, config)
+
+    def test_other_pid(self):
+        os.environ.update({LISTEN_PID: str(os.getpid() + 1), LISTEN_FDS: '1'})
+        try:
+            self.assertEqual(listen_sockets(unset_environment=True), [])
+            self.assertFalse(LISTEN_FDS in os.environ)
+        finally:
+            os.environ.pop(LISTEN_PID, None)
+            os.environ.pop(LISTEN_FDS, None)
+
+    def test_activation(self):
+        run = '%s -c "%s"' % (sys.executable, SERVER)
+        daemon = DaemonConfiguration.from_config({'pid': '/tmp/test.pid', 'run': run,
+                                                  'listen': {'web': '127.0.0.1:0'}})
+        try:
+            address = daemon.get_sockets()[0].getsockname()
+            for _ in xrange(2):
+                # accepted by the kernel before the daemon is started
+                client = socket.create_connection(address, timeout=10)
+                pid, _ = daemon.call(daemon.run_script, sockets=daemon.get_sockets())
+                self.assertEqual(client.recv(16), 'web')
+                client.close()
+                os.waitpid(pid, 0)
+        finally:
+            daemon.close_sockets()
+
+
+if __name__ == '__main__':
+    unittest.main()
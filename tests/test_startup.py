@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from upstart.manager import ConfigStore, Manager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules daemon-tools needs only for some commands
+HEAVY_MODULES = ('yaml', 'inspect', 'subprocess', 'multiprocessing', 'upstart.manager', 'upstart.daemon')
+# modules only DaemonMaster, daemon-runtime and started daemons need
+MASTER_MODULES = ('upstart.cgroups', 'upstart.heartbeat', 'upstart.logchannel', 'upstart.logs', 'upstart.metrics',
+                  'upstart.notify', 'upstart.placement', 'upstart.scaling', 'upstart.sockets', 'gzip', 'mmap')
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.conf_path = tempfile.mkdtemp()
+        os.mkdir(self.conf_path + '/conf-enabled')
+        for name in ('first', 'second', 'third'):
+            with open(self.conf_path + '/conf-enabled/' + name, 'w') as config_file:
+                config_file.write('pid: %s/%s.pid\nrun: /bin/sleep 1000\n' % (self.conf_path, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.conf_path)
+
+    def get_imported(self, module, modules):
+        code = 'import sys, %s; print " ".join(m for m in %r if m in sys.modules)' % (module, modules)
+        process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE)
+        output, _ = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        return output.split()
+
+    def test_import_cli(self):
+        self.assertEqual(self.get_imported('upstart.cli', HEAVY_MODULES + MASTER_MODULES), [])
+
+    def test_import_manager(self):
+        # daemon-tools loads the manager for --direct, without daemon-runtime and for logs
+        modules = MASTER_MODULES + ('multiprocessing', 'subprocess', 'upstart.daemon')
+        self.assertEqual(self.get_imported('upstart.cli, upstart.manager', modules), [])
+
+    def test_load_named_daemons(self):
+        manager = Manager(self.conf_path, store=ConfigStore(), names=['second', 'missing', '../second'])
+        self.assertEqual(manager.daemons.keys(), ['second'])
+
+    def test_load_named_daemons_keeps_cache(self):
+        store = ConfigStore()
+        Manager(self.conf_path, store=store)
+        Manager(self.conf_path, store=store, names=['first'])
+        self.assertEqual(len(store.entries), 3)
+
+    def test_reload_configs(self):
+        manager = Manager(self.conf_path, store=ConfigStore())
+        first, second = manager.daemons['first'], manager.daemons['second']
+        first.crash_number = second.crash_number = 2
+        second.failed = True
+        for name in ('first', 'second', 'fourth'):
+            with open(self.conf_path + '/conf-enabled/' + name, 'w') as config_file:
+                # longer than the old config, in case mtime is coarse
+                config_file.write('pid: %s/%s.pid\nrun: /bin/sleep 20000\n' % (self.conf_path, name))
+        os.remove(self.conf_path + '/conf-enabled/third')
+
+        added, removed, changed = manager.reload_configs()
+        self.assertEqual((added, removed, changed), (set(['fourth']), set(['third']), set(['first', 'second'])))
+        self.assertEqual(sorted(manager.daemons), ['first', 'fourth', 'second'])
+        self.assertEqual(manager.daemons['first'].run_script, '/bin/sleep 20000')
+        # a crashing daemon keeps its count, a failed one gets another chance
+        self.assertEqual(manager.daemons['first'].crash_number, 2)
+        self.assertEqual(manager.daemons['second'].crash_number, 0)
+
+        os.remove(self.conf_path + '/conf-enabled/fourth')
+        fourth = manager.daemons['fourth']
+        self.assertEqual(manager.reload_configs(), (set(), set(['fourth']), set()))
+        with open(self.conf_path + '/conf-enabled/fourth', 'w') as config_file:
+            config_file.write('pid: %s/fourth.pid\nrun: /bin/sleep 20000\n' % (self.conf_path,))
+        self.assertEqual(manager.reload_configs(), (set(['fourth']), set(), set()))
+        self.assertFalse(manager.daemons['fourth'] is fourth)
+        # unchanged daemons keep their objects
+        unchanged = manager.daemons['second']
+        self.assertEqual(manager.reload_configs(), (set(), set(), set()))
+        self.assertTrue(manager.daemons['second'] is unchanged)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import threading
+import time
+import unittest
+
+from upstart.manager import DaemonConfiguration, DaemonConfigurationError
+from upstart.syscalls import reap_children
+from upstart.watcher import ProcessWatcher
+
+
+def spawn(seconds):
+    pid = os.fork()
+    if pid == 0:
+        time.sleep(seconds)
+        os._exit(0)
+    return pid
+
+
+class TestProcessWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.watcher = ProcessWatcher(poll_interval=0.1)
+
+    def tearDown(self):
+        self.watcher.unwatch_all()
+        self.watcher.epoll.close()
+
+    def assertReaped(self, pid):
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except OSError, err:
+            self.assertEqual(err.errno, errno.ECHILD)
+        else:
+            self.fail('process %s is not reaped' % pid)
+
+    def wait_exit(self, timeout):
+        exited = []
+        deadline = time.time() + timeout
+        while not exited and time.time() < deadline:
+            exited = self.watcher.poll(deadline - time.time())
+        return exited
+
+    def test_pidfd(self):
+        pid = spawn(0.2)
+        self.watcher.watch('first', pid)
+        self.assertTrue(self.watcher.pidfd_supported)
+        self.assertEqual(self.watcher.polled, {})
+        # no process is polled, so nothing but the exit ends the wait
+        self.assertEqual(self.watcher.poll(0.05), [])
+        started = time.time()
+        self.assertEqual(self.watcher.poll(5), ['first'])
+        self.assertTrue(time.time() - started < 1)
+        self.assertReaped(pid)
+        self.assertEqual(self.watcher.watched, {})
+        self.assertEqual(self.watcher.pidfds, {})
+
+    def test_polling(self):
+        # a kernel without pidfd_open
+        self.watcher.pidfd_supported = False
+        pid = spawn(0.2)
+        self.watcher.watch('first', pid)
+        self.assertEqual(self.watcher.polled, {'first': pid})
+        self.assertEqual(self.watcher.pidfds, {})
+        self.assertEqual(self.wait_exit(5), ['first'])
+        self.assertReaped(pid)
+        self.assertEqual(self.watcher.polled, {})
+
+    def test_exited_before_watch(self):
+        pid = spawn(0)
+        os.waitpid(pid, 0)
+        self.watcher.watch('first', pid)
+        self.assertEqual(self.watcher.watched, {})
+
+    def test_unwatch(self):
+        pid = spawn(0.2)
+        self.watcher.watch('first', pid)
+        self.watcher.unwatch('first')
+        self.assertEqual(self.watcher.pidfds, {})
+        self.assertEqual(self.wait_exit(0.5), [])
+        os.waitpid(pid, 0)
+
+    def test_reader(self):
+        read_fd, write_fd = os.pipe()
+        ready = []
+        self.watcher.add_reader(read_fd, lambda fd: ready.append(os.read(fd, 10)))
+        os.write(write_fd, 'x')
+        self.assertEqual(self.watcher.poll(1), [])
+        self.assertEqual(ready, ['x'])
+        self.watcher.remove_reader(read_fd)
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+class TestReapChildren(unittest.TestCase):
+
+    def test_orphans(self):
+        pids = set(spawn(0) for _ in xrange(3))
+        deadline = time.time() + 5
+        reaped = set()
+        while reaped != pids and time.time() < deadline:
+            reaped.update(reap_children())
+            time.sleep(0.01)
+        self.assertEqual(reaped, pids)
+
+    def test_waited_script(self):
+        # the loop of daemon-runtime reaps while requests run scripts
+        stopped = threading.Event()
+
+        def reap():
+            while not stopped.is_set():
+                reap_children()
+
+        thread = threading.Thread(target=reap)
+        thread.start()
+        try:
+            daemon = DaemonConfiguration.from_config({'pid': '/tmp/test.pid', 'run': 'true'})
+            daemon.log_path = None
+            for _ in xrange(20):
+                self.assertRaises(DaemonConfigurationError, daemon.call, '/bin/sh -c "exit 3"', block=True)
+        finally:
+            stopped.set()
+            thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
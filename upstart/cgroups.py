@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import os
+import pwd
+import signal
+import time
+
+
+log = logging.getLogger(__name__)
+
+_mount = []
+
+
+def get_mount():
+    """
+    Returns the mount point of the cgroup v2 hierarchy or None.
+    """
+    if not _mount:
+        mount_point = None
+        try:
+            with open('/proc/self/mounts') as mounts_file:
+                for line in mounts_file:
+                    fields = line.split()
+                    if len(fields) > 2 and fields[2] == 'cgroup2':
+                        mount_point = fields[1]
+                        break
+        except IOError:
+            pass
+        _mount.append(mount_point)
+    return _mount[0]
+
+
+def get_root(name):
+    """
+    Returns the cgroup of daemon-manager, name is relative to the cgroup v2
+    mount. None if cgroup v2 is not available or name is empty.
+    """
+    mount_point = get_mount()
+    if not name or mount_point is None:
+        return None
+    return Cgroup(os.path.join(mount_point, name.strip('/')))
+
+
+class Cgroup(object):
+    """
+    A cgroup v2 directory. Processes join it by cgroup.procs, their children
+    stay in it whatever they do, and cgroup.kill kills the whole subtree.
+    """
+    # files a delegated user needs to manage the subtree
+    DELEGATED_FILES = ('cgroup.procs', 'cgroup.threads', 'cgroup.subtree_control')
+
+    KILL_DELAY_MIN = 0.01
+    KILL_DELAY_MAX = 0.5
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def current(cls, pid='self'):
+        """
+        Returns the cgroup v2 of the process or None.
+        """
+        mount_point = get_mount()
+        if mount_point is None:
+            return None
+        try:
+            with open('/proc/%s/cgroup' % pid) as cgroup_file:
+                for line in cgroup_file:
+                    if line.startswith('0::'):
+                        return cls(os.path.join(mount_point, line[3:].strip().lstrip('/')))
+        except IOError:
+            pass
+        return None
+
+    def child(self, name):
+        return Cgroup(os.path.join(self.path, name))
+
+    def exists(self):
+        return os.path.exists(self.path + '/cgroup.procs')
+
+    def create(self, user=None):
+        """
+        Creates the cgroup and delegates it to user. Returns False if it
+        can't be created.
+        """
+        try:
+            try:
+                os.makedirs(self.path)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+            if user:
+                pw_record = pwd.getpwnam(user)
+                os.chown(self.path, pw_record.pw_uid, pw_record.pw_gid)
+                for name in self.DELEGATED_FILES:
+                    os.chown(self.path + '/' + name, pw_record.pw_uid, pw_record.pw_gid)
+        except (OSError, KeyError), e:
+            log.debug('cgroup %s is not created: %s', self.path, e)
+            return False
+        return True
+
+    def add(self, pid=0):
+        """
+        Moves the process (the calling one if pid is 0) into the cgroup.
+        """
+        with open(self.path + '/cgroup.procs', 'w') as procs_file:
+            procs_file.write(str(pid))
+
+    def get_pids(self):
+        """
+        Returns pids of the cgroup and its descendants or None if the
+        cgroup doesn't exist.
+        """
+        pids = []
+        found = False
+        for path, _, _ in os.walk(self.path):
+            try:
+                with open(path + '/cgroup.procs') as procs_file:
+                    pids.extend(int(pid) for pid in procs_file.read().split())
+            except IOError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            found = True
+        return pids if found else None
+
+    def is_populated(self):
+        try:
+            with open(self.path + '/cgroup.events') as events_file:
+                for line in events_file:
+                    key, _, value = line.partition(' ')
+                    if key == 'populated':
+                        return value.strip() == '1'
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        return bool(self.get_pids())
+
+    def kill(self, timeout=5):
+        """
+        Kills every process of the subtree and waits until it's empty.
+        Returns True if it is. Without cgroup.kill (Linux < 5.14) processes
+        are killed one by one until none is left.
+        """
+        deadline = time.time() + timeout
+        delay = self.KILL_DELAY_MIN
+        killed = False
+        while self.is_populated():
+            if not killed:
+                try:
+                    with open(self.path + '/cgroup.kill', 'w') as kill_file:
+                        kill_file.write('1')
+                    killed = True
+                except IOError, err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    for pid in self.get_pids() or []:
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except OSError, err:
+                            if err.errno != errno.ESRCH:
+                                raise
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.KILL_DELAY_MAX)
+        return True
+
+    def remove(self):
+        """
+        Removes the cgroup with its children, if they are empty.
+        """
+        for path, _, _ in os.walk(self.path, topdown=False):
+            try:
+                os.rmdir(path)
+            except OSError, err:
+                if err.errno not in (errno.ENOENT, errno.EBUSY, errno.ENOTEMPTY):
+                    raise
+
+    def __repr__(self):
+        return 'Cgroup(%r)' % self.path
@@ -1,44 +1,158 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 import optparse
+import os
 import sys
-from .manager import Manager
+
+from .control import ControlClient, ThreadOutput, output_from_json
 from .settings import SETTINGS_TOOLS, SETTINGS_MANAGER
 
 log = logging.getLogger('')
-handler = logging.FileHandler(SETTINGS_TOOLS['log']['dir'] + SETTINGS_TOOLS['log']['filename'])
 
-handler.setFormatter(logging.Formatter('%(asctime)s %(process)d/%(thread)d %(levelname)s %(message)s'))
-handler.setLevel(SETTINGS_TOOLS['log']['level'])
-log.addHandler(handler)
-logging.root.setLevel(SETTINGS_TOOLS['log']['level'])
+
+def setup_logging():
+    # the file is opened by the first record, most commands don't log at all
+    handler = logging.FileHandler(SETTINGS_TOOLS['log']['dir'] + SETTINGS_TOOLS['log']['filename'], delay=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(process)d/%(thread)d %(levelname)s %(message)s'))
+    handler.setLevel(SETTINGS_TOOLS['log']['level'])
+    log.addHandler(handler)
+    logging.root.setLevel(SETTINGS_TOOLS['log']['level'])
 
 
 class CLI(object):
-    def __init__(self):
-        self.manager = Manager(SETTINGS_MANAGER.get('configs'))
+    COMMANDS = ('start', 'stop', 'restart', 'reload', 'list', 'status', 'top')
+
+    def __init__(self, manager=None):
+        self._manager = manager
+        # daemons to load configs of, all of them if None
+        self.names = None
+        self.client = ControlClient(SETTINGS_MANAGER['socket'])
         self.optparser = optparse.OptionParser()
-        self.optparser.set_usage("Usage: daemon-tools (start|stop|restart|reload|list|status) [name]")
+        self.optparser.set_usage(
+            "Usage: daemon-tools (start|stop|restart|reload|list|status|top|logs) [name] [options]")
+        self.optparser.add_option('-j', '--jobs', dest='jobs', type='int', default=SETTINGS_TOOLS['jobs'],
+                                  help='number of daemons handled in parallel by start/stop/restart all')
+        self.optparser.add_option('--direct', action='store_true', dest='direct', default=False,
+                                  help="don't ask daemon-runtime, manage daemons from this process")
+        self.optparser.add_option('--json', action='store_true', dest='json', default=False,
+                                  help='print the response of daemon-runtime as JSON')
+        self.optparser.add_option('-v', '--verbose', action='store_true', dest='verbose', default=False,
+                                  help='status: show resources used by daemons')
+        self.optparser.add_option('-n', '--lines', dest='lines', type='int', default=None,
+                                  help='logs: number of last lines to show, 10 without --since and --until')
+        self.optparser.add_option('-f', '--follow', action='store_true', dest='follow', default=False,
+                                  help='logs: keep showing lines as they are written')
+        self.optparser.add_option('--since', dest='since', default=None,
+                                  help='logs: show lines from this time, "10m", "2h" ago or "YYYY-MM-DD HH:MM:SS"')
+        self.optparser.add_option('--until', dest='until', default=None,
+                                  help='logs: show lines up to this time')
+        self.jobs = SETTINGS_TOOLS['jobs']
+        self.verbose = False
+
+    @property
+    def manager(self):
+        if self._manager is None:
+            from .manager import Manager
+            self._manager = Manager(SETTINGS_MANAGER.get('configs'), names=self.names)
+        return self._manager
+
+    def get_error(self, command, name):
+        """
+        Returns the message of an invalid command line or None.
+        """
+        if command not in self.COMMANDS:
+            return 'command %s is not found' % command
+        if command in ('list', 'status', 'top'):
+            if name and name != 'all' and name not in self.manager.daemons:
+                return 'name %s is not found' % name
+        elif not name:
+            return 'name must be specified'
+        elif name not in self.manager.daemons and (name != 'all' or command == 'reload'):
+            return 'name %s is not found' % name
+        return None
+
+    def run_all(self, action):
+        """
+        Calls action for every daemon in a pool of self.jobs threads and
+        prints the output of every daemon in the order of their names.
+        Returns the exit code: 1 if any of the calls has failed.
+        """
+        daemon_names = sorted(self.manager.daemons.iterkeys())
+        if not daemon_names:
+            return 0
 
-    def list(self):
-        if not self.manager.daemons:
+        from multiprocessing.pool import ThreadPool
+
+        output, installed = ThreadOutput.install()
+
+        def call(daemon_name):
+            output.capture()
+            try:
+                result = action(daemon_name)
+            except Exception, e:
+                log.exception('%s failed', daemon_name)
+                print 'failed (%s)' % e
+                result = False
+            return result, output.release()
+
+        pool = ThreadPool(max(1, min(self.jobs, len(daemon_names))))
+        failed = 0
+        try:
+            for result, text in pool.imap(call, daemon_names):
+                if text and not text.endswith('\n'):
+                    text += '\n'
+                # goes to the capture of the calling thread if it has one
+                output.write(text)
+                output.flush()
+                if not result:
+                    failed += 1
+        finally:
+            pool.close()
+            pool.join()
+            if installed:
+                output.uninstall()
+        return 1 if failed else 0
+
+    def list(self, daemons=None):
+        if daemons is None:
+            daemons = self.manager.daemons
+        if not daemons:
             print 'No enabled daemons'
         else:
             print 'Following daemons are enabled:'
-            for daemon_name in self.manager.daemons.iterkeys():
+            for daemon_name in daemons.iterkeys():
                 print ' * ' + daemon_name
 
+    def _start(self, daemon_name):
+        print ' * starting %s ...' % daemon_name,
+        try:
+            pid = self.manager.start(daemon_name)
+        except Exception, e:
+            log.exception('%s is not started', daemon_name)
+            print 'not started (%s)' % e
+            return False
+        if pid:
+            print 'started (%s)' % pid
+        return True
+
+    def _stop(self, daemon_name):
+        print ' * stopping %s ...' % daemon_name,
+        # the daemon prints which of its processes can't be stopped
+        return bool(self.manager.stop(daemon_name))
+
+    def _restart(self, daemon_name):
+        print ' * restarting %s ...' % daemon_name,
+        pid = self.manager.restart(daemon_name)
+        if not pid:
+            print 'not restarted'
+            return False
+        print 'restarted (%s)' % pid
+        return True
+
     def start(self, name):
         if name == 'all':
-            for daemon_name in self.manager.daemons.iterkeys():
-                print ' * starting %s ...' % daemon_name,
-                try:
-                    pid = self.manager.start(daemon_name)
-                    if pid:
-                        print 'started (%s)' % pid
-                except Exception:
-                    print 'not started'
-                    sys.exit(1)
+            return self.run_all(self._start)
         elif name in self.manager.daemons:
             print 'starting %s ...' % name,
             pid = self.manager.start(name)
@@ -50,12 +164,11 @@ class CLI(object):
 
     def stop(self, name):
         if name == 'all':
-            for daemon_name in self.manager.daemons.iterkeys():
-                print ' * stopping %s ...' % daemon_name,
-                self.manager.stop(daemon_name)
+            return self.run_all(self._stop)
         elif name in self.manager.daemons:
             print 'stopping %s ...' % name,
-            self.manager.stop(name)
+            if not self.manager.stop(name):
+                return 1
         elif name:
             self.optparser.error('name %s is not found' % name)
         else:
@@ -63,13 +176,13 @@ class CLI(object):
 
     def restart(self, name):
         if name == 'all':
-            for daemon_name in self.manager.daemons.iterkeys():
-                print ' * restarting %s ...' % daemon_name,
-                pid = self.manager.restart(daemon_name)
-                print 'restarted (%s)' % pid
+            return self.run_all(self._restart)
         elif name in self.manager.daemons:
             print 'restarting %s ...' % name,
             pid = self.manager.restart(name)
+            if not pid:
+                print 'not restarted'
+                return 1
             print 'restarted (%s)' % pid
         elif name:
             self.optparser.error('name %s is not found' % name)
@@ -96,32 +209,152 @@ class CLI(object):
         else:
             self.optparser.error('name must be specified')
 
+    def _get_log_sources(self, name):
+        """
+        Returns (daemon name, path) of logs of daemons: output captured by
+        daemon-runtime and files from the logs key of their configs.
+        """
+        from .logs import get_log_path, get_segments
+
+        if name == 'all':
+            names = set()
+            log_dir = SETTINGS_MANAGER['logs']['dir']
+            if os.path.isdir(log_dir):
+                names.update(file_name[:-4] for file_name in os.listdir(log_dir) if file_name.endswith('.log'))
+        else:
+            names = set(name.split(','))
+            self.names = list(names)
+        try:
+            daemons = self.manager.daemons
+        except (IOError, OSError):
+            daemons = {}
+        if name == 'all':
+            names.update(daemons)
+
+        sources = []
+        for daemon_name in sorted(names):
+            if '/' in daemon_name:
+                self.optparser.error('name %s is not found' % daemon_name)
+            paths = [get_log_path(daemon_name)]
+            if daemon_name in daemons:
+                paths.extend(daemons[daemon_name].log_files)
+            sources.extend((daemon_name, path) for path in paths if get_segments(path))
+        return sources
+
+    def logs(self, name, lines=None, follow=False, since=None, until=None):
+        """
+        Prints logs of daemons read straight from the files: the last lines,
+        lines from since to until of one or more daemons ("all" or "a,b") in
+        the order of time, or new lines as they are written with follow.
+        """
+        from .logs import follow as follow_log, merge_logs, merge_tails, parse_time, read_log, tail
+
+        if not name:
+            self.optparser.error('name must be specified')
+        if not SETTINGS_MANAGER['logs']['dir']:
+            self.optparser.error("logs of daemons aren't written")
+        try:
+            since = parse_time(since) if since else None
+            until = parse_time(until) if until else None
+        except ValueError, e:
+            self.optparser.error(str(e))
+
+        sources = self._get_log_sources(name)
+        if not sources:
+            self.optparser.error('%s has no logs' % name)
+        if follow and len(sources) > 1:
+            self.optparser.error('only one log is followed, %s has %s' % (name, len(sources)))
+
+        write = sys.stdout.write
+        if len(sources) == 1:
+            path = sources[0][1]
+            if since is None and until is None:
+                write(''.join(tail(path, 10 if lines is None else lines)))
+            else:
+                for chunk in read_log(path, since, until):
+                    write(chunk)
+        else:
+            width = max(len(daemon_name) for daemon_name, _ in sources)
+            paths = [path for _, path in sources]
+            if since is None and until is None:
+                records = merge_tails(paths, 10 if lines is None else lines)
+            else:
+                records = merge_logs(paths, since, until)
+            for _, number, line in records:
+                write('%s %s' % (sources[number][0].ljust(width), line))
+
+        if follow:
+            sys.stdout.flush()
+
+            def write_now(data):
+                sys.stdout.write(data)
+                sys.stdout.flush()
+
+            try:
+                follow_log(sources[0][1], write_now)
+            except KeyboardInterrupt:
+                pass
+        return 0
+
+    def request(self, command, name, print_json=False):
+        """
+        Passes the command to daemon-runtime. Returns the exit code or None
+        if daemon-runtime is not running.
+        """
+        response = self.client.request(command, name, jobs=self.jobs, verbose=self.verbose)
+        if response is None:
+            return None
+
+        if print_json:
+            print json.dumps(response, indent=2, sort_keys=True)
+        elif response.get('error'):
+            self.optparser.error(output_from_json(response['error']))
+        else:
+            sys.stdout.write(output_from_json(response.get('output', '')))
+        return response.get('code', 0)
+
     def execute(self):
+        setup_logging()
         if len(sys.argv) < 2:
             self.optparser.print_usage()
             sys.exit(1)
 
         command = sys.argv.pop(1)
-        try:
+        if len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
             name = sys.argv.pop(1)
-        except IndexError:
+        else:
             name = None
 
         options, _ = self.optparser.parse_args()
+        self.jobs = options.jobs
+        self.verbose = options.verbose
+
+        if command == 'logs':
+            return self.logs(name, options.lines, options.follow, options.since, options.until)
+
+        if command in self.COMMANDS and not options.direct:
+            code = self.request(command, name, options.json)
+            if code is not None:
+                return code
+
+        if name and name != 'all':
+            self.names = [name]
 
         if command=='start':
-            self.start(name)
+            return self.start(name)
         elif command=='stop':
-            self.stop(name)
+            return self.stop(name)
         elif command=='status':
             self.status(name)
         elif command=='restart':
-            self.restart(name)
+            return self.restart(name)
         elif command=='reload':
             self.reload(name)
         elif command=='list':
             self.list()
+        elif command=='top':
+            self.optparser.error('resources are sampled by daemon-runtime, which is not running')
         elif command=='help':
             self.optparser.print_help()
         else:
-            self.optparser.error('command %s is not found' % name)
+            self.optparser.error('command %s is not found' % command)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import errno
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+from cStringIO import StringIO
+
+
+log = logging.getLogger(__name__)
+
+
+class ControlError(Exception):
+    pass
+
+
+class ThreadOutput(object):
+    """
+    sys.stdout replacement which collects output of every capturing thread
+    separately, so daemons handled in parallel don't mix their messages.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    @staticmethod
+    def install():
+        """
+        Returns (output, installed): the ThreadOutput which is sys.stdout
+        now and whether it has been installed by this call.
+        """
+        if isinstance(sys.stdout, ThreadOutput):
+            return sys.stdout, False
+        sys.stdout = ThreadOutput(sys.stdout)
+        return sys.stdout, True
+
+    def uninstall(self):
+        if sys.stdout is self:
+            sys.stdout = self.stream
+
+    def capture(self):
+        """
+        Starts collecting output of the current thread. Captures can be
+        nested, release() returns the output of the innermost one.
+        """
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = []
+        self.local.buffers.append([StringIO(), 0])
+
+    def release(self):
+        buffer, _ = self.local.buffers.pop()
+        return buffer.getvalue()
+
+    def _get_buffer(self):
+        buffers = getattr(self.local, 'buffers', None)
+        return buffers[-1] if buffers else None
+
+    def write(self, data):
+        buffer = self._get_buffer()
+        (buffer[0] if buffer else self.stream).write(data)
+
+    def flush(self):
+        buffer = self._get_buffer()
+        (buffer[0] if buffer else self.stream).flush()
+
+    # "print x," keeps its state in the file object, keep it per capture
+    def _get_softspace(self):
+        buffer = self._get_buffer()
+        if buffer:
+            return buffer[1]
+        return getattr(self.stream, 'softspace', 0)
+
+    def _set_softspace(self, value):
+        buffer = self._get_buffer()
+        if buffer:
+            buffer[1] = value
+        else:
+            self.stream.softspace = value
+
+    softspace = property(_get_softspace, _set_softspace)
+
+
+class ControlServer(object):
+    """
+    Local control socket of daemon-runtime. Every connection carries one
+    JSON request line and gets one JSON response line back. Requests are
+    served in their own threads, so a long stop does not block the
+    supervision loop.
+    """
+    MAX_REQUEST_SIZE = 65536
+
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        self.socket = None
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.socket.listen(16)
+        self.socket.setblocking(False)
+        return self.socket.fileno()
+
+    def accept(self, fd=None):
+        try:
+            connection, _ = self.socket.accept()
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        thread = threading.Thread(target=self.serve, args=(connection,))
+        thread.daemon = True
+        thread.start()
+
+    def serve(self, connection):
+        try:
+            connection.setblocking(True)
+            request_file = connection.makefile('rb')
+            try:
+                request = json.loads(request_file.readline(self.MAX_REQUEST_SIZE))
+            finally:
+                request_file.close()
+
+            try:
+                response = self.handler(request)
+            except Exception, e:
+                log.exception('control request %s failed', request)
+                response = {'code': 1, 'error': str(e)}
+            connection.sendall(json.dumps(response) + '\n')
+        except (socket.error, ValueError), e:
+            log.debug('control connection failed: %s', e)
+        finally:
+            connection.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class ControlClient(object):
+    def __init__(self, path, connect_timeout=1):
+        self.path = path
+        self.connect_timeout = connect_timeout
+
+    def request(self, command, name=None, **kwargs):
+        """
+        Returns the response of daemon-runtime or None if it doesn't listen.
+        """
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.settimeout(self.connect_timeout)
+            try:
+                client.connect(self.path)
+            except socket.error, err:
+                if err.args[0] in (errno.ENOENT, errno.ECONNREFUSED, errno.EACCES):
+                    return None
+                raise
+            # commands like "stop all" take as long as the daemons need
+            client.settimeout(None)
+
+            kwargs.update(command=command, name=name)
+            client.sendall(json.dumps(kwargs) + '\n')
+            response_file = client.makefile('rb')
+            try:
+                line = response_file.readline()
+            finally:
+                response_file.close()
+        finally:
+            client.close()
+
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise ControlError('invalid response from daemon-runtime: %r' % line)
+
+
+def output_to_json(text):
+    return text.decode('utf-8', 'replace')
+
+
+def output_from_json(text):
+    return text.encode('utf-8')
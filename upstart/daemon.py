@@ -1,378 +1,24 @@
 # -*- coding: utf-8 -*-
-import sys, os
-import inspect
+import os
+import errno
+import fcntl
+import gc
+import select
 import signal
-import pwd
 import time
-import optparse
-import re
-from multiprocessing import Process, Value
-from itertools import cycle
+from multiprocessing import Process
 
-from .processes import ProcessManager
+# Daemon is in its own module, daemon-tools loads it without multiprocessing
+from .basedaemon import Daemon
+from .settings import SETTINGS_MANAGER
 
 
-class Daemon(object):
-    """
-    Usage: subclass the Daemon class and override the run() method
-    """
-    def __init__(self,
-                 log,
-                 pidfile=None,
-                 user=None,
-                 stop_timeout=5,
-                 terminate_signal=signal.SIGTERM,
-                 kill_signal=signal.SIGKILL,
-                 reload_signal=signal.SIGHUP,
-                 stdin='/dev/null',
-                 stdout='/dev/null',
-                 stderr='/dev/null'):
-        self.log = log
-        self.stdin = stdin
-        self.stdout = stdout
-        self.stderr = stderr
-        self.default_pidfile = pidfile is not None
-        self.pidfile = pidfile
-        self.user = user
-
-        self.stop_timeout = stop_timeout
-
-        self._manager = None
-        self.DEBUG = False
-        self.run_args = {}
-
-        self.terminate_signal = terminate_signal
-        self.kill_signal = kill_signal
-        self.reload_signal = reload_signal
-        self._set_signals_hooks()
-
-    def _set_signals_hooks(self):
-        signal.signal(self.reload_signal, self._sighup_hook)
-        signal.signal(self.terminate_signal, self._sigterm_hook)
-
-    def _sighup_hook(self, signum, frame):
-        self.reload()
-
-    def _sigterm_hook(self, signum, frame):
-        self.pre_stop()
-        sys.exit(0)
-
-    @property
-    def manager(self):
-        if not self._manager:
-            self._manager = ProcessManager()
-        return self._manager
-
-    def _set_user(self):
-        pw_record = pwd.getpwnam(self.user)
-        user_uid = pw_record.pw_uid
-        user_gid = pw_record.pw_gid
-        os.setgid(user_gid)
-        os.setuid(user_uid)
-
-    def _write_pidfile(self, pid):
-        fpid = open(self.pidfile, 'w+')
-        fpid.write("%s\n" % pid)
-        fpid.close()
-        self.log.debug('created pidfile %s' % self.pidfile)
-
-    def daemonize(self):
-        try:
-            pid = os.fork()
-            if pid > 0:
-                # exit first parent
-                sys.exit(0)
-        except OSError, e:
-            sys.stderr.write("fork #1 failed: %d (%s)\n" % (e.errno, e.strerror))
-            sys.exit(1)
-
-        if self.user:
-            self._set_user()
-
-        # decouple from parent environment
-        os.chdir("/")
-        os.setsid()
-        os.umask(0)
-
-        # do second fork
-        try:
-            pid = os.fork()
-            if pid > 0:
-                # exit from second parent
-                sys.exit(0)
-        except OSError, e:
-            sys.stderr.write("fork #2 failed: %d (%s)\n" % (e.errno, e.strerror))
-            sys.exit(1)
-
-        # write pidfile
-        pid = str(os.getpid())
-        self._write_pidfile(pid)
-
-        #redirect standard file descriptors
-        sys.stdout.flush()
-        sys.stderr.flush()
-        si = file(self.stdin, 'r')
-        so = file(self.stdout, 'a+')
-        se = file(self.stderr, 'a+', 0)
-        os.dup2(si.fileno(), sys.stdin.fileno())
-        os.dup2(so.fileno(), sys.stdout.fileno())
-        os.dup2(se.fileno(), sys.stderr.fileno())
-        self.log.debug('redirect standard file descriptors')
-
-    def delpid(self):
-        if os.path.exists(self.pidfile):
-            os.remove(self.pidfile)
-
-    @property
-    def pid(self):
-        try:
-            pidfile = file(self.pidfile,'r')
-            pid = int(pidfile.read().strip())
-            pidfile.close()
-        except (IOError, ValueError):
-            pid = None
-        return pid
-
-    def start(self, daemonize=True):
-        """
-        Don't override!
-        Start the daemon
-        """
-        if self.pid:
-            print "already running (%s)" % self.pid
-            sys.exit(1)
-        else:
-            self.pre_start()
-            if daemonize:
-                self.daemonize()
-            self.log.debug('starting daemon...')
-            self.run(**self.run_args)
-
-    def terminate(self, pid, force=False):
-        try:
-            stop_time = time.time()
-            while True:
-                if force or time.time() - stop_time > self.stop_timeout:
-                    os.kill(pid, self.kill_signal)
-                else:
-                    os.kill(pid, self.terminate_signal)
-                time.sleep(0.2)
-        except OSError, err:
-            err = str(err)
-            if err.find("No such process") > 0:
-                return True
-            else:
-                self.log.debug("Couldn't stop process %s: %s", pid, err)
-                return False
-
-    def stop(self, force=False):
-        """
-        Don't override!
-        Stop the daemon
-        """
-        self.stop_main_process(force)
-        self.kill_lost_processes(force)
-
-    def stop_main_process(self, force):
-        pid = self.pid
-
-        if pid:
-            self.log.debug('stopping...')
-            terminated = self.terminate(pid, force)
-            if terminated:
-                self.log.debug('stopped')
-                self.post_stop()
-                self.log.debug('post stopping...')
-                print 'stopped'
-            else:
-                print 'cannot stop process (%s)' % pid
-        else:
-            print 'not running'
-
-        self.delpid()
-
-    def kill_lost_processes(self, force):
-        while True:
-            lost_processes = self.get_lost_processes()
-            if lost_processes:
-                for process in lost_processes:
-                    terminated = self.terminate(process.pid, force)
-                    if terminated:
-                        print 'stopped lost process (%s)' % process.pid
-                    else:
-                        print 'cannot stop lost process (%s)' % process.pid
-            else:
-                break
-
-    def restart(self):
-        """
-        Don't override!
-        Restart the daemon
-        """
-        self.stop()
-        return self.start()
-
-    def _reload(self):
-        if not self.pid:
-            print 'stopped'
-        else:
-            process = self.manager.get(self.pid)
-            if process:
-                process.signal(self.reload_signal)
-                print 'reloaded'
-            else:
-                print "process with pid {pid} not found".format(pid=pid)
-
-    @property
-    def daemon(self):
-        return sys.argv[0][sys.argv[0].rfind('/')+1:]
-
-    def get_grepline(self):
-        if self.default_pidfile:
-            return r'(.*?)%s(\x00)+(.*?)start(\x00)*' % self.daemon
-        else:
-            return r'(.*?)%s(\x00)+(.*?)%s(.*?)start(\x00)*' % (self.daemon, self.pidfile)
-
-    def get_lost_processes(self):
-        found_processes = set(self.manager.find(self.get_grepline()))
-        running_process = self.manager.get(os.getpid())
-        running_processes = set(running_process.ancestors)
-        running_processes.add(running_process)
-        found_processes = found_processes - running_processes
-
-        if self.pid:
-            process = self.manager.get(self.pid)
-            if process:
-                found_processes.remove(process)
-                return found_processes - set(process.descendants)
-            else:
-                return found_processes
-        else:
-            return found_processes
-
-    def status(self):
-        '''
-        Don't override!
-        @param args tuple (key, value)
-        '''
-        result = False
-        pid = self.pid
-        if pid is None:
-            print 'stopped'
-            result = True
-        else:
-            process = self.manager.get(pid)
-            if process is None:
-                print "process with pid {pid} not found".format(pid=pid)
-            else:
-                if re.search(self.get_grepline(), process.cmdline):
-                    self.manager.get(self.pid)
-                    print 'running ({pid})'.format(pid=self.pid)
-                    result = True
-                else:
-                    print "pid {pid} is found but it belongs to another process".format(pid=pid)
-
-        lost_processes = self.get_lost_processes()
-        if lost_processes:
-            result = False
-            print 'lost pids: %s' % ','.join([str(process.pid) for process in lost_processes])
-        return result
-
-    def run(self, **kwargs):
-        """
-        You should override this method when you subclass Daemon. It will be called after the process has been
-        daemonized by start() or restart().
-        """
-        raise NotImplemented
-
-    def pre_start(self):
-        '''
-        Override it if you need
-        '''
-        pass
-
-    def pre_stop(self):
-        '''
-        Override it if you need
-        '''
-        pass
-
-    def post_stop(self):
-        '''
-        Override it if you need
-        '''
-        pass
-
-    def reload(self):
-        '''
-        Override it if you need
-        '''
-        pass
-
-    def execute(self):
-        daemon = self.daemon
-        optparser = optparse.OptionParser()
-        optparser.set_usage('Usage: {daemon} [options] (start|stop|stop-force|restart|reload|status)'.format(daemon=daemon))
-
-        if len(sys.argv) < 2:
-            optparser.print_usage()
-            sys.exit(1)
-
-        command_args = inspect.getargspec(self.run)
-        arg_names = command_args.args[1:]
-        args = {}
-
-        if command_args.defaults:
-            for i in xrange(len(command_args.defaults), 0, -1):
-                args[arg_names[-i]] = command_args.defaults[-i]
-
-        if not self.default_pidfile:
-            optparser.add_option('-p', '--pid', dest='pid', help='destination of a pid file')
-        optparser.add_option('-d', '--debug', action="store_true", dest='debug', default=False, help='debug mode')
-
-        for arg_name in arg_names:
-            try:
-                if isinstance(args[arg_name], bool):
-                    if args[arg_name]:
-                        optparser.add_option('--%s' % arg_name, action='store_false', default=args[arg_name],
-                                             dest=arg_name, help=arg_name)
-                    else:
-                        optparser.add_option('--%s' % arg_name, action='store_true', default=args[arg_name],
-                                             dest=arg_name, help=arg_name)
-                else:
-                    optparser.add_option('--%s' % arg_name, dest=arg_name, default=args[arg_name], help=arg_name)
-            except KeyError:
-                optparser.add_option('--%s' % arg_name, dest=arg_name, help=arg_name)
-
-        options, _ = optparser.parse_args()
-        if not self.default_pidfile:
-            self.pidfile = getattr(options, 'pid')
-            if not self.pidfile:
-                optparser.error('pid file must be specified')
-
-        for arg_name in arg_names:
-            if arg_name not in args and getattr(options, arg_name) is None:
-                optparser.error('%s must be specified' % arg_name)
-            else:
-                self.run_args[arg_name] = getattr(options, arg_name)
-
-        self.DEBUG = bool(getattr(options, 'debug'))
-
-        command = sys.argv[-1]
-        if command == 'start':
-            self.start(daemonize=not self.DEBUG)
-        elif command == 'stop':
-            self.stop()
-        elif command == 'stop-force':
-            self.stop(force=True)
-        elif command == 'restart':
-            self.restart()
-        elif command == 'reload':
-            self._reload()
-        elif command == 'status':
-            self.status()
-        else:
-            optparser.error("command %s is not found" % command)
+# full collections are started after this many young ones
+GC_FROZEN_THRESHOLD = 2 ** 31 - 1
+# how often a rolling reload checks whether new workers are ready
+ROLLOUT_CHECK_INTERVAL = 0.1
+# how often metrics served on metrics_listen are refreshed
+METRICS_REFRESH_INTERVAL = 1
 
 
 class DaemonMaster(Daemon):
@@ -388,12 +34,91 @@ class DaemonMaster(Daemon):
                  reload_signal=signal.SIGHUP,
                  stdin='/dev/null',
                  stdout='/dev/null',
-                 stderr='/dev/null'):
+                 stderr='/dev/null',
+                 metrics_listen=None,
+                 metrics_textfile=None,
+                 metrics_interval=15,
+                 min_workers=None,
+                 max_workers=None,
+                 scaling_policy=None,
+                 freeze_gc=False,
+                 worker_cpus=None,
+                 rolling_reload=False,
+                 max_surge=1,
+                 max_unavailable=0,
+                 ready_timeout=60,
+                 listen=None,
+                 reuse_port=False,
+                 worker_log=None,
+                 worker_log_format=None,
+                 worker_log_buffer=1 << 20):
         super(DaemonMaster, self).__init__(log, pidfile, user, stop_timeout, terminate_signal, kill_signal,
                                            reload_signal, stdin, stdout, stderr)
         self.worker_timeout = worker_timeout
         self.worker_activity = worker_activity
         self.workers = []
+        self.service_workers = []
+        self.workers_cgroup = None
+        self.heartbeats = None
+        # the pool is scaled between min_workers and max_workers if max_workers is set
+        self.min_workers = min_workers if min_workers is not None else 1
+        self.max_workers = max_workers
+        if max_workers is not None and self.min_workers > max_workers:
+            raise ValueError('min_workers %s is greater than max_workers %s' % (min_workers, max_workers))
+        if scaling_policy is None and max_workers is not None:
+            from .scaling import ScalingPolicy
+
+            scaling_policy = ScalingPolicy()
+        self.scaling_policy = scaling_policy
+        # (worker, time to kill it) of workers stopped by scaling down
+        self.retiring_workers = []
+        # worker: time to kill it, of workers stopped for no activity
+        self.stalled_workers = {}
+        self.freeze_gc = freeze_gc
+        # 'core', 'numa' or CPUs, see CpuPolicy
+        self.cpu_policy = None
+        if worker_cpus is not None:
+            from .placement import CpuPolicy
+
+            self.cpu_policy = CpuPolicy(worker_cpus)
+        self._started_workers = 0
+        # on reload_signal workers are replaced by new ones in turn instead of
+        # getting the signal: up to max_surge extra workers run and up to
+        # max_unavailable are missing at a time
+        self.rolling_reload = rolling_reload
+        if rolling_reload and max_surge + max_unavailable < 1:
+            raise ValueError('max_surge or max_unavailable must be positive')
+        self.max_surge = max_surge
+        self.max_unavailable = max_unavailable
+        self.ready_timeout = ready_timeout
+        # addresses bound once by the master and shared by workers, or bound
+        # by every DaemonWorker itself with reuse_port
+        if isinstance(listen, basestring):
+            listen = [listen]
+        self.listen = list(listen or [])
+        self.reuse_port = reuse_port
+        self.sockets = []
+        # records of DaemonWorkers are sent to the master, which writes them
+        # to worker_log, see LogChannel, in DEFAULT_FORMAT of logchannel by default
+        self.worker_log = worker_log
+        self.worker_log_format = worker_log_format
+        self.worker_log_buffer = worker_log_buffer
+        self.log_channel = None
+        self.outdated_workers = set()
+        # new worker: its start time, of workers not ready yet
+        self.pending_workers = {}
+        self.rollout_size = 0
+        self._reload_requested = False
+        self._template_worker = None
+        self._busy_times = {}
+        self._busy_checked = None
+        self.metrics_listen = metrics_listen
+        self.metrics_textfile = metrics_textfile
+        self.metrics_interval = metrics_interval
+        self.metrics = None
+        self.metrics_snapshot = None
+        self.metrics_server = None
+        self._master_pid = None
 
     def get_workers(self):
         return self.workers
@@ -401,82 +126,644 @@ class DaemonMaster(Daemon):
     def start_worker(self, worker):
         raise NotImplemented
 
+    def preload(self):
+        """
+        Runs once in the master before workers are forked. What it loads,
+        e.g. into attributes of the master, is shared by all workers, so
+        respawned ones start without loading it again.
+        """
+        pass
+
+    def _prepare_fork(self):
+        """
+        Collects garbage of the preload, so its survivors are in the oldest
+        generation, where young collections of workers never touch them.
+        With freeze_gc full collections are stopped as well: they write to
+        every object and copy the pages they are in to each worker.
+        """
+        gc.collect()
+        if not self.freeze_gc:
+            return
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        else:
+            # no gc.freeze() before Python 3.7: cycles that reach the oldest
+            # generation are freed only by an explicit gc.collect()
+            threshold0, threshold1, _ = gc.get_threshold()
+            gc.set_threshold(threshold0, threshold1, GC_FROZEN_THRESHOLD)
+
+    def get_queue_depth(self):
+        """
+        Returns the number of requests waiting for workers, which scales the
+        pool with ScalingPolicy.queue_per_worker. None if unknown.
+        """
+        return None
+
     def stop(self, force=False):
-        self.stop_main_process(force)
+        return self.stop_main_process(force)
 
     def stop_worker(self, process):
-        try:
-            stop_time = time.time()
-            while True:
-                if time.time() - stop_time > self.stop_timeout:
-                    os.kill(process.pid, self.kill_signal)
-                else:
-                    os.kill(process.pid, self.terminate_signal)
-                time.sleep(0.2)
-        except OSError, err:
-            err = str(err)
-            if err.find("No such process") > 0:
-                return True
-            else:
-                self.log.debug("Couldn't stop worker %s: %s", process.pid, err)
-                return False
+        return self.stop_workers([process])[process.pid]
 
-    def run(self):
-        workers = self.get_workers()
-        service_workers = []
+    def stop_workers(self, processes):
+        results = self.terminate_all([process.pid for process in processes])
+        for process in processes:
+            if not results[process.pid]:
+                self.log.debug("Couldn't stop worker %s", process.pid)
+        return results
 
-        for worker in workers:
+    def _create_workers_cgroup(self):
+        """
+        Workers go to a child cgroup of the master's one if daemon-manager
+        has started the master in its own cgroup.
+        """
+        from .cgroups import Cgroup, get_root
+
+        root = get_root(SETTINGS_MANAGER.get('cgroup'))
+        cgroup = Cgroup.current()
+        if root is None or cgroup is None or not cgroup.path.startswith(root.path + '/'):
+            return None
+        cgroup = cgroup.child('workers')
+        if not cgroup.create():
+            return None
+        return cgroup
+
+    def _get_free_slot(self):
+        used = set(worker.slot for worker in self.service_workers if isinstance(worker, DaemonWorker))
+        # retiring workers keep writing their slots until they exit
+        used.update(worker.slot for worker, _ in self.retiring_workers if isinstance(worker, DaemonWorker))
+        for slot in xrange(self.heartbeats.size):
+            if slot not in used:
+                return slot
+        return None
+
+    def _start_worker(self, worker, slot=None):
+        cpus = None
+        if isinstance(worker, DaemonWorker):
+            if slot is None:
+                slot = self._get_free_slot()
+            if self.cpu_policy is not None:
+                cpus = self.cpu_policy.get_cpus(slot)
+            self.heartbeats.reset(slot)
+            worker.attach(self.heartbeats, slot)
+            worker.log_channel = self.log_channel
+            worker.master_log = self.log
+            worker.sockets = self.sockets
+            if self.reuse_port and not self.sockets:
+                worker.listen = self.listen
+            # joins and pins itself before its run(), so it can't fork
+            # anything outside
+            worker.cgroup = self.workers_cgroup
+            worker.cpus = cpus
             worker.start()
-            service_workers.append([worker])
-
-        def hook(signum, frame):
-            self.log.debug('received signal %s', signum)
-            for processes in service_workers:
-                if processes:
-                    worker = processes[0]
-                    if signum == self.terminate_signal:
-                        self.log.debug('terminating worker %s', worker.pid)
-                        worker.terminate()
-                    else:
-                        try:
-                            os.kill(worker.pid, signum)
-                        except OSError:
-                            self.log.debug("couldn't transfer signal %s to process %s", signum, worker.pid)
-
-            if signum == self.terminate_signal:
-                os._exit(0)
+        else:
+            if self.cpu_policy is not None:
+                cpus = self.cpu_policy.get_cpus(self._started_workers)
+            worker.start()
+            self._move_to_cgroup(worker)
+            if cpus is not None:
+                from .syscalls import sched_setaffinity
 
-        signal.signal(self.terminate_signal, hook)
-        signal.signal(self.reload_signal, hook)
+                try:
+                    sched_setaffinity(worker.pid, cpus)
+                except OSError, e:
+                    self.log.debug("couldn't pin worker %s to CPUs %s: %s", worker.pid, cpus, e)
+        self._started_workers += 1
 
-        for processes in cycle(service_workers):
-            worker = processes[0]
+    def _move_to_cgroup(self, worker):
+        if self.workers_cgroup is not None:
+            try:
+                self.workers_cgroup.add(worker.pid)
+            except IOError, e:
+                self.log.debug("couldn't move worker %s to %s: %s", worker.pid, self.workers_cgroup, e)
+
+    def _open_wakeup_pipe(self):
+        wakeup_read, wakeup_write = os.pipe()
+        for fd in (wakeup_read, wakeup_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(wakeup_write)
+        return wakeup_read
+
+    def _create_metrics(self):
+        from .metrics import MetricsRegistry, MetricsServer, MetricsSnapshot
+
+        self.metrics = MetricsRegistry()
+        self.metric_workers = self.metrics.gauge('daemon_master_workers', 'Number of alive workers.')
+        self.metric_restarts = self.metrics.counter('daemon_master_worker_restarts_total',
+                                                    'Restarts of exited workers.')
+        self.metric_stalls = self.metrics.counter('daemon_master_worker_stalls_total',
+                                                  'Workers stopped for no activity within worker_timeout.')
+        self.metric_activity = self.metrics.gauge('daemon_master_worker_last_activity_timestamp_seconds',
+                                                  'Last activity reported by the worker.', ['slot'])
+        self.metric_busy = self.metrics.gauge('daemon_master_worker_busy_ratio',
+                                              'Share of time workers were busy at the last scaling check.')
+        self.metric_restarts.inc(0)
+        self.metric_stalls.inc(0)
+        if self.log_channel is not None:
+            self.metric_log_dropped = self.metrics.counter('daemon_master_worker_log_dropped_total',
+                                                           'Log records of workers dropped for a full channel.')
+        if self.metrics_listen:
+            # a slow scraper mustn't hold up the loop, so a thread serves the
+            # text rendered by the loop: workers are forked while it runs and
+            # it must hold no lock they use
+            self.metrics_snapshot = MetricsSnapshot(self.metrics)
+            self._collect_metrics()
+            self.metrics_snapshot.update()
+            self.metrics_server = MetricsServer(self.metrics_listen, self.metrics_snapshot)
+            self.metrics_server.listen()
+            self.metrics_server.start()
+
+    def _collect_metrics(self):
+        self.metric_workers.set(sum(1 for worker in self.service_workers if worker.is_alive()))
+        if self.log_channel is not None:
+            self.metric_log_dropped.set(self.log_channel.get_dropped())
+        slots = set()
+        for worker in self.service_workers:
+            if isinstance(worker, DaemonWorker):
+                slots.add((str(worker.slot),))
+                self.metric_activity.set(self.heartbeats.get(worker.slot), (str(worker.slot),))
+        # slots freed by scaling down
+        for labels in self.metric_activity.series.keys():
+            if labels not in slots:
+                self.metric_activity.remove(labels)
+
+    def _wait(self, wakeup_fd, timeout):
+        try:
+            select.select([wakeup_fd], [], [], timeout)
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(wakeup_fd, 4096):
+                pass
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
 
-            if self.worker_activity and not worker.is_active(self.worker_timeout):
-                self.stop_worker(worker)
+    def _sigchld_hook(self, signum, frame):
+        # the handler only has to exist: set_wakeup_fd does the wakeup
+        pass
 
-            if not worker.is_alive():
+    def _master_signal_hook(self, signum, frame):
+        if os.getpid() != self._master_pid:
+            # a respawned worker inherits this hook, behave as a first worker
+            if signum == self.terminate_signal:
+                self._sigterm_hook(signum, frame)
+            else:
+                self._sighup_hook(signum, frame)
+            return
+
+        self.log.debug('received signal %s', signum)
+        if signum != self.terminate_signal and self.rolling_reload:
+            # the loop is woken up by the wakeup fd
+            self._reload_requested = True
+            return
+        workers = self.service_workers + [worker for worker, _ in self.retiring_workers]
+        for worker in workers:
+            if signum == self.terminate_signal:
+                self.log.debug('terminating worker %s', worker.pid)
+                worker.terminate()
+            else:
+                try:
+                    os.kill(worker.pid, signum)
+                except OSError:
+                    self.log.debug("couldn't transfer signal %s to process %s", signum, worker.pid)
+
+        if signum == self.terminate_signal:
+            if self.workers_cgroup is not None or self.log_channel is not None:
+                self.manager.wait([worker.pid for worker in workers], self.stop_timeout)
+            if self.workers_cgroup is not None:
+                # nothing started by workers outlives the master
+                self.workers_cgroup.kill(self.stop_timeout)
+            if self.log_channel is not None:
+                # the last records of workers
+                self.log_channel.close()
+            os._exit(0)
+
+    def _respawn_workers(self):
+        for index, worker in enumerate(self.service_workers):
+            if not worker.is_alive() and worker not in self.pending_workers:
                 self.log.info('process %s failed, restarting', worker.pid)
                 try:
                     worker.join()
                 except OSError:
                     pass
-                processes.pop()
                 new_worker = self.start_worker(worker)
-                new_worker.start()
-                processes.append(new_worker)
+                self._start_worker(new_worker, worker.slot if isinstance(worker, DaemonWorker) else None)
+                self.service_workers[index] = new_worker
+                if self.metrics is not None:
+                    self.metric_restarts.inc()
                 self.log.info('new process %s started', new_worker.pid)
-            time.sleep(1)
+
+    def _check_activity(self):
+        """
+        Signals stalled workers to stop and returns the time of the next
+        check: the moment the most quiet worker runs out of its timeout.
+        """
+        stalled_slots, next_check = self.heartbeats.get_stalled(self.worker_timeout)
+        slots = dict((worker.slot, worker) for worker in self.service_workers if isinstance(worker, DaemonWorker))
+        stalled_workers = [slots[slot] for slot in stalled_slots
+                           if slot in slots and slots[slot] not in self.stalled_workers]
+        if stalled_workers:
+            if self.metrics is not None:
+                self.metric_stalls.inc(len(stalled_workers))
+            for worker in stalled_workers:
+                self.log.info('process %s is stalled, stopping', worker.pid)
+                self.stalled_workers[worker] = time.time() + self.stop_timeout
+                try:
+                    os.kill(worker.pid, self.terminate_signal)
+                except OSError, err:
+                    if err.errno != errno.ESRCH:
+                        raise
+        return next_check
+
+    def _kill_stalled_workers(self):
+        """
+        Kills stalled workers out of stop_timeout, _respawn_workers replaces
+        them once they exit. Returns the next time to kill one or None.
+        """
+        stalled_workers = {}
+        for worker, kill_time in self.stalled_workers.items():
+            if worker not in self.service_workers or not worker.is_alive():
+                continue
+            if kill_time <= time.time():
+                self.log.info("process %s hasn't stopped in %s seconds, killing", worker.pid, self.stop_timeout)
+                try:
+                    os.kill(worker.pid, self.kill_signal)
+                except OSError, err:
+                    if err.errno != errno.ESRCH:
+                        raise
+                kill_time = time.time() + self.stop_timeout
+            stalled_workers[worker] = kill_time
+        self.stalled_workers = stalled_workers
+        if not stalled_workers:
+            return None
+        return min(stalled_workers.values())
+
+    def _get_busy_ratio(self, now):
+        """
+        Returns the share of time workers were busy since the previous call,
+        None on the first one.
+        """
+        busy_times = {}
+        for worker in self.service_workers:
+            if isinstance(worker, DaemonWorker):
+                busy_times[worker.pid] = self.heartbeats.get_busy_time(worker.slot, now)
+        last_times, last_checked = self._busy_times, self._busy_checked
+        self._busy_times, self._busy_checked = busy_times, now
+        if last_checked is None or not busy_times or now <= last_checked:
+            return None
+        busy = sum(busy_time - last_times.get(pid, 0) for pid, busy_time in busy_times.iteritems())
+        return min(busy / ((now - last_checked) * len(busy_times)), 1.0)
+
+    def _scale(self):
+        from .scaling import get_load, get_memory_pressure
+
+        now = time.time()
+        signals = {
+            'busy': self._get_busy_ratio(now),
+            'queue': self.get_queue_depth(),
+            'load': get_load(),
+            'memory_pressure': get_memory_pressure(),
+        }
+        if self.metrics is not None and signals['busy'] is not None:
+            self.metric_busy.set(signals['busy'])
+        current = len(self.service_workers)
+        desired = self.scaling_policy.decide(signals, current, self.min_workers, self.max_workers, now)
+        if desired > current:
+            self.log.info('scaling up from %s to %s workers: %s', current, desired, signals)
+            self._add_workers(desired - current)
+        elif desired < current:
+            self.log.info('scaling down from %s to %s workers: %s', current, desired, signals)
+            self._retire_workers(current - desired)
+
+    def _add_workers(self, number):
+        for _ in xrange(number):
+            template = self.service_workers[-1] if self.service_workers else self._template_worker
+            if template is None or self._get_free_slot() is None:
+                self.log.debug('no worker is added, %s are retiring', len(self.retiring_workers))
+                return
+            worker = self.start_worker(template)
+            self._start_worker(worker)
+            self.service_workers.append(worker)
+            self.log.info('new process %s started', worker.pid)
+
+    def _retire_workers(self, number):
+        """
+        Stops idle workers, the last started first. Busy ones finish their
+        requests and are retired by a later check if still not needed.
+        """
+        idle_workers = [worker for worker in reversed(self.service_workers)
+                        if not (isinstance(worker, DaemonWorker) and self.heartbeats.is_busy(worker.slot))]
+        for worker in idle_workers[:number]:
+            self._retire_worker(worker)
+
+    def _retire_worker(self, worker):
+        self.log.info('retiring process %s', worker.pid)
+        self.service_workers.remove(worker)
+        self.retiring_workers.append((worker, time.time() + self.stop_timeout))
+        try:
+            os.kill(worker.pid, self.terminate_signal)
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise
+
+    def _start_rollout(self):
+        """
+        Loads the state again and marks all workers outdated. Workers of
+        a rollout in progress are outdated too.
+        """
+        self._reload_requested = False
+        self.log.info('rolling reload of %s workers', len(self.service_workers))
+        try:
+            self.preload()
+        except Exception:
+            self.log.exception('preload failed, workers are not reloaded')
+            return
+        self._prepare_fork()
+        self.outdated_workers = set(self.service_workers)
+        self.pending_workers = {}
+        self.rollout_size = len(self.service_workers)
+
+    def _is_ready(self, worker, started):
+        if isinstance(worker, DaemonWorker):
+            # any heartbeat after the start: active(), busy() or idle()
+            return self.heartbeats.get(worker.slot) > started
+        return worker.is_alive()
+
+    def _stop_rollout(self, reason):
+        """
+        Retires new workers which are not ready and keeps the old ones.
+        """
+        self.log.error('rolling reload is stopped, %s; %s old workers are kept',
+                       reason, len(self.outdated_workers))
+        for worker in self.pending_workers:
+            self._retire_worker(worker)
+        self.outdated_workers = set()
+        self.pending_workers = {}
+
+    def _roll(self):
+        """
+        Replaces outdated workers as far as max_surge and max_unavailable
+        allow. Returns True while the rollout goes on.
+        """
+        now = time.time()
+        for worker, started in self.pending_workers.items():
+            if not worker.is_alive():
+                # not respawned by _respawn_workers()
+                self._stop_rollout('new process %s exited before it was ready' % worker.pid)
+                return False
+            if self._is_ready(worker, started):
+                self.log.info('new process %s is ready', worker.pid)
+                del self.pending_workers[worker]
+            elif started + self.ready_timeout <= now:
+                self._stop_rollout("new process %s isn't ready in %s seconds" % (worker.pid, self.ready_timeout))
+                return False
+
+        # respawned ones are not outdated anymore
+        outdated = [worker for worker in self.service_workers if worker in self.outdated_workers]
+        self.outdated_workers = set(outdated)
+        if not outdated and not self.pending_workers:
+            self.log.info('rolling reload is done')
+            return False
+
+        # idle ones first, the others are retired when idle or by stop_timeout
+        outdated.sort(key=lambda worker: isinstance(worker, DaemonWorker) and self.heartbeats.is_busy(worker.slot))
+        available = len(self.service_workers) - len(self.pending_workers)
+        while outdated and available - 1 >= self.rollout_size - self.max_unavailable:
+            worker = outdated.pop(0)
+            self.outdated_workers.discard(worker)
+            self._retire_worker(worker)
+            available -= 1
+
+        while (len(outdated) > len(self.pending_workers) and
+               len(self.service_workers) < self.rollout_size + self.max_surge):
+            template = outdated[len(self.pending_workers)]
+            if isinstance(template, DaemonWorker) and self._get_free_slot() is None:
+                self.log.debug('no worker is added, %s are retiring', len(self.retiring_workers))
+                break
+            worker = self.start_worker(template)
+            self._start_worker(worker)
+            self.service_workers.append(worker)
+            if isinstance(worker, DaemonWorker):
+                # the start time written to its slot
+                self.pending_workers[worker] = self.heartbeats.get(worker.slot)
+            else:
+                self.pending_workers[worker] = time.time()
+            self.log.info('new process %s started', worker.pid)
+        return True
+
+    def _reap_retiring_workers(self):
+        """
+        Joins exited retiring workers and kills those out of stop_timeout.
+        Returns the next time to kill one or None.
+        """
+        retiring_workers = []
+        for worker, kill_time in self.retiring_workers:
+            if not worker.is_alive():
+                worker.join()
+                continue
+            if kill_time <= time.time():
+                self.log.info("process %s hasn't stopped in %s seconds, killing", worker.pid, self.stop_timeout)
+                try:
+                    os.kill(worker.pid, self.kill_signal)
+                except OSError, err:
+                    if err.errno != errno.ESRCH:
+                        raise
+                kill_time = time.time() + self.stop_timeout
+            retiring_workers.append((worker, kill_time))
+        self.retiring_workers = retiring_workers
+        if not retiring_workers:
+            return None
+        return min(kill_time for _, kill_time in retiring_workers)
+
+    def run(self):
+        from .heartbeat import HeartbeatTable
+        from .logchannel import DEFAULT_FORMAT, LogChannel
+        from .metrics import write_textfile
+        from .sockets import bind_socket
+
+        self._master_pid = os.getpid()
+        self.service_workers = []
+        self.workers_cgroup = self._create_workers_cgroup()
+
+        if self.inherited_sockets:
+            # daemon-runtime keeps them open while the master restarts
+            self.sockets = [sock for _, sock in self.inherited_sockets]
+        elif self.listen and not self.reuse_port:
+            self.sockets = [bind_socket(address) for address in self.listen]
+
+        started = time.time()
+        self.preload()
+        workers = self.get_workers()
+        size = max(len(workers), self.max_workers or 0)
+        if self.rolling_reload:
+            # room for the surge and for old workers which are stopping
+            size += self.max_surge + self.max_unavailable
+        self.heartbeats = HeartbeatTable(size)
+        if self.worker_log:
+            self.log_channel = LogChannel(self.worker_log, size, self.worker_log_buffer,
+                                          self.worker_log_format or DEFAULT_FORMAT)
+            self.log_channel.start()
+        self._template_worker = workers[0] if workers else None
+        self._prepare_fork()
+        self.log.debug('preloaded in %.3f seconds', time.time() - started)
+        # before the first fork: a signal sent once workers are up must not
+        # find the hooks of a plain Daemon
+        wakeup_fd = self._open_wakeup_pipe()
+        signal.signal(signal.SIGCHLD, self._sigchld_hook)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.signal(self.terminate_signal, self._master_signal_hook)
+        signal.signal(self.reload_signal, self._master_signal_hook)
+        for slot, worker in enumerate(workers):
+            self._start_worker(worker, slot)
+            self.service_workers.append(worker)
+
+        if self.metrics_listen or self.metrics_textfile:
+            self._create_metrics()
+
+        next_check = None
+        next_textfile = None
+        next_scale = None
+        next_refresh = None
+        while True:
+            # workers could have died before SIGCHLD hook was set
+            self._respawn_workers()
+            next_kill = self._reap_retiring_workers()
+
+            next_roll = None
+            if self._reload_requested:
+                self._start_rollout()
+            if self.outdated_workers or self.pending_workers:
+                if self._roll():
+                    # readiness is written to heartbeats, nothing wakes the master
+                    next_roll = time.time() + ROLLOUT_CHECK_INTERVAL
+            elif self.scaling_policy is not None and (next_scale is None or next_scale <= time.time()):
+                next_scale = time.time() + self.scaling_policy.interval
+                self._scale()
+
+            if self.worker_activity and (next_check is None or next_check <= time.time()):
+                next_check = self._check_activity()
+                if next_check is not None and next_check <= time.time():
+                    continue
+            next_stalled_kill = self._kill_stalled_workers()
+
+            if self.metrics_textfile and (next_textfile is None or next_textfile <= time.time()):
+                next_textfile = time.time() + self.metrics_interval
+                self._collect_metrics()
+                write_textfile(self.metrics_textfile, self.metrics)
+
+            if self.metrics_snapshot is not None and (next_refresh is None or next_refresh <= time.time()):
+                next_refresh = time.time() + METRICS_REFRESH_INTERVAL
+                self._collect_metrics()
+                self.metrics_snapshot.update()
+
+            next_times = [next_time for next_time in (next_check, next_textfile, next_scale, next_kill,
+                                                      next_stalled_kill, next_roll, next_refresh)
+                          if next_time is not None]
+            if next_times:
+                timeout = max(min(next_times) - time.time(), 0)
+            else:
+                timeout = None
+            self._wait(wakeup_fd, timeout)
 
 
 class DaemonWorker(Process):
     def __init__(self):
         super(DaemonWorker, self).__init__()
-        self.last_activity = Value('d', time.time())
+        self.heartbeats = None
+        self.slot = 0
+        self._times = None
+        self.cgroup = None
+        self.cpus = None
+        # listening sockets of the master, or addresses to bind with SO_REUSEPORT
+        self.sockets = []
+        self.listen = None
+        # the master's LogChannel and its log, whose handlers are replaced
+        # with log_handler in the worker
+        self.log_channel = None
+        self.master_log = None
+        self.log_handler = None
+
+    def attach(self, heartbeats, slot):
+        """
+        Makes the worker report its activity to the slot of the master's table.
+        """
+        self.heartbeats = heartbeats
+        self.slot = slot
+        self._times = heartbeats.times
+
+    def _bootstrap(self):
+        # drop the supervision loop wakeups inherited from the master
+        wakeup_fd = signal.set_wakeup_fd(-1)
+        if wakeup_fd >= 0:
+            os.close(wakeup_fd)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        if self.cgroup is not None:
+            try:
+                self.cgroup.add()
+            except IOError:
+                pass
+        if self.cpus is not None:
+            from .syscalls import sched_setaffinity
+
+            try:
+                sched_setaffinity(0, self.cpus)
+            except OSError:
+                pass
+        if self.heartbeats is None:
+            from .heartbeat import HeartbeatTable
+
+            # started without a master, nobody watches its beats
+            self.attach(HeartbeatTable(1), 0)
+        if self.log_channel is not None:
+            self.log_handler = self.log_channel.get_handler(self.slot)
+            if self.master_log is not None:
+                # inherited handlers would append to their files on their own
+                self.master_log.handlers = [self.log_handler]
+        if self.listen:
+            from .sockets import bind_socket
+
+            # the kernel balances connections between sockets of workers
+            self.sockets = [bind_socket(address, reuse_port=True) for address in self.listen]
+        return super(DaemonWorker, self)._bootstrap()
+
+    @property
+    def last_activity(self):
+        if self.heartbeats is None:
+            return None
+        return self.heartbeats.get(self.slot)
 
     def is_active(self, timeout=600):
-        return time.time() - self.last_activity.value <= timeout
+        if self.heartbeats is None:
+            return True
+        return time.time() - self.heartbeats.get(self.slot) <= timeout
 
     def active(self):
-        self.last_activity = time.time()
+        """
+        Reports that the worker is alive, cheap enough to be called per request.
+        """
+        self._times[self.slot] = time.time()
+
+    def busy(self):
+        """
+        Reports the start of a request, the busy share of workers scales the
+        pool of a DaemonMaster with max_workers.
+        """
+        now = time.time()
+        self._times[self.slot] = now
+        self.heartbeats.busy_since[self.slot] = now
+
+    def idle(self):
+        """
+        Reports the end of a request.
+        """
+        now = time.time()
+        heartbeats = self.heartbeats
+        since = heartbeats.busy_since[self.slot]
+        if since:
+            heartbeats.busy_since[self.slot] = 0
+            heartbeats.busy_time[self.slot] += now - since
+        self._times[self.slot] = now
 
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import time
+from multiprocessing.sharedctypes import RawArray
+
+
+class HeartbeatTable(object):
+    """
+    Last activity times of workers in shared memory, a slot per worker.
+    The table is created before workers are forked, so they write the
+    master's pages. Every slot has a single writer and a double is stored
+    at once, so a beat takes neither a lock nor a syscall.
+
+    Workers which report their requests also keep the time they have been
+    busy: the start of the current request (0 when idle) and the total of
+    finished ones.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.times = RawArray('d', size)
+        self.busy_since = RawArray('d', size)
+        self.busy_time = RawArray('d', size)
+        now = time.time()
+        for slot in xrange(size):
+            self.times[slot] = now
+
+    def beat(self, slot):
+        self.times[slot] = time.time()
+
+    def reset(self, slot):
+        """
+        Gives a new worker in the slot a whole timeout to start beating.
+        """
+        self.times[slot] = time.time()
+        self.busy_since[slot] = 0
+        self.busy_time[slot] = 0
+
+    def get(self, slot):
+        return self.times[slot]
+
+    def is_busy(self, slot):
+        return self.busy_since[slot] != 0
+
+    def get_busy_time(self, slot, now=None):
+        """
+        Returns seconds the worker in the slot has been busy, the current
+        request included. The total only grows while the slot isn't reset.
+        """
+        # idle() clears busy_since before it adds to busy_time, read in the
+        # other order a finished request can't be counted twice
+        busy_time = self.busy_time[slot]
+        since = self.busy_since[slot]
+        if since:
+            busy_time += max((now or time.time()) - since, 0)
+        return busy_time
+
+    def get_stalled(self, timeout):
+        """
+        Reads all slots in one pass. Returns the stalled slots and the time
+        the most quiet of the others runs out of its timeout (None if all
+        are stalled).
+        """
+        now = time.time()
+        stalled = []
+        next_check = None
+        for slot, last_activity in enumerate(self.times[:]):
+            deadline = last_activity + timeout
+            if deadline < now:
+                stalled.append(slot)
+            elif next_check is None or deadline < next_check:
+                next_check = deadline
+        return stalled, next_check
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import errno
+import fcntl
+import logging
+import os
+import select
+import threading
+import time
+from multiprocessing.sharedctypes import RawArray
+
+from .logs import TIME_FORMAT
+
+
+# not in the fcntl module of python 2
+F_SETPIPE_SZ = 1031
+# a write of up to this many bytes to a pipe is never mixed with others
+PIPE_BUF = getattr(select, 'PIPE_BUF', 4096)
+# bytes the writer takes from the pipe for one write to the file
+BATCH_SIZE = 1 << 20
+# how often the writer looks for dropped records when nothing is sent
+REPORT_INTERVAL = 1
+DEFAULT_FORMAT = '%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'
+
+
+def _set_flags(fd, nonblocking):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    if nonblocking:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class LogChannel(object):
+    """
+    Log records of workers, written to path by a thread of the master.
+    Workers put formatted records to a pipe of capacity bytes without
+    blocking, and the writer appends whatever has gathered in it with one
+    write. A record of up to PIPE_BUF bytes gets to the pipe whole or not
+    at all, so lines of workers are never torn: when the pipe is full the
+    record is dropped and counted in the worker's slot, and the writer
+    logs the number. Longer records, tracebacks mostly, are appended to
+    the file by the worker itself, which is atomic as well but may put
+    them before records of the worker still in the pipe.
+
+    Created before workers are forked, like HeartbeatTable.
+    """
+    def __init__(self, path, slots, capacity=1 << 20, format=DEFAULT_FORMAT):
+        self.path = path
+        self.format = format
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.read_fd, self.write_fd = os.pipe()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_flags(self.fd, False)
+        for fd in (self.read_fd, self.write_fd, self._wakeup_read, self._wakeup_write):
+            _set_flags(fd, True)
+        try:
+            fcntl.fcntl(self.write_fd, F_SETPIPE_SZ, capacity)
+        except IOError:
+            # over /proc/sys/fs/pipe-max-size, the pipe keeps its 64 KB
+            pass
+        # every slot has a single writer, like slots of HeartbeatTable
+        self.dropped = RawArray('L', slots)
+        self.reported = [0] * slots
+        self._thread = None
+        self._closed = False
+
+    def start(self):
+        # the writer only makes syscalls and holds no lock a forked worker
+        # could inherit locked
+        self._thread = threading.Thread(target=self._run, name='worker-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                select.select([self.read_fd, self._wakeup_read], [], [], REPORT_INTERVAL)
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+            self.flush()
+        self.flush()
+
+    def _read(self):
+        chunks = []
+        size = 0
+        while size < BATCH_SIZE:
+            try:
+                chunk = os.read(self.read_fd, BATCH_SIZE - size)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno != errno.EAGAIN:
+                    raise
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return chunks
+
+    def _get_drops(self):
+        drops = []
+        timestamp = None
+        for slot, dropped in enumerate(self.dropped[:]):
+            if dropped != self.reported[slot]:
+                timestamp = timestamp or time.strftime(TIME_FORMAT)
+                drops.append('%s daemon-master: %s records of the worker in slot %s dropped\n' % (
+                    timestamp, dropped - self.reported[slot], slot))
+                self.reported[slot] = dropped
+        return drops
+
+    def _write(self, fd, data):
+        while data:
+            try:
+                written = os.write(fd, data)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            data = data[written:]
+
+    def flush(self):
+        """
+        Appends records gathered in the pipe and the numbers of dropped ones.
+        Returns the number of bytes written.
+        """
+        chunks = self._read()
+        chunks.extend(self._get_drops())
+        data = ''.join(chunks)
+        if data:
+            try:
+                self._write(self.fd, data)
+            except OSError:
+                # the disk is full: records are lost, but the writer goes on
+                pass
+        return len(data)
+
+    def get_dropped(self):
+        return sum(self.dropped[:])
+
+    def get_handler(self, slot):
+        """
+        Called by a worker, returns the handler of its records. The pipe is
+        left to the master.
+        """
+        for fd in (self.read_fd, self._wakeup_read, self._wakeup_write):
+            os.close(fd)
+        self.read_fd = self._wakeup_read = self._wakeup_write = None
+        self._thread = None
+        handler = LogChannelHandler(self, slot)
+        handler.setFormatter(logging.Formatter(self.format))
+        return handler
+
+    def send(self, data, slot):
+        """
+        Puts a record of the worker in the slot to the channel, never waits
+        for the writer.
+        """
+        try:
+            if len(data) > PIPE_BUF:
+                self._write(self.fd, data)
+            else:
+                os.write(self.write_fd, data)
+        except OSError:
+            # EAGAIN: the writer is behind, EPIPE: the master is gone
+            self.dropped[slot] += 1
+
+    def close(self):
+        """
+        Stops the writer after it has written what is left in the pipe.
+        """
+        if self._thread is not None:
+            self._closed = True
+            os.write(self._wakeup_write, '\0')
+            self._thread.join()
+            self._thread = None
+        elif self.read_fd is not None:
+            self.flush()
+        for fd in (self.fd, self.read_fd, self.write_fd, self._wakeup_read, self._wakeup_write):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self.read_fd = self.write_fd = self._wakeup_read = self._wakeup_write = None
+
+
+class LogChannelHandler(logging.Handler):
+    """
+    Sends records of a worker to the master's LogChannel, a line each.
+    """
+    def __init__(self, channel, slot):
+        logging.Handler.__init__(self)
+        self.channel = channel
+        self.slot = slot
+
+    def emit(self, record):
+        try:
+            data = self.format(record)
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            self.channel.send(data + '\n', self.slot)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
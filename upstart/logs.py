@@ -0,0 +1,756 @@
+# -*- coding: utf-8 -*-
+import calendar
+import collections
+import errno
+import fcntl
+import gzip
+import heapq
+import logging
+import mmap
+import os
+import re
+import select
+import shutil
+import struct
+import threading
+import time
+
+from .ratelimit import TokenBucket
+from .settings import SETTINGS_MANAGER
+
+
+log = logging.getLogger(__name__)
+
+# lines start with the local time in this format and its offset from UTC,
+# "2026-10-18 12:00:00+0300": local times repeat when DST ends, so lines are
+# compared by seconds since the epoch. Logs daemons write themselves may
+# have the local time alone.
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+KEY_RE = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:[+-]\d{4})?')
+# (seconds since the epoch, offset) entries of the sparse index
+INDEX_ENTRY = struct.Struct('<dQ')
+INDEX_SUFFIX = '.idx'
+# bytes of a segment given to the reader at once
+CHUNK_SIZE = 1 << 20
+# bytes tail reads at once from the end of a segment
+TAIL_BLOCK = 65536
+
+
+def get_log_path(name):
+    """
+    Returns the file stdout and stderr of the daemon are written to or None
+    if they are discarded.
+    """
+    directory = SETTINGS_MANAGER['logs']['dir']
+    if not directory:
+        return None
+    return os.path.join(directory, name + '.log')
+
+
+class LogFile(object):
+    """
+    Appends to the active segment path. Every INDEX_INTERVAL bytes the time
+    and offset of a write go to the sparse index path.idx, so reads of
+    a time range don't scan the segment. At max_size bytes or after max_age
+    seconds (0 never) the segment is rotated to path.<milliseconds> with its
+    index. Rotated segments older than the newest hot ones are compressed,
+    the newest segments of them are kept.
+    """
+    INDEX_INTERVAL = 65536
+
+    def __init__(self, path, max_size, max_age=0, segments=5, hot=1):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.segments = segments
+        self.hot = hot
+        self.fd = None
+        self.index_fd = None
+        self.size = 0
+        # offset of the last index entry
+        self.indexed = None
+        self.opened = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0640)
+        self.size = os.fstat(self.fd).st_size
+        self.index_fd = os.open(self.path + INDEX_SUFFIX, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0640)
+        index_size = os.fstat(self.index_fd).st_size
+        self.indexed = None
+        if index_size >= INDEX_ENTRY.size:
+            os.lseek(self.index_fd, index_size - index_size % INDEX_ENTRY.size - INDEX_ENTRY.size, os.SEEK_SET)
+            _, self.indexed = INDEX_ENTRY.unpack(os.read(self.index_fd, INDEX_ENTRY.size))
+        self.opened = time.time()
+
+    def rotate(self):
+        self.close()
+        if not self.segments:
+            os.remove(self.path)
+            _remove(self.path + INDEX_SUFFIX)
+            return
+        milliseconds = int(time.time() * 1000)
+        while os.path.exists('%s.%d' % (self.path, milliseconds)) or \
+                os.path.exists('%s.%d.gz' % (self.path, milliseconds)):
+            milliseconds += 1
+        segment = '%s.%d' % (self.path, milliseconds)
+        os.rename(self.path, segment)
+        if os.path.exists(self.path + INDEX_SUFFIX):
+            os.rename(self.path + INDEX_SUFFIX, segment + INDEX_SUFFIX)
+
+        rotated = [segment for segment in get_segments(self.path) if segment != self.path]
+        for segment in rotated[:-self.segments]:
+            _remove(segment)
+            _remove(segment + INDEX_SUFFIX)
+        for segment in rotated[-self.segments:len(rotated) - self.hot]:
+            if not segment.endswith('.gz'):
+                # the loop of daemon-runtime doesn't wait for it
+                thread = threading.Thread(target=compress_segment, args=(segment,))
+                thread.daemon = True
+                thread.start()
+
+    def write(self, data, timestamp=None):
+        """
+        Appends data, timestamp is the time of its first line.
+        """
+        if self.fd is None:
+            self._open()
+        else:
+            # daemons started by daemon-tools --direct append to it too
+            self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        if self.size and (self.size + len(data) > self.max_size or
+                          self.max_age and time.time() - self.opened >= self.max_age):
+            self.rotate()
+            self._open()
+        if timestamp is not None and (self.indexed is None or self.size - self.indexed >= self.INDEX_INTERVAL):
+            os.write(self.index_fd, INDEX_ENTRY.pack(timestamp, self.size))
+            self.indexed = self.size
+        os.write(self.fd, data)
+        self.size += len(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            os.close(self.index_fd)
+            self.fd = None
+            self.index_fd = None
+
+
+class DaemonLog(object):
+    """
+    Output of a daemon read by the pump. Lines are kept until flush(), lines
+    over rate per second (burst at once) are dropped and counted in the log.
+    """
+    def __init__(self, pump, log_file, rate=0, burst=0):
+        self.pump = pump
+        self.log_file = log_file
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.lines = []
+        # time of the first line kept
+        self.first_time = None
+        self.dropped = 0
+
+    def attach(self, stream, pipe):
+        """
+        Passes the pipe to the pump, which closes it at EOF.
+        """
+        self.pump.add(self, stream, pipe)
+
+    def write(self, stream, data):
+        self.pump.write(self, stream, data)
+
+    def add_line(self, stream, line, now, timestamp):
+        if self.limiter is not None and not self.limiter.acquire(now):
+            self.dropped += 1
+            return
+        if not self.lines:
+            self.first_time = now
+        if self.dropped:
+            self.lines.append('%s daemon-runtime: %s lines dropped\n' % (timestamp, self.dropped))
+            self.dropped = 0
+        self.lines.append('%s %s: %s\n' % (timestamp, stream, line))
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = ''.join(self.lines)
+        self.lines = []
+        try:
+            self.log_file.write(data, self.first_time)
+        except (IOError, OSError), e:
+            log.error('cannot write log %s: %s', self.log_file.path, e)
+
+
+class LogPump(object):
+    """
+    Reads stdout and stderr pipes of daemons without blocking and writes
+    their lines to log files of the daemons, once per wakeup. The pump has
+    its own epoll and thread: the loop of daemon-runtime waits for control
+    commands which start and stop daemons, and pipes must be drained
+    meanwhile or daemons block writing to them. Pipes are added from any
+    thread.
+    """
+    READ_SIZE = 65536
+    # longer lines are split
+    MAX_LINE = 65536
+
+    def __init__(self, max_size, max_age=0, segments=5, hot=1, rate=0, burst=0):
+        self.epoll = select.epoll()
+        self.max_size = max_size
+        self.max_age = max_age
+        self.segments = segments
+        self.hot = hot
+        self.rate = rate
+        self.burst = burst
+        self.logs = {}
+        # fd: [daemon log, stream, incomplete line]
+        self.pipes = {}
+        self.lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.epoll.register(self._wakeup_read, select.EPOLLIN)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-pump')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self.poll()
+            except Exception, e:
+                log.exception('log pump failed: %s', e)
+                time.sleep(1)
+
+    def poll(self, timeout=None):
+        """
+        Reads the pipes which are ready within timeout seconds (forever if
+        None) and writes their lines.
+        """
+        try:
+            events = self.epoll.poll(-1 if timeout is None else timeout)
+        except IOError, err:
+            if err.errno != errno.EINTR:
+                raise
+            events = []
+        for fd, _ in events:
+            if fd == self._wakeup_read:
+                try:
+                    os.read(fd, 4096)
+                except OSError:
+                    pass
+            else:
+                self.read(fd)
+        if events:
+            self.flush()
+
+    def get_log(self, name):
+        with self.lock:
+            daemon_log = self.logs.get(name)
+            if daemon_log is None:
+                log_file = LogFile(get_log_path(name), self.max_size, self.max_age, self.segments, self.hot)
+                daemon_log = self.logs[name] = DaemonLog(self, log_file, self.rate, self.burst)
+            return daemon_log
+
+    def remove(self, name):
+        with self.lock:
+            daemon_log = self.logs.pop(name, None)
+            if daemon_log is not None:
+                daemon_log.flush()
+                daemon_log.log_file.close()
+
+    def add(self, daemon_log, stream, pipe):
+        """
+        Takes over the pipe file, it is closed here.
+        """
+        fd = os.dup(pipe.fileno())
+        pipe.close()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        with self.lock:
+            self.pipes[fd] = [daemon_log, stream, '']
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def write(self, daemon_log, stream, data):
+        now = time.time()
+        timestamp = get_key(now)
+        with self.lock:
+            for line in data.splitlines():
+                daemon_log.add_line(stream, line, now, timestamp)
+
+    def read(self, fd):
+        chunks = []
+        closed = False
+        while True:
+            try:
+                chunk = os.read(fd, self.READ_SIZE)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno != errno.EAGAIN:
+                    closed = True
+                break
+            if not chunk:
+                closed = True
+                break
+            chunks.append(chunk)
+
+        now = time.time()
+        timestamp = get_key(now)
+        with self.lock:
+            entry = self.pipes.get(fd)
+            if entry is None:
+                return
+            daemon_log, stream, rest = entry
+            lines = (rest + ''.join(chunks)).split('\n')
+            rest = lines.pop()
+            if closed and rest:
+                lines.append(rest)
+                rest = ''
+            while len(rest) > self.MAX_LINE:
+                lines.append(rest[:self.MAX_LINE])
+                rest = rest[self.MAX_LINE:]
+            for line in lines:
+                daemon_log.add_line(stream, line, now, timestamp)
+            entry[2] = rest
+            if closed:
+                del self.pipes[fd]
+        if closed:
+            # every process holding the pipe has closed it
+            self.epoll.unregister(fd)
+            os.close(fd)
+
+    def flush(self):
+        with self.lock:
+            # daemons removed from configs may still write to their pipes
+            daemon_logs = set(self.logs.itervalues())
+            daemon_logs.update(entry[0] for entry in self.pipes.itervalues())
+            for daemon_log in daemon_logs:
+                daemon_log.flush()
+
+    def close(self):
+        if self._thread is not None:
+            self._closed = True
+            os.write(self._wakeup_write, '\0')
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self.lock:
+            for fd in self.pipes.keys():
+                self.epoll.unregister(fd)
+                os.close(fd)
+            self.pipes = {}
+            for daemon_log in self.logs.itervalues():
+                daemon_log.log_file.close()
+        self.epoll.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def compress_segment(segment):
+    """
+    Replaces a rotated segment with segment.gz, its index isn't needed
+    anymore: compressed segments are read whole.
+    """
+    tmp_path = segment + '.gz.tmp'
+    try:
+        with open(segment, 'rb') as segment_file:
+            compressed = gzip.open(tmp_path, 'wb')
+            try:
+                shutil.copyfileobj(segment_file, compressed, CHUNK_SIZE)
+            finally:
+                compressed.close()
+        # segments are ordered by the time of their last write
+        st = os.stat(segment)
+        os.utime(tmp_path, (st.st_atime, st.st_mtime))
+        os.rename(tmp_path, segment + '.gz')
+        _remove(segment)
+        _remove(segment + INDEX_SUFFIX)
+    except (IOError, OSError), e:
+        log.error('cannot compress log segment %s: %s', segment, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_segments(path):
+    """
+    Returns segments of the log the oldest first: rotated ones ordered by
+    modification time, then path itself. Files rotated by logrotate
+    (path.1, path.2.gz) are segments as well.
+    """
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + '.'
+    try:
+        names = set(os.listdir(directory))
+    except OSError:
+        return []
+    segments = []
+    for name in names:
+        if not name.startswith(prefix) or name.endswith(INDEX_SUFFIX) or name.endswith('.tmp'):
+            continue
+        if name.endswith('.gz') and name[:-3] in names:
+            # compressed right now
+            continue
+        segment = os.path.join(directory, name)
+        try:
+            segments.append((os.stat(segment).st_mtime, segment))
+        except OSError:
+            continue
+    segments = [segment for _, segment in sorted(segments)]
+    if os.path.basename(path) in names:
+        segments.append(path)
+    return segments
+
+
+def get_key(timestamp):
+    """
+    Returns the time lines written at timestamp start with.
+    """
+    local = time.localtime(timestamp)
+    offset = (calendar.timegm(local) - int(timestamp)) // 60
+    return '%s%s%02d%02d' % (time.strftime(TIME_FORMAT, local), '-' if offset < 0 else '+',
+                             abs(offset) // 60, abs(offset) % 60)
+
+
+# key: seconds since the epoch, lines of a second share the key
+_key_times = {}
+
+
+def get_time(key):
+    """
+    Returns seconds since the epoch of a time key, a key without the offset
+    is the local time.
+    """
+    seconds = _key_times.get(key)
+    if seconds is None:
+        parsed = (int(key[0:4]), int(key[5:7]), int(key[8:10]), int(key[11:13]), int(key[14:16]), int(key[17:19]))
+        if len(key) > 19:
+            offset = int(key[20:22]) * 3600 + int(key[22:24]) * 60
+            seconds = calendar.timegm(parsed + (0, 0, 0)) - (offset if key[19] == '+' else -offset)
+        else:
+            seconds = int(time.mktime(parsed + (0, 0, -1)))
+        if len(_key_times) >= 65536:
+            _key_times.clear()
+        _key_times[key] = seconds
+    return seconds
+
+
+def parse_time(value, now=None):
+    """
+    Parses "30s", "10m", "2h" or "1d" ago, "YYYY-MM-DD HH:MM[:SS]" or
+    "HH:MM[:SS]" of today. Returns seconds since the epoch.
+    """
+    now = now or time.time()
+    value = value.strip()
+    match = re.match(r'(\d+)([smhd])$', value)
+    if match:
+        return now - int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%H:%M:%S', '%H:%M'):
+        try:
+            parsed = time.strptime(value, time_format)
+        except ValueError:
+            continue
+        if not time_format.startswith('%Y'):
+            today = time.localtime(now)
+            parsed = today[:3] + parsed[3:6] + today[6:]
+        return time.mktime(parsed[:8] + (-1,))
+    raise ValueError('invalid time %r, "10m" or "YYYY-MM-DD HH:MM:SS" expected' % (value,))
+
+
+def _search_index(segment, size, timestamp):
+    """
+    Returns offsets of the index entries around the first line at timestamp
+    or later, (0, size) if the segment has no index. The index is mapped and
+    searched as well, only a few of its pages are read.
+    """
+    try:
+        with open(segment + INDEX_SUFFIX, 'rb') as index_file:
+            count = os.fstat(index_file.fileno()).st_size // INDEX_ENTRY.size
+            if not count:
+                return 0, size
+            index = mmap.mmap(index_file.fileno(), count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+    except (IOError, OSError, mmap.error):
+        return 0, size
+    try:
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        start = INDEX_ENTRY.unpack_from(index, (low - 1) * INDEX_ENTRY.size)[1] if low else 0
+        end = INDEX_ENTRY.unpack_from(index, low * INDEX_ENTRY.size)[1] if low < count else size
+    finally:
+        index.close()
+    # entries of a crashed write may point past the data
+    return min(start, size), min(end, size)
+
+
+def _get_line_key(data, position, end):
+    """
+    Returns the time key and the start of the first line at position or
+    after it which begins with a time, (None, end) if there is none.
+    """
+    while position < end:
+        match = KEY_RE.match(data, position, end)
+        if match:
+            return match.group(), position
+        newline = data.find('\n', position, end)
+        if newline < 0:
+            break
+        position = newline + 1
+    return None, end
+
+
+def _find(data, timestamp, low, high, after=False):
+    """
+    Returns the start of the first line from low to high written in the
+    second timestamp or later (only later if after). Lines without a time
+    belong to the line before them.
+    """
+    end = high
+    while low < high:
+        middle = (low + high) // 2
+        line_start = 0 if middle == 0 else data.find('\n', middle - 1, end) + 1 or end
+        line_key, _ = _get_line_key(data, line_start, end)
+        seconds = get_time(line_key) if line_key is not None else None
+        if seconds is None or (seconds > timestamp if after else seconds >= timestamp):
+            high = middle
+        else:
+            low = middle + 1
+    position = 0 if low == 0 else data.find('\n', low - 1, end) + 1 or end
+    return _get_line_key(data, position, end)[1]
+
+
+def _get_range(data, segment, since, until):
+    """
+    Returns the offsets of lines from since to until in the mapped segment.
+    The index narrows the search to an interval between two entries.
+    """
+    size = len(data)
+    start, end = 0, size
+    if since is not None:
+        low, high = _search_index(segment, size, int(since))
+        start = _find(data, int(since), low, high)
+    if until is not None:
+        low, high = _search_index(segment, size, int(until) + 1)
+        end = _find(data, int(until), max(low, start), max(high, start), after=True)
+    return start, max(start, end)
+
+
+def _read_compressed(segment, since, until):
+    with gzip.open(segment, 'rb') as segment_file:
+        included = since is None
+        for line in segment_file:
+            match = KEY_RE.match(line)
+            if match:
+                seconds = get_time(match.group())
+                if until is not None and seconds > int(until):
+                    break
+                included = since is None or seconds >= int(since)
+            if included:
+                yield line
+
+
+def read_log(path, since=None, until=None):
+    """
+    Yields the log from since to until (seconds since the epoch, both may be
+    None) in chunks. Segments out of the range are skipped by their times
+    and uncompressed ones are mapped and searched by their index and times
+    of lines, so a range of a big log is read without scanning it. Chunks of
+    mapped segments are buffers of the mapping.
+    """
+    for segment in get_segments(path):
+        try:
+            if since is not None and os.stat(segment).st_mtime < int(since):
+                # written before the range
+                continue
+            if segment.endswith('.gz'):
+                for line in _read_compressed(segment, since, until):
+                    yield line
+                continue
+            with open(segment, 'rb') as segment_file:
+                size = os.fstat(segment_file.fileno()).st_size
+                if not size:
+                    continue
+                data = mmap.mmap(segment_file.fileno(), size, access=mmap.ACCESS_READ)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            # removed by rotation in the meantime
+            continue
+        try:
+            key, _ = _get_line_key(data, 0, size)
+            if until is not None and key is not None and get_time(key) > int(until):
+                # written after the range, so are the rest
+                break
+            start, end = _get_range(data, segment, since, until)
+            for position in xrange(start, end, CHUNK_SIZE):
+                yield buffer(data, position, min(CHUNK_SIZE, end - position))
+        finally:
+            data.close()
+
+
+def read_records(path, since=None, until=None):
+    """
+    Yields (seconds since the epoch, line) of the log from since to until,
+    lines without a time get the time of the line before them.
+    """
+    def get_lines():
+        rest = ''
+        for chunk in read_log(path, since, until):
+            lines = (rest + str(chunk)).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if rest:
+            yield rest + '\n'
+
+    return get_records(get_lines())
+
+
+def get_records(lines):
+    seconds = 0
+    for line in lines:
+        match = KEY_RE.match(line)
+        if match:
+            seconds = get_time(match.group())
+        yield seconds, line
+
+
+def merge_logs(paths, since=None, until=None):
+    """
+    Yields (seconds since the epoch, number of the log, line) of lines from
+    since to until of many logs in the order of time.
+    """
+    def records(number, path):
+        for key, line in read_records(path, since, until):
+            yield key, number, line
+
+    return heapq.merge(*[records(number, path) for number, path in enumerate(paths)])
+
+
+def merge_tails(paths, number):
+    """
+    Returns (seconds since the epoch, number of the log, line) of the last
+    number lines of many logs in the order of time.
+    """
+    def records(log_number, path):
+        for key, line in get_records(tail(path, number)):
+            yield key, log_number, line
+
+    lines = list(heapq.merge(*[records(log_number, path) for log_number, path in enumerate(paths)]))
+    return lines[-number:] if number > 0 else []
+
+
+def _tail_segment(segment, number):
+    """
+    Returns the last number lines of an uncompressed segment, read in blocks
+    backwards from its end until they are there.
+    """
+    with open(segment, 'rb') as segment_file:
+        position = os.fstat(segment_file.fileno()).st_size
+        blocks = []
+        newlines = 0
+        while position > 0 and newlines <= number:
+            size = min(TAIL_BLOCK, position)
+            position -= size
+            segment_file.seek(position)
+            block = segment_file.read(size)
+            blocks.append(block)
+            newlines += block.count('\n')
+    lines = ''.join(reversed(blocks)).splitlines(True)
+    if position > 0:
+        # the start of the first line is in the block before
+        lines = lines[1:]
+    return lines[-number:]
+
+
+def _tail_compressed(segment, number):
+    with gzip.open(segment, 'rb') as segment_file:
+        return list(collections.deque(segment_file, number))
+
+
+def tail(path, number):
+    """
+    Returns the last number lines of the log, earlier ones are taken from
+    rotated segments if the active one is shorter. Only the end of the log
+    is read.
+    """
+    lines = []
+    for segment in reversed(get_segments(path)):
+        if len(lines) >= number:
+            break
+        try:
+            if segment.endswith('.gz'):
+                lines = _tail_compressed(segment, number - len(lines)) + lines
+            else:
+                lines = _tail_segment(segment, number - len(lines)) + lines
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+    return lines
+
+
+def _read_rest(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, CHUNK_SIZE)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def follow(path, write, interval=0.5):
+    """
+    Calls write with what is appended to the log until it's interrupted,
+    a rotated log is followed by the new file. The file is read with
+    os.read: EOF of a stdio file is sticky, so later reads of it would
+    miss what is appended.
+    """
+    fd = None
+    # only what is written after the start is shown, a new file is read whole
+    from_end = True
+    try:
+        while True:
+            if fd is None:
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    time.sleep(interval)
+                    from_end = False
+                    continue
+                if from_end:
+                    os.lseek(fd, 0, os.SEEK_END)
+            data = _read_rest(fd)
+            if data:
+                write(data)
+                continue
+            time.sleep(interval)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_ino != os.fstat(fd).st_ino or st.st_size < os.lseek(fd, 0, os.SEEK_CUR):
+                # rotated: the rest of the old file, then the new one from its start
+                write(_read_rest(fd))
+                os.close(fd)
+                fd = None
+                from_end = False
+    finally:
+        if fd is not None:
+            os.close(fd)
@@ -1,52 +1,187 @@
 # -*- coding: utf-8 -*-
 import atexit
+import marshal
 import stat
 import time
 import logging
-import shlex
-import subprocess
 import os
-import yaml
+import socket
 import sys
 
-from .daemon import Daemon
+from .basedaemon import Daemon
 from .settings import SETTINGS_MANAGER
 
 
 log = logging.getLogger(__name__)
 
-class Manager(object):
-    def __init__(self, conf_path):
-        configs_path = conf_path + '/conf-enabled'
-        configs = os.listdir(configs_path)
+class ConfigStore(object):
+    """
+    Parsed configs keyed by path, mtime and size. The store is kept on disk
+    with marshal, so yaml parses a config only after the file changes.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.changed = False
+        self._read()
+
+    def _read(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                version, entries = marshal.load(cache_file)
+        except (IOError, EOFError, ValueError, TypeError), e:
+            log.debug('config cache %s is not loaded: %s', self.cache_path, e)
+            return
+        if version == self.VERSION:
+            self.entries = entries
+
+    def save(self):
+        if not self.cache_path or not self.changed:
+            return
+        tmp_path = '%s.%s' % (self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                marshal.dump((self.VERSION, self.entries), cache_file)
+            os.rename(tmp_path, self.cache_path)
+            self.changed = False
+        except (IOError, OSError, ValueError), e:
+            # e.g. daemon-tools run by a user who can't write the cache
+            log.debug('config cache %s is not saved: %s', self.cache_path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-        hooks_path = conf_path + '/hooks'
+    @staticmethod
+    def get_signature(path):
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
 
-        self.daemons = {}
-        for daemon_name in configs:
-            full_config_path = configs_path + '/' + daemon_name
+    def get(self, path, signature=None):
+        if signature is None:
+            signature = self.get_signature(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+
+        config = DaemonConfiguration.load(path)
+        self.entries[path] = (signature, config)
+        self.changed = True
+        return config
+
+    def prune(self, paths):
+        for path in set(self.entries) - set(paths):
+            del self.entries[path]
+            self.changed = True
 
-            daemon = DaemonConfiguration.parse(full_config_path)
-            pre_start_script = hooks_path + '/pre-start/' + daemon_name
-            if os.path.exists(pre_start_script):
-                self._make_executable(pre_start_script)
-                daemon.pre_start_script = pre_start_script
 
-            pre_stop_script = hooks_path + '/pre-stop/' + daemon_name
-            if os.path.exists(pre_stop_script):
-                self._make_executable(pre_start_script)
-                daemon.pre_stop_script = pre_start_script
+class Manager(object):
+    """
+    Daemons configured in conf_path. If names are given only these daemons
+    are loaded, which is all daemon-tools needs for a single daemon.
+    """
+    def __init__(self, conf_path, store=None, names=None):
+        from .cgroups import get_root
+
+        self.configs_path = conf_path + '/conf-enabled'
+        self.hooks_path = conf_path + '/hooks'
+        if store is None:
+            store = ConfigStore(SETTINGS_MANAGER.get('cache'))
+        self.store = store
+        self.names = names
+        self.cgroup = get_root(SETTINGS_MANAGER.get('cgroup'))
+        # reads output of daemons in daemon-runtime, see set_log_pump()
+        self.log_pump = None
 
-            post_stop_script = hooks_path + '/post-stop/' + daemon_name
-            if os.path.exists(post_stop_script):
-                self._make_executable(post_stop_script)
-                daemon.pre_stop_script = post_stop_script
+        self.daemons = {}
+        self.signatures = {}
+        self.reload_configs()
+
+    def reload_configs(self):
+        """
+        Rebuilds only daemons whose config files have changed, the other
+        daemons keep their objects and runtime state.
+        Returns (added, removed, changed) sets of daemon names.
+        """
+        from .logs import get_log_path
+
+        if self.names is None:
+            daemon_names = os.listdir(self.configs_path)
+        else:
+            daemon_names = [daemon_name for daemon_name in self.names if '/' not in daemon_name]
 
+        signatures = {}
+        for daemon_name in daemon_names:
+            try:
+                signatures[daemon_name] = ConfigStore.get_signature(self.configs_path + '/' + daemon_name)
+            except OSError:
+                continue
+
+        added = set(signatures) - set(self.daemons)
+        removed = set(self.daemons) - set(signatures)
+        changed = set(daemon_name for daemon_name in signatures
+                      if daemon_name in self.daemons and self.signatures[daemon_name] != signatures[daemon_name])
+
+        for daemon_name in removed:
+            self.daemons[daemon_name].close_sockets()
+            del self.daemons[daemon_name]
+            if self.log_pump is not None:
+                self.log_pump.remove(daemon_name)
+            del self.signatures[daemon_name]
+
+        for daemon_name in added | changed:
+            config_path = self.configs_path + '/' + daemon_name
+            config = self.store.get(config_path, signatures[daemon_name])
+            daemon = DaemonConfiguration.from_config(config)
+            if self.cgroup is not None:
+                daemon.cgroup = self.cgroup.child(daemon_name)
+            daemon.log_path = get_log_path(daemon_name)
+            if self.log_pump is not None:
+                daemon.output = self.log_pump.get_log(daemon_name)
+            previous = self.daemons.get(daemon_name)
+            # a changed config gives a failed daemon another chance
+            if previous is not None and not previous.failed:
+                daemon.crash_number = previous.crash_number
+                daemon.respawn_time = previous.respawn_time
+            if previous is not None:
+                if previous.listen == daemon.listen:
+                    # connections keep waiting in the same sockets
+                    daemon.sockets = previous.sockets
+                else:
+                    previous.close_sockets()
             self.daemons[daemon_name] = daemon
+            self.signatures[daemon_name] = signatures[daemon_name]
+
+        for daemon_name, daemon in self.daemons.iteritems():
+            self._set_hooks(daemon_name, daemon)
+
+        if self.names is None:
+            # other entries are still valid when only some daemons are loaded
+            self.store.prune([self.configs_path + '/' + daemon_name for daemon_name in signatures])
+        self.store.save()
+        return added, removed, changed
+
+    def set_log_pump(self, log_pump):
+        self.log_pump = log_pump
+        for daemon_name, daemon in self.daemons.iteritems():
+            daemon.output = log_pump.get_log(daemon_name)
 
-    def _make_executable(self, file_path):
-        st = os.stat(file_path)
-        os.chmod(file_path, st.st_mode | stat.S_IEXEC)
+    def _set_hooks(self, daemon_name, daemon):
+        daemon.pre_start_script = self._get_hook('pre-start', daemon_name)
+        daemon.pre_stop_script = self._get_hook('pre-stop', daemon_name)
+        daemon.post_stop_script = self._get_hook('post-stop', daemon_name)
+
+    def _get_hook(self, hook, daemon_name):
+        script = self.hooks_path + '/' + hook + '/' + daemon_name
+        try:
+            st = os.stat(script)
+        except OSError:
+            return None
+        if not st.st_mode & stat.S_IEXEC:
+            os.chmod(script, st.st_mode | stat.S_IEXEC)
+        return script
 
     def get(self, name):
         return self.daemons[name]
@@ -80,7 +215,14 @@ class DaemonConfiguration(Daemon):
                  respawn=False,
                  respawn_limit=0,
                  respawn_interval=0,
+                 respawn_max_interval=SETTINGS_MANAGER['defaults']['respawn']['max_interval'],
+                 respawn_jitter=SETTINGS_MANAGER['defaults']['respawn']['jitter'],
+                 respawn_healthy=SETTINGS_MANAGER['defaults']['respawn']['healthy'],
                  expect=None,
+                 notify=SETTINGS_MANAGER['defaults']['notify'],
+                 placement=None,
+                 listen=None,
+                 log_files=None,
 
                  start_timeout=SETTINGS_MANAGER['defaults']['timeouts']['start'],
                  stop_timeout=SETTINGS_MANAGER['defaults']['timeouts']['stop'],
@@ -95,17 +237,33 @@ class DaemonConfiguration(Daemon):
         self.respawn = respawn
         self.respawn_limit = respawn_limit
         self.respawn_interval = respawn_interval
+        self.respawn_max_interval = respawn_max_interval
+        self.respawn_jitter = respawn_jitter
+        self.respawn_healthy = respawn_healthy
         self.expect = expect
+        self.notify = notify
+        self.placement = placement
+        # (name, address) of sockets passed to the daemon, see get_sockets()
+        self.listen = listen or []
+        self.sockets = None
+        # stdout and stderr are read by the LogPump of daemon-runtime into
+        # output, or written to log_path by the daemon itself
+        self.log_path = None
+        self.output = None
+        # files the daemon writes itself, e.g. stdout and stderr of Daemon, for daemon-tools logs
+        self.log_files = log_files or []
+        # crashes in a row, forgotten after respawn_healthy seconds of uptime
         self.crash_number = 0
+        # the last start by daemon-runtime
         self.respawn_time = time.time()
+        # crashed more than respawn_limit times, not respawned until started again
+        self.failed = False
         self.start_timeout = start_timeout
 
         self.pre_start_script = None
         self.pre_stop_script = None
         self.post_stop_script = None
 
-        self._pid = None
-
         log = logging.getLogger()
         super(DaemonConfiguration, self).__init__(
             log, pidfile, user,
@@ -115,59 +273,222 @@ class DaemonConfiguration(Daemon):
             reload_signal=reload_signal
         )
 
-    def _prepare_run(self):
+    def _prepare_run(self, cgroup=None, env=None, sockets=None):
+        if cgroup is not None:
+            cgroup.add()
+        if sockets:
+            from .sockets import pass_sockets
+
+            # env is what subprocess executes the command with
+            pass_sockets(sockets, [name for name, _ in self.listen], env)
+        if self.placement is not None:
+            # before the user is changed: a higher priority needs root
+            self.placement.apply()
         if self.user:
             self._set_user()
         os.chdir("/")
         os.setsid()
         os.umask(0)
 
-    @property
-    def pid(self):
-        pid = super(DaemonConfiguration, self).pid
-        if pid != self._pid:
-            self.crash_number = 0
-        return pid
-
-    def call(self, command, expect=None, block=False):
-        args = shlex.split(command)
-        popen = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=self._prepare_run)
-        popen_process = self.manager.get(popen.pid)
-        result = ''
-
-        if not popen_process:
-            raise DaemonConfigurationError('cannot run process %s' % command)
+    def get_sockets(self):
+        """
+        Binds sockets of listen once. daemon-runtime keeps them open, so
+        connections wait in their backlog while the daemon restarts instead
+        of being refused.
+        """
+        if self.sockets is None:
+            from .sockets import bind_socket
 
-        if block:
-            result = popen.stdout.read()
-
-        if not expect:
-            return popen.pid, result
+            sockets = []
+            try:
+                for _, address in self.listen:
+                    sockets.append(bind_socket(address))
+            except socket.error, e:
+                for sock in sockets:
+                    sock.close()
+                raise DaemonConfigurationError('cannot listen on %s: %s' % (address, e))
+            self.sockets = sockets
+        return self.sockets
+
+    def close_sockets(self):
+        if self.sockets:
+            for sock in self.sockets:
+                sock.close()
+        self.sockets = None
+
+    def get_respawn_delay(self):
+        """
+        Returns seconds from the last start to a restart after crash_number
+        crashes in a row: respawn_interval doubled with every crash up to
+        respawn_max_interval, less up to respawn_jitter of it at random.
+        """
+        import random
+
+        delay = self.respawn_interval * 2 ** min(max(self.crash_number - 1, 0), 32)
+        delay = min(delay, self.respawn_max_interval)
+        return delay * (1 - self.respawn_jitter * random.random())
+
+    def call(self, command, expect=None, block=False, cgroup=None, sockets=None):
+        import functools
+        import shlex
+        import subprocess
+        from .notify import NOTIFY_SOCKET, NotifySocket
+        from .sockets import LISTEN_FDNAMES, LISTEN_FDS, LISTEN_PID
+        from .syscalls import waited_children, waited_lock
+
+        # a notify socket of daemon-runtime's own supervisor is not for them
+        env = dict(os.environ)
+        env.pop(NOTIFY_SOCKET, None)
+        for key in (LISTEN_PID, LISTEN_FDS, LISTEN_FDNAMES):
+            env.pop(key, None)
+        notify_socket = None
+        if expect and self.notify:
+            notify_socket = NotifySocket(self.user)
+            env[NOTIFY_SOCKET] = notify_socket.path
+
+        stdout = stderr = subprocess.PIPE
+        log_file = None
+        if self.output is None:
+            # nobody reads pipes of daemon-tools after it exits
+            log_file = self._open_log()
+            stderr = log_file
+            if not block:
+                stdout = log_file
+
+        popen = None
+        try:
+            args = shlex.split(command)
+            try:
+                # the exit status of a blocking call is collected by popen,
+                # the reaper of daemon-runtime leaves it alone
+                with waited_lock:
+                    popen = subprocess.Popen(args, stdout=stdout, stderr=stderr,
+                                             preexec_fn=functools.partial(self._prepare_run, cgroup, env, sockets),
+                                             env=env)
+                    if block:
+                        waited_children.add(popen.pid)
+            finally:
+                if log_file is not None:
+                    log_file.close()
+            popen_process = self.manager.get(popen.pid)
+            result = ''
+
+            if not popen_process:
+                raise DaemonConfigurationError('cannot run process %s' % command)
+
+            if block:
+                # stderr is read too, a script which fills its pipe can't hang
+                result, errors = popen.communicate()
+                if errors:
+                    self.output.write('stderr', errors)
+                if popen.returncode:
+                    raise DaemonConfigurationError('%s exited with status %s' % (command, popen.returncode))
+            elif self.output is not None:
+                self.output.attach('stdout', popen.stdout)
+                self.output.attach('stderr', popen.stderr)
+
+            if not expect:
+                return popen.pid, result
+
+            if notify_socket:
+                child_pid = self._wait_ready(notify_socket)
+                if child_pid:
+                    log.debug('child_pid %s is ready', child_pid)
+                    return child_pid, result
+            else:
+                # signals (SIGCHLD in daemon-runtime) cut time.sleep short
+                deadline = time.time() + self.start_timeout
+                while True:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    time.sleep(remaining)
+        finally:
+            if notify_socket:
+                notify_socket.close()
+            if block and popen is not None:
+                with waited_lock:
+                    waited_children.discard(popen.pid)
+
+        return self._find_child_pid(popen.pid), result
+
+    def _open_log(self):
+        if self.log_path:
+            try:
+                return open(self.log_path, 'a')
+            except IOError, e:
+                log.debug('log %s is not opened: %s', self.log_path, e)
+        return open(os.devnull, 'w')
+
+    def _wait_ready(self, notify_socket):
+        """
+        Returns the main pid reported by the daemon or None if it hasn't
+        reported it in start_timeout.
+        """
+        states = notify_socket.wait(self.start_timeout)
+        if states.get('READY') != '1':
+            log.debug('%s has not reported readiness in %s seconds', self.run_script, self.start_timeout)
+            return None
+        try:
+            main_pid = int(states.get('MAINPID', ''))
+        except ValueError:
+            return None
+        if main_pid > 0 and self.manager.is_running(main_pid):
+            return main_pid
+        return None
+
+    def _find_child_pid(self, popen_pid):
+        """
+        Looks for the forked process among orphans. In daemon-runtime, which
+        is a child subreaper, they are its own children instead of init's,
+        next to the started process itself.
+        """
+        from .syscalls import is_child_subreaper
+
+        if is_child_subreaper():
+            reaper_pid = os.getpid()
+            table = self.manager.get_children_table(reaper_pid)
         else:
-            time.sleep(self.start_timeout)
-            processes = self.manager.find(self.get_grepline())
-            child_pid = None
-            for process in processes:
-                if not child_pid and process.parent_pid == 1:
-                    child_pid = process.pid
-                elif child_pid and process.parent_pid == 1:
-                    raise DaemonConfigurationError('two forked proceesses were found: %s and %s' %
-                                                       (child_pid, process.pid))
-            log.debug('child_pid %s', child_pid)
-            return child_pid, result
+            reaper_pid = 1
+            table = None
+
+        processes = self.manager.find(self.get_grepline(), table)
+        child_pid = None
+        for process in processes:
+            if process.pid == popen_pid:
+                continue
+            if not child_pid and process.parent_pid == reaper_pid:
+                child_pid = process.pid
+            elif child_pid and process.parent_pid == reaper_pid:
+                raise DaemonConfigurationError('two forked proceesses were found: %s and %s' %
+                                                   (child_pid, process.pid))
+        log.debug('child_pid %s', child_pid)
+        return child_pid
 
     def get_grepline(self):
         return self.run_script.replace(' ', '\x00')
 
     def stop(self, force=False):
         if self.stop_script:
-            child_pid, result = self.call(self.stop_script, block=True)
-            print result,
-        else:
-            super(DaemonConfiguration, self).stop(force)
+            pid = self.pid
+            try:
+                child_pid, result = self.call(self.stop_script, block=True)
+            except DaemonConfigurationError, e:
+                print '%s,' % e,
+            else:
+                print result,
+                # the script usually only sends a signal
+                if not pid or not self.manager.wait([pid], self.stop_timeout):
+                    return True
+                print 'still running (%s) after stop script,' % pid,
+        return super(DaemonConfiguration, self).stop(force)
 
     def run(self):
-        pid, result = self.call(self.run_script, self.expect)
+        # only the daemon joins the cgroup, its hooks are not killed by stop
+        cgroup = None
+        if self.cgroup is not None and self.cgroup.create(self.user):
+            cgroup = self.cgroup
+        pid, result = self.call(self.run_script, self.expect, cgroup=cgroup, sockets=self.get_sockets())
         return pid
 
     def start(self, daemonize=False):
@@ -195,14 +516,29 @@ class DaemonConfiguration(Daemon):
             self.call(self.pre_start_script)
 
     @staticmethod
-    def parse(conf_path):
+    def load(conf_path):
+        # yaml is the slowest import of daemon-tools, most calls are served
+        # from the config cache or by daemon-runtime and don't need it
+        import yaml
+
         config_file = open(conf_path, 'r')
         try:
             config = yaml.load(config_file)
         except yaml.scanner.ScannerError:
             raise AttributeError('invalid config %s' % conf_path)
+        finally:
+            config_file.close()
+
+        if not isinstance(config, dict):
+            raise AttributeError('invalid config %s' % conf_path)
+        return config
 
-        config_file.close()
+    @staticmethod
+    def parse(conf_path):
+        return DaemonConfiguration.from_config(DaemonConfiguration.load(conf_path))
+
+    @staticmethod
+    def from_config(config):
         pidfile = config.get('pid')
         if not pidfile:
             raise AttributeError('pid attribute is not specified')
@@ -216,6 +552,9 @@ class DaemonConfiguration(Daemon):
         respawn_raw = config.get('respawn', SETTINGS_MANAGER['defaults']['respawn'])
         respawn_limit = SETTINGS_MANAGER['defaults']['respawn']['limit']
         respawn_interval = SETTINGS_MANAGER['defaults']['respawn']['interval']
+        respawn_max_interval = SETTINGS_MANAGER['defaults']['respawn']['max_interval']
+        respawn_jitter = SETTINGS_MANAGER['defaults']['respawn']['jitter']
+        respawn_healthy = SETTINGS_MANAGER['defaults']['respawn']['healthy']
         if isinstance(respawn_raw, dict):
             try:
                 respawn_limit = int(respawn_raw.get('limit', respawn_limit))
@@ -227,6 +566,23 @@ class DaemonConfiguration(Daemon):
             except ValueError:
                 raise AttributeError('respawn:interval must be integer')
 
+            try:
+                respawn_max_interval = int(respawn_raw.get('max_interval', respawn_max_interval))
+            except ValueError:
+                raise AttributeError('respawn:max_interval must be integer')
+
+            try:
+                respawn_healthy = int(respawn_raw.get('healthy', respawn_healthy))
+            except ValueError:
+                raise AttributeError('respawn:healthy must be integer')
+
+            try:
+                respawn_jitter = float(respawn_raw.get('jitter', respawn_jitter))
+            except ValueError:
+                raise AttributeError('respawn:jitter must be a number')
+            if not 0 <= respawn_jitter <= 1:
+                raise AttributeError('respawn:jitter must be from 0 to 1')
+
             respawn = respawn_limit > 0
         else:
             respawn = bool(respawn_raw)
@@ -235,14 +591,47 @@ class DaemonConfiguration(Daemon):
         if expect not in ['fork', 'daemon', False]:
             raise AttributeError('expect must be fork or daemon or not exist')
 
+        notify = bool(config.get('notify', SETTINGS_MANAGER['defaults']['notify']))
+
+        from .placement import Placement
+
+        try:
+            placement = Placement.from_config(config)
+        except (ValueError, TypeError), e:
+            raise AttributeError('invalid placement: %s' % e)
+
+        listen = config.get('listen') or []
+        if isinstance(listen, dict):
+            listen = sorted(listen.items())
+        elif isinstance(listen, (list, tuple)):
+            listen = [('unknown', address) for address in listen]
+        else:
+            listen = [('unknown', listen)]
+        if listen:
+            from .sockets import parse_address
+
+        for name, address in listen:
+            try:
+                parse_address(address)
+            except ValueError, e:
+                raise AttributeError(str(e))
+            if ':' in str(name):
+                raise AttributeError('listen name %s contains ":"' % name)
+
+        log_files = config.get('logs') or []
+        if isinstance(log_files, basestring):
+            log_files = [log_files]
+        if not all(isinstance(log_file, basestring) and log_file.startswith('/') for log_file in log_files):
+            raise AttributeError('logs must be absolute paths')
+
         signals = config.get('signals', SETTINGS_MANAGER['defaults']['signals'])
         terminate_signal = signals.get('terminate', SETTINGS_MANAGER['defaults']['signals']['terminate'])
         kill_signal = signals.get('kill', SETTINGS_MANAGER['defaults']['signals']['kill'])
         reload_signal = signals.get('reload', SETTINGS_MANAGER['defaults']['signals']['reload'])
 
         timeouts = config.get('timeouts', SETTINGS_MANAGER['defaults']['timeouts'])
-        start_timeout = signals.get('start', SETTINGS_MANAGER['defaults']['timeouts']['start'])
-        stop_timeout = signals.get('stop', SETTINGS_MANAGER['defaults']['timeouts']['stop'])
+        start_timeout = timeouts.get('start', SETTINGS_MANAGER['defaults']['timeouts']['start'])
+        stop_timeout = timeouts.get('stop', SETTINGS_MANAGER['defaults']['timeouts']['stop'])
 
         return DaemonConfiguration(
             pidfile=pidfile,
@@ -252,7 +641,14 @@ class DaemonConfiguration(Daemon):
             respawn=respawn,
             respawn_limit=respawn_limit,
             respawn_interval=respawn_interval,
+            respawn_max_interval=respawn_max_interval,
+            respawn_jitter=respawn_jitter,
+            respawn_healthy=respawn_healthy,
             expect=expect,
+            notify=notify,
+            placement=placement,
+            listen=listen,
+            log_files=log_files,
 
             start_timeout=start_timeout,
             stop_timeout=stop_timeout,
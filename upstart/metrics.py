@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import os
+import socket
+import threading
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric(object):
+    """
+    A metric family in the Prometheus text format. Every series keeps its
+    rendered lines and the family keeps its text, so a scrape renders only
+    what has changed since the previous one.
+    """
+    KINDS = ('counter', 'gauge', 'summary')
+
+    def __init__(self, registry, name, kind, help, labels=()):
+        if kind not in self.KINDS:
+            raise ValueError('unknown metric type %s' % kind)
+        self.registry = registry
+        self.name = name
+        self.kind = kind
+        self.label_names = tuple(labels)
+        self.header = '# HELP %s %s\n# TYPE %s %s\n' % (name, help.replace('\n', ' '), name, kind)
+        # label values -> [value, rendered lines or None]
+        self.series = OrderedDict()
+        self.text = None
+
+    def _update(self, labels, value):
+        entry = self.series.get(labels)
+        if entry is None:
+            if len(labels) != len(self.label_names):
+                raise ValueError('%s expects labels %s' % (self.name, self.label_names))
+            self.series[labels] = [value, None]
+        elif entry[0] == value:
+            return
+        else:
+            entry[0] = value
+            entry[1] = None
+        self.text = None
+        self.registry.text = None
+
+    def set(self, value, labels=()):
+        with self.registry.lock:
+            self._update(labels, value)
+
+    def inc(self, amount=1, labels=()):
+        with self.registry.lock:
+            entry = self.series.get(labels)
+            self._update(labels, (entry[0] if entry else 0) + amount)
+
+    def observe(self, value, labels=()):
+        """
+        Adds an observation to a summary, which is kept as (sum, count).
+        """
+        with self.registry.lock:
+            entry = self.series.get(labels)
+            total, count = entry[0] if entry else (0.0, 0)
+            self._update(labels, (total + value, count + 1))
+
+    def get(self, labels=()):
+        entry = self.series.get(labels)
+        return entry[0] if entry else None
+
+    def remove(self, labels=()):
+        with self.registry.lock:
+            if self.series.pop(labels, None) is not None:
+                self.text = None
+                self.registry.text = None
+
+    def _render_series(self, labels, value):
+        if labels:
+            label_text = '{%s}' % ','.join('%s="%s"' % (name, escape_label(label))
+                                           for name, label in zip(self.label_names, labels))
+        else:
+            label_text = ''
+        if self.kind == 'summary':
+            return '%s_sum%s %s\n%s_count%s %s\n' % (self.name, label_text, format_value(value[0]),
+                                                       self.name, label_text, format_value(value[1]))
+        return '%s%s %s\n' % (self.name, label_text, format_value(value))
+
+    def render(self):
+        if self.text is None:
+            lines = [self.header]
+            for labels, entry in self.series.iteritems():
+                if entry[1] is None:
+                    entry[1] = self._render_series(labels, entry[0])
+                lines.append(entry[1])
+            self.text = ''.join(lines)
+        return self.text
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.RLock()
+        self.text = None
+
+    def _add(self, name, kind, help, labels):
+        with self.lock:
+            if name in self.metrics:
+                raise ValueError('metric %s is already registered' % name)
+            metric = self.metrics[name] = Metric(self, name, kind, help, labels)
+            self.text = None
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(name, 'counter', help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._add(name, 'gauge', help, labels)
+
+    def summary(self, name, help, labels=()):
+        return self._add(name, 'summary', help, labels)
+
+    def remove_series(self, labels):
+        """
+        Drops the series with these label values from all metrics, e.g.
+        of a daemon which is not configured anymore.
+        """
+        for metric in self.metrics.itervalues():
+            if len(metric.label_names) == len(labels):
+                metric.remove(labels)
+
+    def render(self):
+        with self.lock:
+            if self.text is None:
+                self.text = ''.join(metric.render() for metric in self.metrics.itervalues())
+            return self.text
+
+
+class MetricsSnapshot(object):
+    """
+    Text of a registry rendered by update() in the thread which owns it.
+    Other threads serve render() without touching the registry.
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.text = ''
+
+    def update(self):
+        self.text = self.registry.render()
+
+    def render(self):
+        return self.text
+
+
+def write_textfile(path, registry):
+    """
+    Writes the metrics for the textfile collector of node-exporter. The
+    file is replaced atomically, so a half-written file is never read.
+    """
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(registry.render())
+        os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        log.warning('metrics are not written to %s: %s', path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class MetricsServer(object):
+    """
+    Serves GET /metrics over HTTP on "unix:/path" or "host:port" (meant for
+    loopback addresses). accept() is called by the loop of the owner and
+    serves a connection in a thread of its own, or inline if threaded is
+    False. Or start() accepts connections in a thread, then nothing is
+    logged: a process which forks must not fork with a lock of logging
+    held. collect is called before every scrape to refresh metrics which
+    aren't kept current; registry may be a MetricsSnapshot.
+    """
+    MAX_REQUEST_SIZE = 8192
+    TIMEOUT = 5
+
+    def __init__(self, address, registry, collect=None, threaded=True):
+        self.address = address
+        self.registry = registry
+        self.collect = collect
+        self.threaded = threaded
+        self.socket = None
+        self.path = None
+        self.quiet = False
+
+    def listen(self):
+        if self.address.startswith('unix:') or self.address.startswith('/'):
+            self.path = self.address[5:] if self.address.startswith('unix:') else self.address
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(self.path)
+        else:
+            host, _, port = self.address.rpartition(':')
+            self.socket = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((host.strip('[]') or '127.0.0.1', int(port)))
+        self.socket.listen(16)
+        self.socket.setblocking(False)
+        return self.socket.fileno()
+
+    def accept(self, fd=None):
+        try:
+            connection, _ = self.socket.accept()
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        self._dispatch(connection)
+
+    def _dispatch(self, connection):
+        if self.threaded:
+            thread = threading.Thread(target=self.serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.serve(connection)
+
+    def start(self):
+        self.quiet = True
+        self.socket.setblocking(True)
+        thread = threading.Thread(target=self._serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+
+    def _serve_forever(self):
+        while self.socket is not None:
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error, err:
+                if err.args[0] in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                # closed
+                return
+            self._dispatch(connection)
+
+    def _read_request(self, connection):
+        data = ''
+        while '\r\n\r\n' not in data and '\n\n' not in data and len(data) < self.MAX_REQUEST_SIZE:
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data.split('\n', 1)[0].split()
+
+    def serve(self, connection):
+        try:
+            connection.settimeout(self.TIMEOUT)
+            request = self._read_request(connection)
+            if len(request) < 2 or request[0] not in ('GET', 'HEAD'):
+                status, body = '405 Method Not Allowed', ''
+            elif request[1].split('?', 1)[0] not in ('/metrics', '/'):
+                status, body = '404 Not Found', ''
+            else:
+                if self.collect is not None:
+                    self.collect()
+                status, body = '200 OK', self.registry.render()
+            headers = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %s\r\nConnection: close\r\n\r\n' % (
+                status, CONTENT_TYPE, len(body))
+            connection.sendall(headers + (body if request and request[0] != 'HEAD' else ''))
+        except socket.error, e:
+            if not self.quiet:
+                log.debug('metrics connection failed: %s', e)
+        except Exception:
+            if not self.quiet:
+                log.exception('metrics are not served')
+        finally:
+            connection.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import pwd
+import select
+import shutil
+import socket
+import tempfile
+import time
+
+
+# the same variable as systemd uses, so sd_notify-aware daemons work as is
+NOTIFY_SOCKET = 'NOTIFY_SOCKET'
+
+
+def _get_address(path):
+    # "@name" is a socket in the abstract namespace
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    return path
+
+
+def notify(state, unset_environment=False):
+    """
+    Reports newline separated "KEY=value" assignments to the supervisor,
+    like sd_notify(3), e.g. notify('READY=1\\nMAINPID=%s' % os.getpid()).
+    Returns False if the process has no notify socket.
+    """
+    path = os.environ.get(NOTIFY_SOCKET)
+    if unset_environment:
+        os.environ.pop(NOTIFY_SOCKET, None)
+    if not path:
+        return False
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        client.sendto(state, _get_address(path))
+    except socket.error:
+        return False
+    finally:
+        client.close()
+    return True
+
+
+def parse_state(data):
+    states = {}
+    for line in data.splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            states[key.strip()] = value
+    return states
+
+
+class NotifySocket(object):
+    """
+    Datagram socket a starting daemon reports its readiness to. It lives in
+    a private directory, which is given to the user the daemon runs as.
+    """
+    def __init__(self, user=None):
+        self.directory = tempfile.mkdtemp(prefix='daemon-manager-')
+        self.path = self.directory + '/notify'
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.socket.bind(self.path)
+            if user:
+                pw_record = pwd.getpwnam(user)
+                for path in (self.directory, self.path):
+                    os.chown(path, pw_record.pw_uid, pw_record.pw_gid)
+        except Exception:
+            self.close()
+            raise
+
+    def wait(self, timeout):
+        """
+        Collects states until READY=1 is received or timeout has passed.
+        Returns the dict of the received states.
+        """
+        states = {}
+        deadline = time.time() + timeout
+        while states.get('READY') != '1':
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                readable, _, _ = select.select([self.socket], [], [], remaining)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                states.update(parse_state(self.socket.recv(4096)))
+        return states
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import glob
+import re
+
+from .syscalls import IOPRIO_CLASSES, ioprio_set, sched_getaffinity, sched_setaffinity, setpriority
+
+
+def parse_cpu_list(value):
+    """
+    Parses CPUs given as "0-3,8" (the format of /sys and taskset), a number
+    or a list of numbers. Returns a sorted list.
+    """
+    if isinstance(value, (int, long)):
+        cpus = [value]
+    elif isinstance(value, (list, tuple)):
+        cpus = [int(cpu) for cpu in value]
+    else:
+        cpus = []
+        for part in str(value).split(','):
+            part = part.strip()
+            if not part:
+                continue
+            first, _, last = part.partition('-')
+            cpus.extend(xrange(int(first), int(last or first) + 1))
+    if not cpus or min(cpus) < 0:
+        raise ValueError('invalid CPU list %r' % (value,))
+    return sorted(set(cpus))
+
+
+def _read_cpu_list(path):
+    try:
+        with open(path) as cpus_file:
+            return parse_cpu_list(cpus_file.read())
+    except (IOError, ValueError):
+        return None
+
+
+def get_cores(cpus=None):
+    """
+    Returns physical cores as lists of their hardware threads, only threads
+    from cpus (allowed CPUs of this process by default) are included.
+    """
+    allowed = set(cpus or sched_getaffinity(0))
+    cores = []
+    seen = set()
+    for cpu in sorted(allowed):
+        if cpu in seen:
+            continue
+        siblings = _read_cpu_list('/sys/devices/system/cpu/cpu%s/topology/thread_siblings_list' % cpu) or [cpu]
+        core = [sibling for sibling in siblings if sibling in allowed]
+        seen.update(core)
+        cores.append(core)
+    return cores
+
+
+def get_nodes(cpus=None):
+    """
+    Returns CPUs of every NUMA node, only CPUs from cpus (allowed CPUs of
+    this process by default) are included. All CPUs are one node if the
+    kernel knows nothing about NUMA.
+    """
+    allowed = set(cpus or sched_getaffinity(0))
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    nodes = []
+    for path in sorted(paths, key=lambda path: int(re.search(r'node(\d+)/', path).group(1))):
+        node = [cpu for cpu in _read_cpu_list(path) or () if cpu in allowed]
+        if node:
+            nodes.append(node)
+    return nodes or [sorted(allowed)]
+
+
+class CpuPolicy(object):
+    """
+    Chooses CPUs of workers by their slots:
+
+    * 'core' - a physical core (with its hardware threads) per worker, cores
+      are shared only by more workers than there are cores
+    * 'numa' - workers are spread over NUMA nodes in turn and run on any CPU
+      of their node, so their memory stays local
+    * a list of CPU lists, e.g. [[0, 1], [2, 3]] - CPUs of every slot, used
+      in turn if there are more workers
+    * a CPU list, e.g. "0-7" - the same CPUs for every worker
+    """
+    def __init__(self, policy):
+        self.policy = policy
+        self.groups = None
+        if policy not in ('core', 'numa'):
+            if isinstance(policy, (list, tuple)) and policy and isinstance(policy[0], (list, tuple, basestring)):
+                self.groups = [parse_cpu_list(cpus) for cpus in policy]
+            else:
+                self.groups = [parse_cpu_list(policy)]
+
+    def get_groups(self):
+        if self.groups is None:
+            # the topology is read once, by the master
+            self.groups = get_cores() if self.policy == 'core' else get_nodes()
+        return self.groups
+
+    def get_cpus(self, slot):
+        groups = self.get_groups()
+        return groups[slot % len(groups)]
+
+
+def parse_ioprio(value):
+    """
+    Parses "class/level" ("be/4", "rt/0", "idle") or a level of the
+    best-effort class. Returns (class, level).
+    """
+    if isinstance(value, (int, long)):
+        ioclass, level = 'be', value
+    else:
+        ioclass, _, level = str(value).partition('/')
+        level = int(level or 0)
+    if ioclass not in IOPRIO_CLASSES or not 0 <= level <= 7:
+        raise ValueError('invalid ioprio %r, "rt/0-7", "be/0-7" or "idle" expected' % (value,))
+    return ioclass, level
+
+
+class Placement(object):
+    """
+    Where and at what priority a daemon runs: CPUs, nice value, I/O priority
+    and the OOM killer's adjustment. Applied by the process itself before it
+    drops privileges, as raising priorities needs them.
+    """
+    KEYS = ('cpus', 'nice', 'ioprio', 'oom_score_adj')
+
+    def __init__(self, cpus=None, nice=None, ioprio=None, oom_score_adj=None):
+        self.cpus = cpus
+        self.nice = nice
+        self.ioprio = ioprio
+        self.oom_score_adj = oom_score_adj
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the Placement of a daemon's config or None if it has none.
+        Raises ValueError for invalid values.
+        """
+        if not any(config.get(key) is not None for key in cls.KEYS):
+            return None
+        placement = cls()
+        if config.get('cpus') is not None:
+            placement.cpus = parse_cpu_list(config['cpus'])
+        if config.get('nice') is not None:
+            placement.nice = int(config['nice'])
+            if not -20 <= placement.nice <= 19:
+                raise ValueError('nice must be from -20 to 19')
+        if config.get('ioprio') is not None:
+            placement.ioprio = parse_ioprio(config['ioprio'])
+        if config.get('oom_score_adj') is not None:
+            placement.oom_score_adj = int(config['oom_score_adj'])
+            if not -1000 <= placement.oom_score_adj <= 1000:
+                raise ValueError('oom_score_adj must be from -1000 to 1000')
+        return placement
+
+    def apply(self, pid=0):
+        """
+        Applies the placement to the process, 0 is the calling one.
+        """
+        if self.oom_score_adj is not None:
+            with open('/proc/%s/oom_score_adj' % (pid or 'self'), 'w') as oom_file:
+                oom_file.write(str(self.oom_score_adj))
+        if self.nice is not None:
+            setpriority(pid, self.nice)
+        if self.ioprio is not None:
+            ioprio_set(pid, *self.ioprio)
+        if self.cpus is not None:
+            sched_setaffinity(pid, self.cpus)
+
+    def __repr__(self):
+        return 'Placement(cpus=%r, nice=%r, ioprio=%r, oom_score_adj=%r)' % (
+            self.cpus, self.nice, self.ioprio, self.oom_score_adj)
@@ -1,7 +1,23 @@
 # -*- coding: utf-8 -*-
+import errno
+import logging
 import os
 import signal
 import re
+import select
+import sre_constants
+import sre_parse
+import threading
+import time
+from collections import OrderedDict
+
+from .syscalls import pidfd_open, pid_exists
+
+
+log = logging.getLogger(__name__)
+
+# /proc/<pid>/stat flag of kernel threads, they never have a cmdline
+PF_KTHREAD = 0x00200000
 
 
 class ProcessError(Exception):
@@ -14,129 +30,466 @@ class ProcessNotFound(ProcessError):
         super(ProcessNotFound, self).__init__("Process %s doesn't exist" % pid)
 
 
+class ProcessPattern(object):
+    """
+    Compiled grepline. Literals which every match must contain are pulled
+    out of the pattern so most cmdlines are rejected without the regex.
+    """
+    __slots__ = ('source', 'regex', 'literals', 'matches_empty')
+
+    def __init__(self, pattern):
+        if isinstance(pattern, basestring):
+            self.regex = re.compile(pattern, re.I)
+        else:
+            self.regex = pattern
+        self.source = self.regex.pattern
+        self.literals = ProcessPattern.get_literals(self.source)
+        self.matches_empty = self.regex.search('') is not None
+
+    @staticmethod
+    def get_literals(pattern):
+        try:
+            parsed = sre_parse.parse(pattern)
+        except (sre_constants.error, OverflowError):
+            return []
+
+        literals = []
+        literal = []
+        for op, value in parsed:
+            if op == sre_constants.LITERAL and value < 256:
+                literal.append(chr(value))
+            elif literal:
+                literals.append(''.join(literal).lower())
+                literal = []
+        if literal:
+            literals.append(''.join(literal).lower())
+        # the longest literal rejects most of cmdlines, check it first
+        return sorted(literals, key=len, reverse=True)
+
+    def match(self, cmdline):
+        if cmdline == self.source:
+            return True
+        if self.literals:
+            lowered = cmdline.lower()
+            for literal in self.literals:
+                if literal not in lowered:
+                    return False
+        return self.regex.search(cmdline) is not None
+
+
 class ProcessManager(object):
+    PATTERNS_CACHE_SIZE = 128
+    # backoff limits of waiting for processes which have no pidfd
+    WAIT_DELAY_MIN = 0.01
+    WAIT_DELAY_MAX = 0.5
+    # seconds given to processes to die after kill_signal past the deadline
+    KILL_GRACE = 1
+
+    _patterns = OrderedDict()
+    _patterns_lock = threading.Lock()
+
+    @classmethod
+    def compile(cls, pattern):
+        if isinstance(pattern, ProcessPattern):
+            return pattern
+
+        key = pattern if isinstance(pattern, basestring) else (pattern.pattern, pattern.flags)
+        with cls._patterns_lock:
+            compiled = cls._patterns.pop(key, None)
+            if compiled is None:
+                compiled = ProcessPattern(pattern)
+                if len(cls._patterns) >= cls.PATTERNS_CACHE_SIZE:
+                    cls._patterns.popitem(last=False)
+            cls._patterns[key] = compiled
+        return compiled
+
+    def snapshot(self):
+        return ProcessTable()
+
+    def is_running(self, pid):
+        """
+        Zombies count as stopped: they are gone for everybody except their
+        parent, who is the one to reap them.
+        """
+        if not pid_exists(pid):
+            return False
+        try:
+            return Process(pid).state != ProcessState.ZOMBIE
+        except ProcessNotFound:
+            return False
+
+    def wait(self, pids, timeout):
+        """
+        Waits until the processes exit or timeout runs out. Returns the set
+        of pids which are still running.
+        """
+        deadline = time.time() + timeout
+        running = set(pid for pid in pids if self.is_running(pid))
+        poller = select.poll()
+        pidfds = {}
+        for pid in running:
+            try:
+                fd = pidfd_open(pid)
+            except OSError:
+                continue
+            pidfds[fd] = pid
+            poller.register(fd, select.POLLIN)
 
-    def find(self, pattern):
-        processes = self.get_all()
+        try:
+            delay = self.WAIT_DELAY_MIN
+            while running:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                polled = running.difference(pidfds.itervalues())
+                wait_time = min(remaining, delay) if polled else remaining
+                try:
+                    events = poller.poll(wait_time * 1000)
+                except select.error, err:
+                    if err.args[0] != errno.EINTR:
+                        raise
+                    events = []
+
+                for fd, event in events:
+                    running.discard(pidfds.pop(fd))
+                    poller.unregister(fd)
+                    os.close(fd)
+
+                if polled:
+                    for pid in polled:
+                        if not self.is_running(pid):
+                            running.discard(pid)
+                    delay = min(delay * 2, self.WAIT_DELAY_MAX)
+        finally:
+            for fd in pidfds:
+                os.close(fd)
+        return running
+
+    def _send_signal(self, pid, sign):
+        """
+        Returns True if the signal is delivered, None if the process is gone
+        and False if it can't be signalled.
+        """
+        try:
+            os.kill(pid, sign)
+        except OSError, err:
+            if err.errno == errno.ESRCH:
+                return None
+            log.debug("couldn't send signal %s to process %s: %s", sign, pid, err)
+            return False
+        return True
+
+    def stop(self, pids, timeout, terminate_signal=signal.SIGTERM, kill_signal=signal.SIGKILL, force=False):
+        """
+        Stops all processes at once: sends terminate_signal (kill_signal if
+        force) one time, waits for all of them against one deadline and
+        sends kill_signal one time to the ones which are still running.
+        Those get what is left of timeout and KILL_GRACE seconds to die.
+        Returns {pid: True if the process is stopped}.
+        """
+        deadline = time.time() + timeout
+        results = {}
+        signalled = set()
+        for pid in set(pids):
+            delivered = self._send_signal(pid, kill_signal if force else terminate_signal)
+            if delivered:
+                signalled.add(pid)
+            else:
+                results[pid] = delivered is None
+
+        running = self.wait(signalled, timeout)
+        if running and not force:
+            for pid in list(running):
+                delivered = self._send_signal(pid, kill_signal)
+                if not delivered:
+                    running.discard(pid)
+                    results[pid] = delivered is None
+            running = self.wait(running, max(deadline - time.time(), 0) + self.KILL_GRACE)
+
+        for pid in signalled:
+            results.setdefault(pid, pid not in running)
+        return results
+
+    def find(self, pattern, table=None):
+        """
+        Kernel threads and zombies are rejected by stat before their
+        cmdline is read.
+        """
+        pattern = self.compile(pattern)
         found_processes = []
-        for process in processes:
-            if process.cmdline == pattern or re.search(pattern, process.cmdline, re.I):
+        for process in self.get_all(table):
+            if not pattern.matches_empty and \
+                    (process.flags & PF_KTHREAD or process.state == ProcessState.ZOMBIE):
+                continue
+            if pattern.match(process.cmdline):
                 found_processes.append(process)
         return found_processes
 
-    def get(self, pid):
+    def get(self, pid, table=None):
+        if table is not None:
+            return table.get(pid)
         try:
             return Process(pid)
         except ProcessNotFound:
             return None
 
-    def get_all(self):
-        processes = []
-        for pid in os.listdir('/proc'):
+    def get_all(self, table=None):
+        if table is None:
+            table = self.snapshot()
+        return table.values()
+
+    def get_children_table(self, pid):
+        """
+        Returns a ProcessTable of the children of pid. They are listed by
+        /proc/<pid>/task/*/children where the kernel has it
+        (CONFIG_PROC_CHILDREN), otherwise the whole /proc is read.
+        """
+        child_pids = []
+        try:
+            for task in os.listdir('/proc/%s/task' % pid):
+                with open('/proc/%s/task/%s/children' % (pid, task)) as children_file:
+                    child_pids.extend(int(child_pid) for child_pid in children_file.read().split())
+        except (IOError, OSError), err:
+            if err.errno != errno.ENOENT:
+                raise
+            table = self.snapshot()
+            return ProcessTable(table.children.get(int(pid), []))
+        return ProcessTable(child_pids)
+
+
+class ProcessTable(object):
+    """
+    Snapshot of /proc, or of the given pids only. Every process is read
+    once, tree queries are answered from pid -> ppid and ppid -> [pid]
+    indexes. cgroup is set if the pids are all processes of a cgroup.
+    """
+    # full scans of /proc done by this process and their total duration
+    scans = 0
+    scan_seconds = 0.0
+
+    def __init__(self, pids=None, cgroup=None):
+        self.pids = pids
+        self.cgroup = cgroup
+        self.processes = {}
+        self.parents = {}
+        self.children = {}
+        self.refresh()
+
+    def refresh(self):
+        started = time.time()
+        processes = {}
+        parents = {}
+        children = {}
+        pids = os.listdir('/proc') if self.pids is None else map(str, self.pids)
+        for pid in pids:
             if pid.isdigit():
                 try:
-                    process = Process(pid)
-                    processes.append(process)
+                    process = Process(pid, table=self)
                 except ProcessNotFound:
-                    pass
+                    continue
+                processes[process.pid] = process
+                parents[process.pid] = process.parent_pid
+                children.setdefault(process.parent_pid, []).append(process.pid)
+
+        self.processes = processes
+        self.parents = parents
+        self.children = children
+        if self.pids is None:
+            ProcessTable.scans += 1
+            ProcessTable.scan_seconds += time.time() - started
+
+    def get(self, pid):
+        try:
+            return self.processes[int(pid)]
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    def values(self):
+        return self.processes.values()
+
+    def get_parent(self, pid):
+        return self.get(self.parents.get(pid))
+
+    def get_children(self, pid):
+        return [self.processes[child_pid] for child_pid in self.children.get(pid, [])]
+
+    def get_descendants(self, pid):
+        processes = []
+        stack = list(reversed(self.children.get(pid, [])))
+        while stack:
+            child_pid = stack.pop()
+            processes.append(self.processes[child_pid])
+            stack.extend(reversed(self.children.get(child_pid, [])))
+        return processes
+
+    def get_ancestors(self, pid):
+        processes = []
+        seen = set([pid])
+        parent_pid = self.parents.get(pid)
+        while parent_pid in self.processes and parent_pid not in seen:
+            seen.add(parent_pid)
+            processes.append(self.processes[parent_pid])
+            parent_pid = self.parents[parent_pid]
         return processes
 
+    def __contains__(self, pid):
+        return pid in self.processes
+
+    def __iter__(self):
+        return self.processes.itervalues()
+
+    def __len__(self):
+        return len(self.processes)
+
 
 class Process(object):
+    """
+    Fields are loaded lazily: /proc/<pid>/stat on the first stat field,
+    /proc/<pid>/cmdline on the first cmdline access. Loaded values are
+    cached until refresh() is called.
+    """
+    __slots__ = ('pid', 'table', '_stat', '_cmdline')
+
+    # positions in /proc/<pid>/stat after the "(comm)" field
+    STAT_STATE = 0
+    STAT_PARENT_PID = 1
+    STAT_GID = 2
+    STAT_FLAGS = 6
+    STAT_UTIME = 11
+    STAT_STIME = 12
+    STAT_VSIZE = 20
 
     @staticmethod
-    def get_info(pid):
-        info = {}
+    def _read(path):
         try:
-            with open('/proc/%s/stat' % pid) as stat:
-                process_stat = stat.read().split(' ')
-                info['pid'] = int(process_stat[0])
-                info['name'] = process_stat[1][1:-1]
-                info['state'] = process_stat[2]
-                info['parent_pid'] = int(process_stat[3])
-                info['gid'] = process_stat[4]
-                info['vsize'] = process_stat[22]
-            with open('/proc/%s/cmdline' % pid) as cmdline:
-                info['cmdline'] = cmdline.read()
-            return info
-        except IOError:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
             return None
+        try:
+            chunks = []
+            while True:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return ''.join(chunks)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
 
-    def _get_all_pids(self):
-        return [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    @staticmethod
+    def parse_stat(data):
+        """
+        Returns (name, fields). The name may contain spaces and parentheses,
+        so it is cut between the first "(" and the last ")".
+        """
+        name_start = data.find('(')
+        name_end = data.rfind(')')
+        if name_start < 0 or name_end < name_start:
+            raise ValueError('invalid stat line')
+        return data[name_start + 1:name_end], data[name_end + 2:].split(' ')
 
-    def __init__(self, pid):
+    @staticmethod
+    def get_info(pid):
+        stat = Process._read('/proc/%s/stat' % pid)
+        cmdline = Process._read('/proc/%s/cmdline' % pid)
+        if stat is None or cmdline is None:
+            return None
+
+        name, fields = Process.parse_stat(stat)
+        return {
+            'pid': int(pid),
+            'name': name,
+            'state': fields[Process.STAT_STATE],
+            'parent_pid': int(fields[Process.STAT_PARENT_PID]),
+            'gid': fields[Process.STAT_GID],
+            'vsize': fields[Process.STAT_VSIZE],
+            'cmdline': cmdline,
+        }
+
+    def __init__(self, pid, table=None):
         try:
             pid = int(pid)
         except (ValueError, TypeError):
             raise AttributeError('pid must be integer')
 
-        process_info = Process.get_info(pid)
-        if process_info is not None:
-            self.pid = pid
-            self.name = process_info['name']
-            self.cmdline = process_info['cmdline']
-        else:
-            raise ProcessNotFound(pid)
+        self.pid = pid
+        self.table = table
+        self._stat = None
+        self._cmdline = None
+        self._load_stat()
+
+    def _load_stat(self):
+        data = Process._read('/proc/%s/stat' % self.pid)
+        if data is None:
+            raise ProcessNotFound(self.pid)
+        self._stat = Process.parse_stat(data)
+        return self._stat
+
+    def _get_stat_field(self, index):
+        stat = self._stat or self._load_stat()
+        return stat[1][index]
+
+    def refresh(self):
+        self._stat = None
+        self._cmdline = None
+        self._load_stat()
+
+    @property
+    def name(self):
+        stat = self._stat or self._load_stat()
+        return stat[0]
+
+    @property
+    def cmdline(self):
+        if self._cmdline is None:
+            # a process which has already gone away matches nothing
+            self._cmdline = Process._read('/proc/%s/cmdline' % self.pid) or ''
+        return self._cmdline
+
+    @property
+    def flags(self):
+        return int(self._get_stat_field(Process.STAT_FLAGS))
+
+    def _get_table(self):
+        if self.table is None:
+            return ProcessTable()
+        return self.table
 
     @property
     def parent_pid(self):
-        process_info = Process.get_info(self.pid)
-        return process_info['parent_pid']
+        return int(self._get_stat_field(Process.STAT_PARENT_PID))
 
     @property
     def parent(self):
+        if self.table is not None:
+            parent = self.table.get(self.parent_pid)
+            if parent is None:
+                raise ProcessNotFound(self.parent_pid)
+            return parent
         return Process(self.parent_pid)
 
     @property
     def ancestors(self):
-        processes = []
-        process = self
-        while True:
-            try:
-                process = process.parent
-                processes.append(process)
-            except ProcessNotFound:
-                break
-        return processes
+        return self._get_table().get_ancestors(self.pid)
 
     @property
     def children(self):
-        processes = []
-        for pid in self._get_all_pids():
-            try:
-                process = Process(pid)
-                if process.parent_pid == self.pid:
-                    processes.append(process)
-            except ProcessNotFound:
-                pass
-        return processes
+        return self._get_table().get_children(self.pid)
 
     @property
     def descendants(self):
-        return self._get_children_tree(self.pid)
-
-    def _get_children_tree(self, parent_pid):
-        processes = []
-        for pid in self._get_all_pids():
-            try:
-                process = Process(pid)
-                if process.parent_pid == parent_pid:
-                    processes.append(process)
-                    processes.extend(self._get_children_tree(pid))
-            except ProcessNotFound:
-                pass
-        return processes
+        return self._get_table().get_descendants(self.pid)
 
     @property
     def state(self):
-        process_info = Process.get_info(self.pid)
-        return process_info['state']
+        return self._get_stat_field(Process.STAT_STATE)
 
     @property
     def memory(self):
-        process_info = Process.get_info(self.pid)
-        return process_info['vsize']
+        return self._get_stat_field(Process.STAT_VSIZE)
 
     def kill(self):
         os.kill(self.pid, signal.SIGKILL)
@@ -148,15 +501,14 @@ class Process(object):
         os.kill(self.pid, sign)
 
     def __repr__(self):
-        process_info = Process.get_info(self.pid)
         return "<Process pid={pid}, name={name}, cmdline={cmdline}, " \
                "parent_pid={parent_pid}, state={state}, memory={memory}>".format(
             pid=self.pid,
             name=self.name,
             cmdline=self.cmdline,
-            parent_pid=process_info['parent_pid'],
-            state=process_info['state'],
-            memory=process_info['vsize']
+            parent_pid=self.parent_pid,
+            state=self.state,
+            memory=self.memory
         )
 
     def __cmp__(self, other):
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows burst actions at once and rate actions per second after that.
+    """
+    def __init__(self, rate, burst):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def acquire(self, now=None):
+        """
+        Takes a token if there is one. Returns False otherwise.
+        """
+        self._refill(now or time.time())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def get_next_time(self, now=None):
+        """
+        Returns the time the next token is there.
+        """
+        now = now or time.time()
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+import errno
+import fcntl
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from .cli import CLI
+from .control import ControlServer, ThreadOutput, output_to_json
+from .basedaemon import Daemon
+from .manager import Manager
+from .metrics import MetricsRegistry, MetricsServer, write_textfile
+from .processes import ProcessTable
+from .ratelimit import TokenBucket
+from .sampling import CLOCK_TICKS, ResourceSampler, format_size, format_stats, format_trend
+from .settings import SETTINGS_MANAGER
+from .syscalls import reap_children, set_child_subreaper
+from .watcher import ProcessWatcher
+
+
+log = logging.getLogger('daemon-runtime')
+
+
+class DaemonManager(Daemon):
+    """
+    Waits for exits of daemons' main processes and respawns crashed ones.
+    A full status check of every daemon runs once per reconcile interval
+    to catch what the watcher cannot see (e.g. a rewritten pidfile).
+
+    The runtime is a child subreaper: daemons which fork into background
+    stay its children, so their exits are seen by pidfd and waitpid and
+    the forked process is looked up among its children only.
+
+    daemon-tools talks to it through the control socket, see handle_request.
+    """
+    def __init__(self, *args, **kwargs):
+        super(DaemonManager, self).__init__(*args, **kwargs)
+        self.daemon_manager = Manager(SETTINGS_MANAGER['configs'])
+        self.watcher = None
+        self.respawns = {}
+        self.next_reconcile = 0
+        self.reload_requested = False
+        self.sampler = None
+        self.next_sample = 0
+        self.log_pump = None
+        # when the watcher has seen daemons exit, for the respawn delay
+        self.exit_times = {}
+        self.next_textfile = 0
+        self._create_metrics()
+        self.respawn_limiter = None
+        if SETTINGS_MANAGER['respawn_limit']['rate']:
+            self.respawn_limiter = TokenBucket(SETTINGS_MANAGER['respawn_limit']['rate'],
+                                               SETTINGS_MANAGER['respawn_limit']['burst'])
+
+        # daemons are changed by the loop and by control requests
+        self.lock = threading.RLock()
+        self.changed_daemons = set()
+        # daemons started or stopped by control requests right now: the
+        # requests run without the lock and the loop leaves them alone
+        self.busy_daemons = set()
+        self.daemons_released = threading.Condition(self.lock)
+        self._wakeup_read = None
+        self._wakeup_write = None
+
+    def _create_metrics(self):
+        self.metrics = MetricsRegistry()
+        metrics = self.metrics
+        self.metric_daemons = metrics.gauge('daemon_manager_daemons', 'Number of configured daemons.')
+        self.metric_up = metrics.gauge('daemon_manager_daemon_up', 'Whether the daemon is running.', ['daemon'])
+        self.metric_crashes = metrics.gauge('daemon_manager_daemon_crash_number',
+                                            'Crashes counted against the respawn limit.', ['daemon'])
+        self.metric_failed = metrics.gauge('daemon_manager_daemon_failed',
+                                           'Whether the daemon crashed too many times to be respawned.', ['daemon'])
+        self.metric_respawns = metrics.counter('daemon_manager_daemon_respawns_total',
+                                               'Restarts of crashed daemons.', ['daemon'])
+        self.metric_respawn_delay = metrics.summary('daemon_manager_daemon_respawn_delay_seconds',
+                                                    'Time from an exit of the daemon to its restart.', ['daemon'])
+        self.metric_processes = metrics.gauge('daemon_manager_daemon_processes',
+                                              'Processes of the daemon with its descendants.', ['daemon'])
+        self.metric_cpu = metrics.counter('daemon_manager_daemon_cpu_seconds_total',
+                                          'CPU time used by processes of the daemon.', ['daemon'])
+        self.metric_rss = metrics.gauge('daemon_manager_daemon_resident_memory_bytes',
+                                        'Resident memory of processes of the daemon.', ['daemon'])
+        self.metric_fds = metrics.gauge('daemon_manager_daemon_open_fds',
+                                        'Open file descriptors of processes of the daemon.', ['daemon'])
+        self.metric_read = metrics.counter('daemon_manager_daemon_read_bytes_total',
+                                           'Bytes read from storage by processes of the daemon.', ['daemon'])
+        self.metric_write = metrics.counter('daemon_manager_daemon_write_bytes_total',
+                                            'Bytes written to storage by processes of the daemon.', ['daemon'])
+        self.metric_loop = metrics.summary('daemon_manager_loop_duration_seconds',
+                                           'Work done by the supervision loop per wakeup.')
+        self.metric_reconcile = metrics.summary('daemon_manager_reconcile_duration_seconds',
+                                                'Full status checks of all daemons.')
+        self.metric_scan = metrics.summary('daemon_manager_proc_scan_duration_seconds',
+                                           'Scans of the whole /proc.')
+
+    def watch(self, daemon_name):
+        pid = self.daemon_manager.get(daemon_name).pid
+        if pid:
+            self.watcher.watch(daemon_name, pid)
+        else:
+            self.watcher.unwatch(daemon_name)
+        self.metric_up.set(1 if daemon_name in self.watcher.watched else 0, (daemon_name,))
+
+    def check(self, daemon_name):
+        if daemon_name in self.busy_daemons:
+            return
+        daemon = self.daemon_manager.get(daemon_name)
+        now = time.time()
+        respawn_time = self.respawns.get(daemon_name)
+        if daemon.respawn_limit and not daemon.failed and (respawn_time is None or respawn_time <= now):
+            if self.daemon_manager.status(daemon_name):
+                self.respawns.pop(daemon_name, None)
+                if daemon.crash_number and now - daemon.respawn_time >= daemon.respawn_healthy:
+                    log.info('daemon %s is up for %s seconds, its crashes are forgotten',
+                             daemon_name, daemon.respawn_healthy)
+                    daemon.crash_number = 0
+            elif respawn_time is None:
+                self.crashed(daemon_name, now)
+            else:
+                self.respawn(daemon_name, now)
+        if daemon_name not in self.respawns:
+            self.exit_times.pop(daemon_name, None)
+        self.metric_crashes.set(daemon.crash_number, (daemon_name,))
+        self.metric_failed.set(1 if daemon.failed else 0, (daemon_name,))
+        self.watch(daemon_name)
+
+    def crashed(self, daemon_name, now):
+        daemon = self.daemon_manager.get(daemon_name)
+        if now - daemon.respawn_time >= daemon.respawn_healthy:
+            daemon.crash_number = 0
+        daemon.crash_number += 1
+        if daemon.crash_number > daemon.respawn_limit:
+            daemon.failed = True
+            log.error('daemon %s crashed %s times in a row, it is failed until it is started again',
+                      daemon_name, daemon.crash_number)
+            return
+        log.info('daemon %s crashed %s times', daemon_name, daemon.crash_number)
+        # backoff counts from the last start, a crash after a long run is respawned at once
+        self.respawns[daemon_name] = max(daemon.respawn_time + daemon.get_respawn_delay(), now)
+        if self.respawns[daemon_name] <= now:
+            self.respawn(daemon_name, now)
+
+    def respawn(self, daemon_name, now):
+        daemon = self.daemon_manager.get(daemon_name)
+        if self.respawn_limiter is not None and not self.respawn_limiter.acquire(now):
+            # a failure shared by many daemons doesn't restart them all at once
+            self.respawns[daemon_name] = self.respawn_limiter.get_next_time(now)
+            log.info('respawn of daemon %s is delayed by the host-wide limit', daemon_name)
+            return
+        self.respawns.pop(daemon_name, None)
+        self.daemon_manager.restart(daemon_name)
+        log.info('restarted daemon %s', daemon_name)
+        daemon.respawn_time = time.time()
+        self.metric_respawns.inc(labels=(daemon_name,))
+        exit_time = self.exit_times.get(daemon_name)
+        if exit_time is not None:
+            self.metric_respawn_delay.observe(daemon.respawn_time - exit_time, (daemon_name,))
+
+    def reset_crashes(self, daemon_name):
+        """
+        Called when a daemon is started or stopped by hand: it isn't failed
+        anymore and a pending respawn is dropped.
+        """
+        daemon = self.daemon_manager.daemons.get(daemon_name)
+        if daemon is None:
+            return
+        daemon.failed = False
+        daemon.crash_number = 0
+        daemon.respawn_time = time.time()
+        self.respawns.pop(daemon_name, None)
+        self.exit_times.pop(daemon_name, None)
+
+    def reconcile(self):
+        started = time.time()
+        for daemon_name in self.daemon_manager.daemons.keys():
+            self.check(daemon_name)
+        self.metric_reconcile.observe(time.time() - started)
+
+    def get_timeout(self):
+        next_times = [self.next_reconcile] + self.respawns.values()
+        if self.sampler is not None:
+            next_times.append(self.next_sample)
+        if SETTINGS_MANAGER['metrics']['textfile']:
+            next_times.append(self.next_textfile)
+        return max(min(next_times) - time.time(), 0)
+
+    def sample(self):
+        daemons = {}
+        for daemon_name, pid in self.watcher.watched.iteritems():
+            daemon = self.daemon_manager.daemons.get(daemon_name)
+            if daemon is not None:
+                daemons[daemon_name] = (pid, daemon.cgroup)
+        self.sampler.sample(daemons)
+
+        for daemon_name in self.daemon_manager.daemons:
+            labels = (daemon_name,)
+            buffer = self.sampler.buffers.get(daemon_name)
+            if buffer and daemon_name in daemons:
+                self.metric_processes.set(int(buffer.get('processes')), labels)
+                self.metric_rss.set(int(buffer.get('rss')), labels)
+                self.metric_fds.set(int(buffer.get('fds')), labels)
+                self.metric_cpu.set(buffer.get('cpu') / CLOCK_TICKS, labels)
+                self.metric_read.set(int(buffer.get('read_bytes')), labels)
+                self.metric_write.set(int(buffer.get('write_bytes')), labels)
+            else:
+                self.metric_processes.set(0, labels)
+                self.metric_rss.set(0, labels)
+                self.metric_fds.set(0, labels)
+
+    def get_stats(self, daemon_name):
+        if self.sampler is None or daemon_name not in self.watcher.watched:
+            return None
+        return self.sampler.get_stats(daemon_name, SETTINGS_MANAGER['sampling']['window'])
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, '\0')
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeups(self, fd):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def _open_wakeup_pipe(self):
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.watcher.add_reader(self._wakeup_read, self._drain_wakeups)
+
+    def _sigchld_hook(self, signum, frame):
+        # the handler only has to exist, the wakeup fd interrupts epoll
+        pass
+
+    def _become_subreaper(self):
+        try:
+            set_child_subreaper()
+        except OSError, e:
+            log.warning('cannot become a child subreaper: %s', e)
+            return
+        signal.signal(signal.SIGCHLD, self._sigchld_hook)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(self._wakeup_write)
+
+    def reap(self):
+        """
+        Collects intermediate processes of daemonization and other orphans
+        adopted by the runtime. Exits of watched daemons are reported by
+        the watcher regardless of who has reaped them.
+        """
+        for pid in reap_children():
+            log.debug('reaped process %s', pid)
+
+    def get_status(self, configs, verbose=False):
+        """
+        Running daemons are reported from the watcher without touching
+        /proc, the rest get the full status check. configs maps names of
+        the daemons to their configurations. verbose adds resources used by
+        the daemons.
+        """
+        daemons = {}
+        names = sorted(configs)
+        for daemon_name in names:
+            daemon = configs[daemon_name]
+            pid = self.watcher.watched.get(daemon_name)
+            if pid:
+                status = 'running (%s)\n' % pid
+                running = True
+            else:
+                sys.stdout.capture()
+                try:
+                    running = bool(daemon.status()) and daemon.pid is not None
+                finally:
+                    status = sys.stdout.release()
+                pid = daemon.pid
+                if not running and daemon.failed:
+                    status = 'failed (crashed %s times)\n' % daemon.crash_number
+
+            if len(names) == 1:
+                print '%s is %s' % (daemon_name, status),
+            else:
+                print ' * %s is %s' % (daemon_name, status),
+            daemons[daemon_name] = {
+                'pid': pid,
+                'running': running,
+                'crash_number': daemon.crash_number,
+                'failed': daemon.failed,
+                'status': output_to_json(status.strip()),
+            }
+            if verbose:
+                stats = self.get_stats(daemon_name)
+                if stats is not None:
+                    print '   ' + format_stats(stats)
+                daemons[daemon_name]['resources'] = stats
+        return daemons
+
+    def get_top(self, names):
+        """
+        Prints resources of running daemons, the busiest first.
+        """
+        daemons = {}
+        for daemon_name in names:
+            stats = self.get_stats(daemon_name)
+            if stats is not None:
+                stats['pid'] = self.watcher.watched[daemon_name]
+                daemons[daemon_name] = stats
+
+        print '%-24s %7s %6s %6s %9s %10s %9s %9s %5s' % (
+            'NAME', 'PID', 'PROCS', 'CPU%', 'RSS', 'RSS/min', 'READ/s', 'WRITE/s', 'FDS')
+        for daemon_name in sorted(daemons, key=lambda name: (-daemons[name]['cpu_percent'], name)):
+            stats = daemons[daemon_name]
+            print '%-24s %7s %6s %6.1f %9s %10s %9s %9s %5s' % (
+                daemon_name, stats['pid'], stats['processes'], stats['cpu_percent'],
+                format_size(stats['rss']), format_trend(stats['rss_trend']),
+                format_size(stats['read_rate']), format_size(stats['write_rate']), stats['fds'])
+        return daemons
+
+    def handle_request(self, request):
+        command = request.get('command')
+        name = request.get('name')
+        cli = CLI(self.daemon_manager)
+        error = cli.get_error(command, name)
+        if error:
+            return {'code': 2, 'error': error}
+        if request.get('jobs'):
+            cli.jobs = int(request['jobs'])
+
+        if command in ('list', 'status', 'top'):
+            # a reload replaces entries of daemons, the reply is made of one
+            # version of them
+            with self.lock:
+                configs = dict(self.daemon_manager.daemons)
+            if command != 'list' and name and name != 'all':
+                if name not in configs:
+                    return {'code': 2, 'error': 'name %s is not found' % name}
+                configs = {name: configs[name]}
+
+        response = {'code': 0}
+        sys.stdout.capture()
+        try:
+            if command == 'list':
+                cli.list(configs)
+                response['daemons'] = sorted(configs)
+            elif command == 'top':
+                response['daemons'] = self.get_top(sorted(configs))
+            elif command == 'status':
+                response['daemons'] = self.get_status(configs, bool(request.get('verbose')))
+            else:
+                with self.lock:
+                    # a daemon is handled by one request at a time
+                    while True:
+                        names = set(self.daemon_manager.daemons) if name == 'all' else set([name])
+                        if not names & self.busy_daemons:
+                            break
+                        self.daemons_released.wait()
+                    self.busy_daemons.update(names)
+                    if command in ('start', 'stop', 'restart'):
+                        for daemon_name in names:
+                            self.reset_crashes(daemon_name)
+                try:
+                    # a stop takes up to stop_timeout, crashes of other
+                    # daemons are handled meanwhile
+                    response['code'] = getattr(cli, command)(name) or 0
+                finally:
+                    with self.lock:
+                        self.busy_daemons.difference_update(names)
+                        self.changed_daemons.update(names)
+                        self.daemons_released.notify_all()
+                    self._wakeup()
+        finally:
+            response['output'] = output_to_json(sys.stdout.release())
+        return response
+
+    def run(self):
+        self.watcher = ProcessWatcher(SETTINGS_MANAGER['watch']['poll'])
+        self._open_wakeup_pipe()
+        self._become_subreaper()
+        logs = SETTINGS_MANAGER['logs']
+        if logs['dir']:
+            from .logs import LogPump
+
+            self.log_pump = LogPump(logs['max_size'], logs['max_age'], logs['segments'],
+                                    logs['hot'], logs['rate'], logs['burst'])
+            self.log_pump.start()
+            self.daemon_manager.set_log_pump(self.log_pump)
+        if SETTINGS_MANAGER['sampling']['interval']:
+            self.sampler = ResourceSampler(SETTINGS_MANAGER['sampling']['size'], SETTINGS_MANAGER['sampling']['tree'])
+        ThreadOutput.install()
+        control = ControlServer(SETTINGS_MANAGER['socket'], self.handle_request)
+        self.watcher.add_reader(control.listen(), control.accept)
+        metrics_server = None
+        if SETTINGS_MANAGER['metrics']['listen']:
+            metrics_server = MetricsServer(SETTINGS_MANAGER['metrics']['listen'], self.metrics, self.collect_metrics)
+            self.watcher.add_reader(metrics_server.listen(), metrics_server.accept)
+        try:
+            exited = []
+            while True:
+                try:
+                    started = time.time()
+                    self.reap()
+                    with self.lock:
+                        for daemon_name in exited:
+                            if daemon_name in self.daemon_manager.daemons and daemon_name not in self.busy_daemons:
+                                log.info('daemon %s exited', daemon_name)
+                                self.exit_times.setdefault(daemon_name, started)
+                                self.check(daemon_name)
+                        exited = []
+                        self.step()
+                    self.metric_loop.observe(time.time() - started)
+                    exited = self.watcher.poll(self.get_timeout())
+                except Exception, e:
+                    log.error('error occured %s \n%s', e, traceback.format_exc())
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            control.close()
+            if self.log_pump is not None:
+                self.log_pump.close()
+
+    def step(self):
+        if self.reload_requested and not self.busy_daemons:
+            # objects of busy daemons are in use by control requests
+            self.reload_requested = False
+            added, removed, changed = self.daemon_manager.reload_configs()
+            log.info('reloaded configs: added %s, removed %s, changed %s',
+                     sorted(added), sorted(removed), sorted(changed))
+            for daemon_name in removed | changed:
+                self.watcher.unwatch(daemon_name)
+                self.respawns.pop(daemon_name, None)
+            if self.sampler is not None:
+                for daemon_name in removed:
+                    self.sampler.forget(daemon_name)
+            for daemon_name in removed:
+                self.exit_times.pop(daemon_name, None)
+                self.metrics.remove_series((daemon_name,))
+            self.changed_daemons.update(added | changed)
+
+        if self.next_reconcile <= time.time():
+            self.next_reconcile = time.time() + SETTINGS_MANAGER['watch']['reconcile']
+            self.reconcile()
+
+        for daemon_name, respawn_time in self.respawns.items():
+            if respawn_time <= time.time():
+                self.check(daemon_name)
+
+        if self.sampler is not None and self.next_sample <= time.time():
+            interval = SETTINGS_MANAGER['sampling']['interval']
+            # keeps the cadence unless the loop has fallen behind
+            self.next_sample += interval
+            if self.next_sample <= time.time():
+                self.next_sample = time.time() + interval
+            self.sample()
+
+        while self.changed_daemons:
+            daemon_name = self.changed_daemons.pop()
+            # busy daemons are watched again when their requests are done
+            if daemon_name in self.daemon_manager.daemons and daemon_name not in self.busy_daemons:
+                self.watch(daemon_name)
+
+        textfile = SETTINGS_MANAGER['metrics']['textfile']
+        if textfile and self.next_textfile <= time.time():
+            self.next_textfile = time.time() + SETTINGS_MANAGER['metrics']['interval']
+            self.collect_metrics()
+            write_textfile(textfile, self.metrics)
+
+    def collect_metrics(self):
+        """
+        Updates the metrics which aren't kept current by the loop.
+        """
+        self.metric_daemons.set(len(self.daemon_manager.daemons))
+        self.metric_scan.set((ProcessTable.scan_seconds, ProcessTable.scans))
+
+    def reload(self):
+        # called from the signal handler, the loop picks it up after epoll wakes
+        self.reload_requested = True
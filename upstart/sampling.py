@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import time
+from array import array
+
+from .processes import Process, ProcessNotFound, ProcessTable
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# positions of values in split /proc/<pid>/io
+IO_READ_BYTES = 9
+IO_WRITE_BYTES = 11
+
+
+class RingBuffer(object):
+    """
+    The last size samples of several fields. Every field is an array of
+    doubles written in a circle, so a sample allocates nothing.
+    """
+    def __init__(self, fields, size):
+        self.fields = fields
+        self.size = size
+        self.columns = dict((field, array('d', [0.0]) * size) for field in fields)
+        self.count = 0
+
+    def append(self, sample):
+        index = self.count % self.size
+        for field in self.fields:
+            self.columns[field][index] = sample[field]
+        self.count += 1
+
+    def get(self, field, age=0):
+        """
+        Returns the value of the sample taken age samples before the last one.
+        """
+        if not 0 <= age < len(self):
+            raise IndexError(age)
+        return self.columns[field][(self.count - 1 - age) % self.size]
+
+    def values(self, field):
+        """
+        Returns all kept values of the field, the oldest first.
+        """
+        return [self.get(field, age) for age in xrange(len(self) - 1, -1, -1)]
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+
+class ProcessFiles(object):
+    """
+    /proc files of one process. They are opened once and read again from
+    the start on every sample. A read fails with ESRCH once the process is
+    gone, so a reused pid is never mistaken for the old process.
+    """
+    NAMES = ('stat', 'statm', 'io')
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.fds = {}
+        for name in self.NAMES:
+            try:
+                self.fds[name] = os.open('/proc/%s/%s' % (pid, name), os.O_RDONLY)
+            except OSError, err:
+                # io is readable only by the owner of the process and root
+                if name == 'io' and err.errno == errno.EACCES:
+                    continue
+                self.close()
+                if err.errno in (errno.ENOENT, errno.ESRCH):
+                    raise ProcessNotFound(pid)
+                raise
+
+    def read(self, name):
+        fd = self.fds.get(name)
+        if fd is None:
+            return None
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            return os.read(fd, 4096)
+        except OSError, err:
+            if err.errno == errno.ESRCH:
+                raise ProcessNotFound(self.pid)
+            raise
+
+    def get_fds_number(self):
+        path = '/proc/%s/fd' % self.pid
+        try:
+            # the size of the directory is the number of fds since Linux 6.2
+            number = os.stat(path).st_size or len(os.listdir(path))
+        except OSError, err:
+            if err.errno in (errno.ENOENT, errno.ESRCH):
+                raise ProcessNotFound(self.pid)
+            if err.errno != errno.EACCES:
+                raise
+            number = 0
+        return number
+
+    def sample(self):
+        """
+        Returns (cpu ticks, rss bytes, read bytes, written bytes, fds).
+        """
+        _, fields = Process.parse_stat(self.read('stat'))
+        cpu = int(fields[Process.STAT_UTIME]) + int(fields[Process.STAT_STIME])
+        rss = int(self.read('statm').split()[1]) * PAGE_SIZE
+
+        read_bytes = write_bytes = 0
+        io = self.read('io')
+        if io:
+            # "rchar: n wchar: n syscr: n syscw: n read_bytes: n write_bytes: n ..."
+            io_fields = io.split()
+            read_bytes = int(io_fields[IO_READ_BYTES])
+            write_bytes = int(io_fields[IO_WRITE_BYTES])
+        return cpu, rss, read_bytes, write_bytes, self.get_fds_number()
+
+    def close(self):
+        for fd in self.fds.itervalues():
+            os.close(fd)
+        self.fds = {}
+
+
+class ResourceSampler(object):
+    """
+    Samples CPU, memory, I/O and fds of daemons with their descendants into
+    a RingBuffer per daemon.
+
+    Processes of a daemon come from its cgroup if it has one. Otherwise
+    descendants are found by a /proc scan every tree_interval seconds and
+    only the known processes are sampled in between.
+    """
+    FIELDS = ('time', 'cpu', 'rss', 'read_bytes', 'write_bytes', 'fds', 'processes')
+
+    def __init__(self, size=300, tree_interval=10):
+        self.size = size
+        self.tree_interval = tree_interval
+        self.buffers = {}
+        # pid -> ProcessFiles and the last (cpu, read, write) counters
+        self.files = {}
+        self.counters = {}
+        # daemon -> [cpu, read, write] of all its processes, dead ones too
+        self.totals = {}
+        # daemon -> descendants found by the last /proc scan
+        self.descendants = {}
+        self.next_tree = 0
+
+    def sample(self, daemons):
+        """
+        daemons is {name: (main pid, cgroup or None)} of running daemons.
+        """
+        now = time.time()
+        scan = self.next_tree <= now
+        if scan:
+            self.next_tree = now + self.tree_interval
+        table = None
+
+        seen = set()
+        for name, (main_pid, cgroup) in daemons.iteritems():
+            buffer = self.buffers.get(name)
+            if buffer is None:
+                buffer = self.buffers[name] = RingBuffer(self.FIELDS, self.size)
+            totals = self.totals.setdefault(name, [0, 0, 0])
+            sample = {'time': now, 'rss': 0, 'fds': 0, 'processes': 0}
+
+            pids = cgroup.get_pids() if cgroup is not None else None
+            if not pids or main_pid not in pids:
+                if scan:
+                    if table is None:
+                        # only daemons without a cgroup need it
+                        table = ProcessTable()
+                    self.descendants[name] = set(process.pid for process in table.get_descendants(main_pid))
+                pids = [main_pid] + list(self.descendants.get(name, ()))
+
+            for pid in pids:
+                try:
+                    files = self.files.get(pid)
+                    if files is None:
+                        files = self.files[pid] = ProcessFiles(pid)
+                    cpu, rss, read_bytes, write_bytes, fds = files.sample()
+                except ProcessNotFound:
+                    self._forget_pid(pid)
+                    self.descendants.get(name, set()).discard(pid)
+                    continue
+
+                seen.add(pid)
+                counters = (cpu, read_bytes, write_bytes)
+                # a process which appeared since the last sample has done
+                # all its work in between, the first sample is the baseline
+                last = self.counters.get(pid, (0, 0, 0) if len(buffer) else counters)
+                for i in xrange(3):
+                    totals[i] += counters[i] - last[i]
+                self.counters[pid] = counters
+
+                sample['rss'] += rss
+                sample['fds'] += fds
+                sample['processes'] += 1
+
+            sample['cpu'], sample['read_bytes'], sample['write_bytes'] = totals
+            buffer.append(sample)
+
+        for pid in set(self.files) - seen:
+            self._forget_pid(pid)
+
+    def _forget_pid(self, pid):
+        files = self.files.pop(pid, None)
+        if files is not None:
+            files.close()
+        self.counters.pop(pid, None)
+
+    def forget(self, name):
+        self.buffers.pop(name, None)
+        self.totals.pop(name, None)
+        self.descendants.pop(name, None)
+
+    def get_stats(self, name, window=5):
+        """
+        Returns the last sample of the daemon with rates over the last window
+        samples: CPU %, read and written bytes per second and the RSS trend
+        in bytes per minute over all kept samples. None if it isn't sampled.
+        """
+        buffer = self.buffers.get(name)
+        if not buffer:
+            return None
+
+        stats = {
+            'time': buffer.get('time'),
+            'rss': int(buffer.get('rss')),
+            'fds': int(buffer.get('fds')),
+            'processes': int(buffer.get('processes')),
+            'cpu_percent': 0.0,
+            'read_rate': 0.0,
+            'write_rate': 0.0,
+            'rss_trend': 0.0,
+        }
+        age = min(window, len(buffer) - 1)
+        elapsed = buffer.get('time') - buffer.get('time', age)
+        if elapsed > 0:
+            stats['cpu_percent'] = (buffer.get('cpu') - buffer.get('cpu', age)) * 100.0 / CLOCK_TICKS / elapsed
+            stats['read_rate'] = (buffer.get('read_bytes') - buffer.get('read_bytes', age)) / elapsed
+            stats['write_rate'] = (buffer.get('write_bytes') - buffer.get('write_bytes', age)) / elapsed
+
+        oldest = len(buffer) - 1
+        elapsed = buffer.get('time') - buffer.get('time', oldest)
+        if elapsed > 0:
+            stats['rss_trend'] = (buffer.get('rss') - buffer.get('rss', oldest)) * 60 / elapsed
+        return stats
+
+    def close(self):
+        for pid in self.files.keys():
+            self._forget_pid(pid)
+
+
+def format_size(size):
+    sign = '-' if size < 0 else ''
+    size = abs(size)
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024 or unit == 'G':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return '%s%d%s' % (sign, size, unit)
+    return '%s%.1f%s' % (sign, size, unit)
+
+
+def format_trend(size):
+    return ('+' if size >= 0 else '') + format_size(size)
+
+
+def format_stats(stats):
+    return 'cpu %.1f%%, rss %s (%s/min), read %s/s, write %s/s, fds %s, processes %s' % (
+        stats['cpu_percent'],
+        format_size(stats['rss']),
+        format_trend(stats['rss_trend']),
+        format_size(stats['read_rate']),
+        format_size(stats['write_rate']),
+        stats['fds'],
+        stats['processes'],
+    )
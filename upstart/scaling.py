@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import math
+import os
+import time
+
+
+log = logging.getLogger(__name__)
+
+PRESSURE_PATH = '/proc/pressure/memory'
+
+
+def get_load():
+    """
+    Returns the 1 minute load average per CPU.
+    """
+    try:
+        cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+    except (ValueError, OSError):
+        cpus = 1
+    return os.getloadavg()[0] / max(cpus, 1)
+
+
+def get_memory_pressure(path=PRESSURE_PATH):
+    """
+    Returns the share of the last 10 seconds (0-100) some tasks waited for
+    memory or None without PSI (Linux < 4.20 or psi=0).
+    """
+    try:
+        with open(path) as pressure_file:
+            for line in pressure_file:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    for field in fields[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'avg10':
+                            return float(value)
+    except IOError, err:
+        if err.errno not in (errno.ENOENT, errno.EOPNOTSUPP):
+            raise
+    return None
+
+
+class ScalingPolicy(object):
+    """
+    Decides how many workers a DaemonMaster needs from its signals:
+
+    * busy - share of time workers spent on requests since the last check
+      (reported by DaemonWorker.busy() and idle()), kept near target_busy
+    * queue - waiting requests from DaemonMaster.get_queue_depth(), if
+      queue_per_worker is set there are enough workers for all of them
+    * load, memory_pressure - host load per CPU and PSI of memory, above
+      max_load or max_memory_pressure the pool doesn't grow
+
+    A change up waits up_cooldown seconds after the previous change, a change
+    down waits down_cooldown, so short peaks don't make the pool flap.
+    Override get_desired() for another policy.
+    """
+    def __init__(self, target_busy=0.7, queue_per_worker=None, max_load=None, max_memory_pressure=None,
+                 interval=5, up_cooldown=10, down_cooldown=60):
+        self.target_busy = target_busy
+        self.queue_per_worker = queue_per_worker
+        self.max_load = max_load
+        self.max_memory_pressure = max_memory_pressure
+        self.interval = interval
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.last_change = None
+
+    def get_desired(self, signals, current):
+        desired = current
+        if signals.get('busy') is not None and self.target_busy:
+            desired = int(math.ceil(current * signals['busy'] / self.target_busy))
+        if signals.get('queue') is not None and self.queue_per_worker:
+            desired = max(desired, int(math.ceil(float(signals['queue']) / self.queue_per_worker)))
+        return desired
+
+    def is_overloaded(self, signals):
+        if self.max_load is not None and signals.get('load') is not None and signals['load'] > self.max_load:
+            return True
+        if (self.max_memory_pressure is not None and signals.get('memory_pressure') is not None and
+                signals['memory_pressure'] > self.max_memory_pressure):
+            return True
+        return False
+
+    def decide(self, signals, current, min_workers, max_workers, now=None):
+        """
+        Returns the number of workers the pool should have.
+        """
+        now = now or time.time()
+        desired = min(max(self.get_desired(signals, current), min_workers), max_workers)
+        # bounds are kept whatever the cooldowns are
+        if min_workers <= current <= max_workers:
+            if desired > current:
+                if self.is_overloaded(signals):
+                    log.debug('pool is not grown, the host is overloaded: %s', signals)
+                    return current
+                if self.last_change is not None and now - self.last_change < self.up_cooldown:
+                    return current
+            elif desired < current:
+                if self.last_change is not None and now - self.last_change < self.down_cooldown:
+                    return current
+        if desired != current:
+            self.last_change = now
+        return desired
@@ -11,17 +11,74 @@ SETTINGS_MANAGER = {
     },
     'configs': '/etc/daemon-manager',
     'pid': '/var/run/daemon-manager.pid',
-    'sleep': 5,
+    'socket': '/var/run/daemon-manager.sock',
+    'cache': '/var/cache/daemon-manager/configs.cache',
+    # cgroup v2 subtree of daemons relative to the cgroup2 mount, every daemon
+    # gets its own child cgroup there. None keeps the /proc based tracking
+    'cgroup': 'daemon-manager',
+    'watch': {
+        # seconds between kill(pid, 0) checks where pidfd is not supported
+        'poll': 1,
+        # seconds between full status checks of all daemons
+        'reconcile': 60
+    },
+    'sampling': {
+        # seconds between resource samples of running daemons, 0 disables
+        'interval': 1,
+        # samples kept per daemon
+        'size': 300,
+        # seconds between /proc scans for descendants of daemons without cgroup
+        'tree': 10,
+        # samples rates are computed over
+        'window': 5
+    },
+    'metrics': {
+        # "unix:/path" or "host:port" to serve Prometheus metrics on, None disables
+        'listen': None,
+        # file for the textfile collector of node-exporter, None disables
+        'textfile': None,
+        # seconds between writes of the textfile
+        'interval': 15
+    },
+    'logs': {
+        # stdout and stderr of daemons go to <dir>/<name>.log, None discards them
+        'dir': '/var/log/daemon-manager/daemons/',
+        # bytes and seconds (0 - no limit) after which a log segment is rotated
+        'max_size': 10 * 1024 * 1024,
+        'max_age': 0,
+        # rotated segments kept as <name>.log.<milliseconds>, all but the
+        # newest hot ones are compressed
+        'segments': 5,
+        'hot': 1,
+        # lines per second a daemon may write (burst at once), others are dropped. 0 disables
+        'rate': 1000,
+        'burst': 10000
+    },
+    # host-wide limit of respawns: burst at once, then rate per second
+    'respawn_limit': {
+        'rate': 1,
+        'burst': 5
+    },
     'defaults': {
         'timeouts': {
             'start': 2,
             'stop': 5
         },
         'respawn': {
+            # crashes in a row after which the daemon is failed
             'limit': 0,
-            'interval': 5
+            # seconds from a start to a restart, doubled with every crash in a row
+            'interval': 5,
+            'max_interval': 300,
+            # share of the delay taken off at random, so daemons crashed together restart apart
+            'jitter': 0.5,
+            # seconds of uptime after which crashes are forgotten
+            'healthy': 60
         },
         'expect': False,
+        # pass NOTIFY_SOCKET to expect daemons and wait for READY=1 instead
+        # of sleeping for the whole start timeout
+        'notify': True,
         'signals': {
             'terminate': signal.SIGTERM,
             'kill': signal.SIGKILL,
@@ -36,11 +93,15 @@ SETTINGS_TOOLS = {
         'filename': 'daemon-tools.log',
         'level': logging.DEBUG
     },
+    # daemons handled in parallel by start/stop/restart all
+    'jobs': 8,
 }
 
 if DEBUG:
     SETTINGS_MANAGER['log']['dir'] = '/vagrant/Python/ProcessMaster/tests/daemons/logs/'
     SETTINGS_MANAGER['configs'] = '/vagrant/Python/ProcessMaster/tests/configs'
     SETTINGS_MANAGER['pid'] = '/vagrant/Python/ProcessMaster/tests/daemons/run/daemon-manager.pid'
+    SETTINGS_MANAGER['socket'] = '/vagrant/Python/ProcessMaster/tests/daemons/run/daemon-manager.sock'
+    SETTINGS_MANAGER['cache'] = '/vagrant/Python/ProcessMaster/tests/daemons/run/configs.cache'
 
     SETTINGS_TOOLS['log']['dir'] = '/vagrant/Python/ProcessMaster/tests/daemons/logs/'
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import os
+import socket
+import stat
+
+
+# the same variables as systemd uses, so sd_listen_fds-aware daemons work as is
+LISTEN_PID = 'LISTEN_PID'
+LISTEN_FDS = 'LISTEN_FDS'
+LISTEN_FDNAMES = 'LISTEN_FDNAMES'
+LISTEN_FDS_START = 3
+
+# not in the socket module of python 2
+SO_DOMAIN = 39
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def parse_address(address):
+    """
+    Parses "unix:/path", "/path", "@abstract", "host:port", "[::1]:port" or
+    ":port" (all interfaces). Returns (family, address for bind).
+    """
+    address = str(address)
+    if address.startswith('unix:'):
+        address = address[5:]
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+    if address.startswith('@'):
+        return socket.AF_UNIX, '\0' + address[1:]
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit() or not 0 <= int(port) <= 65535:
+        raise ValueError('invalid listen address %r, "host:port" or "unix:/path" expected' % (address,))
+    if host.startswith('['):
+        return socket.AF_INET6, (host.strip('[]'), int(port))
+    return socket.AF_INET, (host or '0.0.0.0', int(port))
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def bind_socket(address, backlog=socket.SOMAXCONN, reuse_port=False):
+    """
+    Returns a listening stream socket. It isn't inherited by executed
+    programs, pass it with pass_sockets(). With reuse_port every process
+    may bind its own socket to the address and the kernel balances new
+    connections between them.
+    """
+    family, bind_address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        _set_cloexec(sock.fileno())
+        if family == socket.AF_UNIX:
+            if not bind_address.startswith('\0'):
+                # a socket left by a previous run
+                try:
+                    if stat.S_ISSOCK(os.stat(bind_address).st_mode):
+                        os.remove(bind_address)
+                except OSError:
+                    pass
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(bind_address)
+        sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def pass_sockets(sockets, names, env):
+    """
+    Moves sockets to fds 3, 4, ... and describes them in env for the
+    program executed next. Called in the child process before exec.
+    """
+    # the copies are above the target fds, so none of them is overwritten
+    fds = [fcntl.fcntl(sock.fileno(), fcntl.F_DUPFD, LISTEN_FDS_START + len(sockets)) for sock in sockets]
+    for index, fd in enumerate(fds):
+        os.dup2(fd, LISTEN_FDS_START + index)
+        os.close(fd)
+    env[LISTEN_PID] = str(os.getpid())
+    env[LISTEN_FDS] = str(len(sockets))
+    env[LISTEN_FDNAMES] = ':'.join(names)
+
+
+def listen_sockets(unset_environment=False):
+    """
+    Returns (name, socket) of sockets passed by the supervisor, like
+    sd_listen_fds(3). Their fds aren't inherited by executed programs.
+    """
+    try:
+        pid = int(os.environ.get(LISTEN_PID, ''))
+        number = int(os.environ.get(LISTEN_FDS, ''))
+    except ValueError:
+        number = 0
+    else:
+        if pid != os.getpid():
+            number = 0
+    names = os.environ.get(LISTEN_FDNAMES, '').split(':')
+    if unset_environment:
+        for key in (LISTEN_PID, LISTEN_FDS, LISTEN_FDNAMES):
+            os.environ.pop(key, None)
+
+    sockets = []
+    for index in xrange(number):
+        fd = LISTEN_FDS_START + index
+        # fromfd needs the family, which only the socket itself knows
+        probe = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        family = probe.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+        sock_type = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+        probe.close()
+        sock = socket.fromfd(fd, family, sock_type)
+        os.close(fd)
+        _set_cloexec(sock.fileno())
+        name = names[index] if index < len(names) and names[index] else 'unknown'
+        sockets.append((name, sock))
+    return sockets
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import errno
+import os
+import threading
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+# the same number on every architecture since syscall numbers were unified
+SYS_pidfd_open = 434
+
+PR_SET_CHILD_SUBREAPER = 36
+PR_GET_CHILD_SUBREAPER = 37
+
+# glibc has no ioprio_set(), its number differs between architectures
+SYS_ioprio_set = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}.get(os.uname()[4])
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {
+    'rt': 1,
+    'be': 2,
+    'idle': 3,
+}
+
+PRIO_PROCESS = 0
+
+# bits in cpu_set_t of glibc, masks grow if the kernel has more CPUs
+CPU_SETSIZE = 1024
+_ULONG_BITS = ctypes.sizeof(ctypes.c_ulong) * 8
+
+P_ALL = 0
+WEXITED = 4
+WNOWAIT = 0x01000000
+
+# children whose exit status is collected by their Popen, see reap_children
+waited_children = set()
+waited_lock = threading.Lock()
+
+
+class _ChildInfo(ctypes.Structure):
+    _fields_ = [('pid', ctypes.c_int), ('uid', ctypes.c_uint), ('status', ctypes.c_int)]
+
+
+class _SigInfoFields(ctypes.Union):
+    # aligned to a pointer like the union of siginfo_t
+    _fields_ = [('child', _ChildInfo), ('align', ctypes.c_void_p), ('pad', ctypes.c_int * 29)]
+
+
+class _SigInfo(ctypes.Structure):
+    _fields_ = [('signo', ctypes.c_int), ('errno', ctypes.c_int), ('code', ctypes.c_int),
+                ('fields', _SigInfoFields)]
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def pidfd_open(pid):
+    """
+    Returns a file descriptor which becomes readable when the process exits.
+    Raises OSError with ENOSYS on kernels older than 5.3.
+    """
+    if hasattr(os, 'pidfd_open'):
+        return os.pidfd_open(pid)
+    return _check(_libc.syscall(SYS_pidfd_open, ctypes.c_int(pid), ctypes.c_uint(0)))
+
+
+def set_child_subreaper(enabled=True):
+    """
+    Orphaned descendants are reparented to this process instead of init,
+    so it gets their SIGCHLD and has to reap them. Linux 3.4+.
+    """
+    _check(_libc.prctl(PR_SET_CHILD_SUBREAPER, ctypes.c_ulong(1 if enabled else 0), 0, 0, 0))
+
+
+def is_child_subreaper():
+    enabled = ctypes.c_int(0)
+    try:
+        _check(_libc.prctl(PR_GET_CHILD_SUBREAPER, ctypes.byref(enabled), 0, 0, 0))
+    except OSError:
+        return False
+    return bool(enabled.value)
+
+
+def sched_setaffinity(pid, cpus):
+    """
+    Pins the process (0 for the calling one) to the CPUs.
+    """
+    cpus = list(cpus)
+    words = max(CPU_SETSIZE, max(cpus) + 1) // _ULONG_BITS + 1
+    mask = (ctypes.c_ulong * words)()
+    for cpu in cpus:
+        mask[cpu // _ULONG_BITS] |= 1 << (cpu % _ULONG_BITS)
+    _check(_libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)))
+
+
+def sched_getaffinity(pid):
+    """
+    Returns the sorted list of CPUs the process may run on.
+    """
+    words = CPU_SETSIZE // _ULONG_BITS
+    while True:
+        mask = (ctypes.c_ulong * words)()
+        try:
+            _check(_libc.sched_getaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)))
+        except OSError, err:
+            # the mask is smaller than the kernel's one
+            if err.errno == errno.EINVAL and words < 1024:
+                words *= 2
+                continue
+            raise
+        return [i * _ULONG_BITS + bit for i in xrange(words) for bit in xrange(_ULONG_BITS)
+                if mask[i] >> bit & 1]
+
+
+def setpriority(pid, nice):
+    """
+    Sets the nice value of the process (0 for the calling one).
+    """
+    _check(_libc.setpriority(PRIO_PROCESS, pid, nice))
+
+
+def ioprio_set(pid, ioclass, level=0):
+    """
+    Sets the I/O scheduling class (rt, be or idle) and level (0-7, 0 is the
+    highest) of the process. Schedulers without priorities ignore them.
+    """
+    if SYS_ioprio_set is None:
+        raise OSError(errno.ENOSYS, 'ioprio_set is unknown on %s' % os.uname()[4])
+    ioprio = IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT | level
+    _check(_libc.syscall(SYS_ioprio_set, IOPRIO_WHO_PROCESS, pid, ioprio))
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        if err.errno == errno.ESRCH:
+            return False
+        if err.errno == errno.EPERM:
+            return True
+        raise
+    return True
+
+
+def reap(pid):
+    """
+    Collects the exit status of a child process without blocking.
+    Returns True if the pid was a child and has been reaped.
+    """
+    try:
+        reaped_pid, _ = os.waitpid(pid, os.WNOHANG)
+    except OSError, err:
+        if err.errno != errno.ECHILD:
+            raise
+        return False
+    return reaped_pid == pid
+
+
+def _peek_child():
+    """
+    Returns the pid of an exited child without reaping it, None if there is
+    none.
+    """
+    info = _SigInfo()
+    while True:
+        try:
+            _check(_libc.waitid(P_ALL, 0, ctypes.byref(info), WEXITED | os.WNOHANG | WNOWAIT))
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno != errno.ECHILD:
+                raise
+            return None
+        return info.fields.child.pid or None
+
+
+def reap_children():
+    """
+    Collects exited children without blocking, but not waited_children:
+    a Popen whose child is reaped by someone else gets ECHILD and takes it
+    for a success. Children which exit after a waited one are left to the
+    next call. Returns the pids of reaped children.
+    """
+    pids = []
+    while True:
+        with waited_lock:
+            pid = _peek_child()
+            if pid is None or pid in waited_children:
+                break
+            reap(pid)
+        pids.append(pid)
+    return pids
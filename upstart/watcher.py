@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import os
+import select
+import time
+
+from .syscalls import pidfd_open, pid_exists, reap
+
+
+log = logging.getLogger(__name__)
+
+
+class ProcessWatcher(object):
+    """
+    Reports exits of watched processes. A pidfd of every process is put
+    into epoll, so an exit wakes the caller immediately. On kernels without
+    pidfd_open processes are polled with kill(pid, 0) every poll_interval.
+
+    Other file descriptors can share the same loop through add_reader().
+    """
+    def __init__(self, poll_interval=1):
+        self.poll_interval = poll_interval
+        self.epoll = select.epoll()
+        self.watched = {}
+        self.pidfds = {}
+        self.polled = {}
+        self.readers = {}
+        self.pidfd_supported = True
+        self._next_poll = None
+
+    def watch(self, key, pid):
+        if self.watched.get(key) == pid:
+            return
+        self.unwatch(key)
+        self.watched[key] = pid
+
+        if self.pidfd_supported:
+            try:
+                fd = pidfd_open(pid)
+            except OSError, err:
+                if err.errno == errno.ESRCH:
+                    # already gone, nothing to wait for
+                    del self.watched[key]
+                    return
+                if err.errno not in (errno.ENOSYS, errno.EINVAL, errno.EPERM):
+                    raise
+                log.info('pidfd is not supported (%s), polling processes', err)
+                self.pidfd_supported = False
+            else:
+                self.pidfds[fd] = key
+                self.epoll.register(fd, select.EPOLLIN)
+                return
+
+        self._add_polled(key, pid)
+
+    def _add_polled(self, key, pid):
+        self.polled[key] = pid
+        if self._next_poll is None:
+            self._next_poll = time.time()
+
+    def unwatch(self, key):
+        if self.watched.pop(key, None) is None:
+            return
+        self.polled.pop(key, None)
+        for fd, watched_key in self.pidfds.items():
+            if watched_key == key:
+                self._close_pidfd(fd)
+
+    def unwatch_all(self):
+        for key in self.watched.keys():
+            self.unwatch(key)
+
+    def _close_pidfd(self, fd):
+        del self.pidfds[fd]
+        self.epoll.unregister(fd)
+        os.close(fd)
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if self.readers.pop(fd, None) is not None:
+            self.epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) and returns keys of
+        the processes which have exited. Exited processes are unwatched.
+        """
+        if self.polled:
+            poll_timeout = max(self._next_poll - time.time(), 0)
+            if timeout is None or poll_timeout < timeout:
+                timeout = poll_timeout
+
+        try:
+            events = self.epoll.poll(-1 if timeout is None else timeout)
+        except IOError, err:
+            if err.errno != errno.EINTR:
+                raise
+            events = []
+
+        exited = []
+        for fd, event in events:
+            if fd in self.pidfds:
+                key = self.pidfds[fd]
+                reap(self.watched[key])
+                exited.append(key)
+                self.unwatch(key)
+            elif fd in self.readers:
+                self.readers[fd](fd)
+
+        if self.polled and self._next_poll <= time.time():
+            for key, pid in self.polled.items():
+                if reap(pid) or not pid_exists(pid):
+                    exited.append(key)
+                    self.unwatch(key)
+            self._next_poll = time.time() + self.poll_interval
+
+        return exited